@@ -1,7 +1,13 @@
-from collections import Iterable
+from array import array
+from collections import Iterable, namedtuple
+from contextlib import contextmanager
+from itertools import count as counter
 import logging
 import re
 import socket
+from struct import error as StructError
+import threading
+from time import time
 
 try:
     # Use Django settings if they're around:
@@ -18,8 +24,19 @@ except ImportError:
 
 import sphinxapi
 
-from oedipus.results import DictResults, TupleResults, ObjectResults
-from oedipus.utils import lookup_triples, listify, mix_slices
+from oedipus.balancing import ReplicaSet
+from oedipus.cache import QueryRecorder, SingleFlight
+from oedipus.circuit import CircuitBreaker, CircuitOpen
+from oedipus.compact import CompactMatches
+from oedipus.instrumentation import count, timed
+from oedipus.parallel import ThreadPool
+from oedipus.pool import ConnectionPool
+from oedipus.protocol import (NO_TIMEOUTS, IncompleteResponse, QueryEncoder,
+                              Timeouts, excerpt_exchange, run)
+from oedipus.sharding import merge_results
+from oedipus.results import (DictResults, TupleResults, ObjectResults,
+                             AttrResults, AttrDictResults, AttrTupleResults)
+from oedipus.utils import lookup_triples, listify, mix_slices, Steps
 
 
 # 64-bit signed min and max, which are the bounds of Sphinx's range filters:
@@ -39,6 +56,15 @@ MIN_WEIGHT = 1
 MAX_WEIGHT = 10
 
 
+# The number of results SphinxClient asks for if you don't call SetLimits():
+DEFAULT_LIMIT = 20
+
+
+# Where searchd is, for S objects which aren't told otherwise:
+DEFAULT_HOST = settings.SPHINX_HOST
+DEFAULT_PORT = settings.SPHINX_PORT
+
+
 log = logging.getLogger('oedipus')
 
 
@@ -46,6 +72,10 @@ class SearchError(Exception):
     pass
 
 
+class SearchSocketError(SearchError):
+    pass
+
+
 class ExcerptError(Exception):
     pass
 
@@ -58,12 +88,37 @@ class ExcerptSocketError(ExcerptError):
     pass
 
 
+class QueryPlan(namedtuple('QueryPlan', ['query', 'filters', 'sort',
+                                         'group_by', 'weights', 'fields',
+                                         'results_class', 'highlight_fields',
+                                         'highlight_options'])):
+    """The compiled form of an ``S``'s steps
+
+    It holds everything needed to set up a SphinxClient for a query, worked
+    out once so it needn't be each time the query runs. ``filters`` is a
+    tuple of (SphinxClient method name, args) pairs, ready to apply.
+    ``group_by`` is None or an (attribute, group sort clause) pair. Treat the
+    dicts as read-only; plans are shared.
+
+    """
+    __slots__ = ()
+
+
 class S(object):
     """A lazy query of Sphinx whose API is a subset of elasticutils.S"""
-    def __init__(self, model, host=settings.SPHINX_HOST,
-                              port=settings.SPHINX_PORT):
+    def __init__(self, model, host=None, port=None):
+        """
+        :arg host: The host where searchd lives. Defaults to
+            ``settings.SPHINX_HOST`` as of import time.
+        :arg port: The port searchd listens on. Defaults to
+            ``settings.SPHINX_PORT`` as of import time.
+
+        Passing either one overrides any replicas set up in the model's
+        ``SphinxMeta`` or in ``settings.SPHINX_REPLICAS``.
+
+        """
         self.type = model
-        self.steps = []
+        self.steps = Steps()
         self.meta = model.SphinxMeta
         self._host = host
         self._port = port
@@ -75,15 +130,27 @@ class S(object):
         # further __getitem__() calls after that.
         self._slice = slice(None, None)
         self._raw_cache = None
+        self._count_cache = None  # Results of a count-only query
+        self._error = None  # What went wrong in execute_parallel(), if anything
+        self._hydrated = {}  # {id: obj/tuple/dict} pulled from the DB so far
         self._highlight_fields = []
         self._highlight_options = {}
         self._query = None
+        # Overrides of the SphinxMeta.result_cache's behavior:
+        self._cache_ttl = None
+        self._cache_bypass = False
+        self._timeouts = NO_TIMEOUTS  # Overrides of SphinxMeta's
+        self._plan = None  # QueryPlan compiled from steps
+        self._fingerprints = {}  # {count_only: fingerprint}
 
     def _clone(self, next_step=None):
         new = self.__class__(self.type)
-        new.steps = self.steps[:]
         if next_step:
-            new.steps.append(next_step)
+            new.steps = self.steps.plus(next_step)
+        else:
+            new.steps = self.steps
+            # Same steps, so the same plan will do:
+            new._plan = self._plan
         new.meta = self.meta
         new._host = self._host
         new._port = self._port
@@ -92,6 +159,9 @@ class S(object):
         new._slice = self._slice
         new._highlight_fields = self._highlight_fields
         new._highlight_options = self._highlight_options
+        new._cache_ttl = self._cache_ttl
+        new._cache_bypass = self._cache_bypass
+        new._timeouts = self._timeouts
         return new
 
     @property
@@ -101,12 +171,51 @@ class S(object):
         Overridable in case you need this to differ at test time, for instance
 
         """
-        return self._host
+        return DEFAULT_HOST if self._host is None else self._host
 
     @property
     def port(self):
         """Return the port number where Sphinx is listening."""
-        return self._port
+        return DEFAULT_PORT if self._port is None else self._port
+
+    def _replicas(self):
+        """Return the ``ReplicaSet`` to spread my queries among, or None if they all go to ``host`` and ``port``.
+
+        ``SphinxMeta.replicas`` wins over ``settings.SPHINX_REPLICAS``, and
+        either can be a ``ReplicaSet`` or a list of (host, port) pairs.
+
+        """
+        if self._host is not None or self._port is not None:
+            return None
+        replicas = (getattr(self.meta, 'replicas', None) or
+                    getattr(settings, 'SPHINX_REPLICAS', None))
+        if not replicas or isinstance(replicas, ReplicaSet):
+            return replicas or None
+        return replica_set(replicas)
+
+    def _deadlines(self):
+        """Return the ``protocol.Timeouts`` my searches run under, or None if there are none."""
+        timeouts = Timeouts(*[mine if mine is not None else
+                              getattr(self.meta, name, None)
+                              for mine, name in zip(self._timeouts,
+                                                    ('connect_timeout',
+                                                     'read_timeout',
+                                                     'hedge_after'))])
+        if timeouts == (None, None, None):
+            return None
+        return timeouts
+
+    def _shards(self):
+        """Return the servers my index is split across, or None if it isn't.
+
+        They come from ``SphinxMeta.shards``, a list of (host, port) pairs
+        or ``ReplicaSet`` objects. Like replicas, they're ignored if I was
+        given a host or port.
+
+        """
+        if self._host is not None or self._port is not None:
+            return None
+        return getattr(self.meta, 'shards', None) or None
 
     def __getitem__(self, k):
         """Do a lazy slice of myself, or return a single item from my results.
@@ -125,11 +234,15 @@ class S(object):
 
         """
         if self._raw_cache is not None:
-            return self._results(k)
+            if isinstance(k, slice):
+                return self._results(k)
+            return list(self._results(k))[0]
 
         new = self._clone()
         # Compute a single slice out of any we already have & the new one:
         new._slice = mix_slices(new._slice, k)
+        # Count-only queries ignore the slice, so their results still apply:
+        new._count_cache = self._count_cache
         if isinstance(k, slice):  # k is a slice, so we can be lazy.
             return new
         else:  # k is a number; we must fetch results.
@@ -281,6 +394,70 @@ class S(object):
             raise TypeError('values() must be given a list of field names.')
         return self._clone(next_step=('values', fields))
 
+    def attrs(self, *fields):
+        """Return a new ``S`` whose results are tuples of Sphinx attributes.
+
+        Like ``values()``, but the values come straight from the attributes
+        Sphinx returns with each match, without a DB query. ``id`` may be
+        included even if it isn't an attribute; it's the object ID.
+
+        """
+        if not fields:
+            raise TypeError('attrs() must be given a list of field names.')
+        return self._clone(next_step=('attrs', fields))
+
+    def attrs_dict(self, *fields):
+        """Return a new ``S`` whose results are dicts of Sphinx attributes.
+
+        Like ``values_dict()``, but without a DB query. With no ``fields``,
+        each dict holds all the attributes, plus ``id``.
+
+        """
+        return self._clone(next_step=('attrs_dict', fields))
+
+    def cache(self, ttl=None, bypass=False):
+        """Return a new ``S`` which caches its results differently.
+
+        Results are cached across ``S`` objects only if the model's
+        ``SphinxMeta`` has a ``result_cache``.
+
+        :arg ttl: Number of seconds to cache results, overriding the
+            ``result_cache``'s default
+        :arg bypass: If True, neither consult nor fill the cache
+
+        """
+        new = self._clone()
+        new._cache_ttl = ttl
+        new._cache_bypass = bypass
+        return new
+
+    def timeout(self, connect=None, read=None, hedge_after=None):
+        """Return a new ``S`` which gives up on or hedges slow searches sooner.
+
+        Each defaults to the ``SphinxMeta`` attribute of the same name (with
+        ``_timeout`` tacked onto the first two), and otherwise to no limit.
+
+        :arg connect: Seconds to allow for connecting to searchd
+        :arg read: Seconds to allow, once connected, for sending the query
+            and getting the response
+        :arg hedge_after: Seconds after which, if searchd hasn't answered,
+            to send the query to a second replica as well and take
+            whichever answer comes first. This has an effect only with
+            replicas. Something like your 95th percentile latency is a good
+            start.
+
+        Running out of time raises ``SearchError``. An ``S`` with any of
+        these runs its searches over non-blocking sockets, so it doesn't use
+        the connection pool.
+
+        """
+        new = self._clone()
+        new._timeouts = Timeouts(*[mine if mine is not None else old for
+                                   mine, old in zip((connect, read,
+                                                     hedge_after),
+                                                    self._timeouts)])
+        return new
+
     def object_ids(self):
         """Returns a list of object IDs from Sphinx matches.
 
@@ -290,18 +467,26 @@ class S(object):
 
         """
         raw = self._raw()  # side effect: sets _results_class and _fields
-        results = raw['matches']
+        return self._ids(raw['matches'])
 
+    def _ids(self, matches):
+        """Return the object IDs of some Sphinx matches, as ``object_ids()`` does."""
+        if isinstance(matches, CompactMatches):
+            return list(matches.column(getattr(self.meta, 'id_field', 'id')))
         if hasattr(self.meta, 'id_field'):
             field = self.meta.id_field
-            ids = [r['attrs'][field] for r in results]
-        else:
-            ids = [r['id'] for r in results]
-        return ids
+            return [m['attrs'][field] for m in matches]
+        return [m['id'] for m in matches]
 
     def count(self):
         """Return the number of hits for the current query.
 
+        This is the total number of matching docs, less any sliced off, even
+        if there are more than you could iterate over. If results have
+        already been fetched, their count is used; otherwise, a cheap query
+        is run which fetches just the count, not the matches. Either way, it
+        is cached.
+
         .. Note::
 
            This tells you the number of docs that match the Sphinx
@@ -309,8 +494,23 @@ class S(object):
            then this won't be accurate.
 
         """
-        raw = self._raw()
-        return len(raw['matches'])
+        if self._raw_cache is not None:
+            raw = self._raw()
+        else:
+            if self._count_cache is None:
+                self._count_cache = self._execute(count_only=True)
+            raw = self._count_cache
+        total = raw.get('total_found', 0)
+
+        # Take slicing into account:
+        if isinstance(self._slice, slice):
+            start = self._slice.start or 0
+            stop = self._slice.stop
+            total = max(total - start, 0)
+            if stop is not None:
+                total = min(total, stop - start)
+            return total
+        return 1 if total > self._slice else 0
 
     __len__ = count
 
@@ -322,6 +522,9 @@ class S(object):
         gives us API compatibility with elasticutils, which can return multiple
         highlit fragments for each highlit field.
 
+        To excerpt several results, ``excerpts()`` is much faster than calling
+        this repeatedly.
+
         :raises ExcerptError: Raises an ``ExcerptError`` if
             ``excerpt`` was called before results were calculated or if
             ``highlight_fields`` is not a subset of ``fields``
@@ -332,6 +535,92 @@ class S(object):
         :raises ExcerptSocketError: if there was a socket.error
             when trying to retrieve the excerpt.
 
+        """
+        return self.excerpts([result])[0]
+
+    def excerpts(self, results):
+        """Return the excerpts of many results, built in a single request to Sphinx.
+
+        Return a list with an item for each result, in order. Each is what
+        ``excerpt()`` would return for that result.
+
+        Raises the same exceptions as ``excerpt()``.
+
+        """
+        results = list(results)
+        docs, options = self._excerpt_request(results)
+        if not docs:
+            return [[] for r in results]
+
+        deadlines = self._deadlines()
+        if deadlines is not None:
+            exchange = excerpt_exchange(docs, self.meta.index, self._query,
+                                        options)
+            excerpts = _run_exchanges([(_excerpt_server(self), exchange,
+                                        deadlines)],
+                                      event='excerpts',
+                                      index=self.meta.index,
+                                      matches=len(docs),
+                                      bytes=sum(len(d) for d in docs))[0]
+            if isinstance(excerpts, socket.timeout):
+                raise ExcerptTimeoutError('Socket timeout error with excerpt!')
+            if isinstance(excerpts, CircuitOpen):
+                raise ExcerptSocketError(str(excerpts))
+            if isinstance(excerpts, socket.error):
+                raise ExcerptSocketError(
+                    'Socket error building excerpt: %s!' % excerpts)
+            if isinstance(excerpts, Exception):
+                raise ExcerptError('Sphinx failed to build excerpts: %s' %
+                                   excerpts)
+            return self._split_excerpts(excerpts)
+
+        with _client_for(_excerpt_server(self),
+                         unavailable=ExcerptSocketError) as sphinx:
+            try:
+                with timed('excerpts', index=self.meta.index,
+                           matches=len(docs),
+                           bytes=sum(len(d) for d in docs)):
+                    excerpts = sphinx.BuildExcerpts(
+                        docs, self.meta.index, self._query, options)
+            except socket.timeout:
+                raise ExcerptTimeoutError('Socket timeout error with excerpt!')
+            except (socket.error, StructError), msg:
+                # The sphinxapi exceptions suck, so raising our own and
+                # ignoring theirs doesn't make a big difference.
+                raise ExcerptSocketError(
+                    'Socket error building excerpt: %s!', msg)
+            if excerpts is None:
+                error = sphinx.GetLastError()
+                if _is_connection_error(error):
+                    raise ExcerptSocketError(
+                        'Socket error building excerpt: %s!' % error)
+                raise ExcerptError('Sphinx failed to build excerpts: %s' %
+                                   error)
+        return self._split_excerpts(excerpts)
+
+    def excerpts_exchange(self, results):
+        """Return a ``protocol.Exchange`` which builds excerpts without blocking.
+
+        This is ``excerpts()`` for use with event loops. Send the exchange's
+        ``request`` to a searchd serving my index--(``host``, ``port``), or,
+        if the index is sharded, any one shard--and ``feed()`` it the
+        response. Its ``finish()`` then returns what ``excerpts()`` would.
+
+        If there's nothing to excerpt, return None.
+
+        """
+        docs, options = self._excerpt_request(list(results))
+        if not docs:
+            return None
+        return excerpt_exchange(docs, self.meta.index, self._query, options,
+                                self._split_excerpts)
+
+    def _excerpt_request(self, results):
+        """Return the docs and options to send to Sphinx to excerpt some results.
+
+        The docs are the highlighted fields of all the results, in one flat
+        list.
+
         """
         # This catches the case where results haven't been calculated.
         # That could happen if the results from one S were used in a
@@ -352,8 +641,10 @@ class S(object):
                 "highlight_fields isn't a subset of fields %r %r" %
                 (highlight_fields, self._fields))
 
-        docs = self._results_class.content_for_fields(
-            result, self._fields, highlight_fields)
+        docs = []
+        for result in results:
+            docs.extend(self._results_class.content_for_fields(
+                result, self._fields, highlight_fields))
 
         # Note that this requires the option names in
         # _highlight_options to exactly match the option names in
@@ -364,25 +655,62 @@ class S(object):
                 options[mem] = self._highlight_options[mem]
             elif hasattr(self.meta, 'excerpt_' + mem):
                 options[mem] = getattr(self.meta, 'excerpt_' + mem)
+        return docs, options
 
-        sphinx = self._sphinx()
-
-        try:
-            excerpt = sphinx.BuildExcerpts(
-                list(docs), self.meta.index, self._query, options)
-        except socket.error, msg:
-            # The sphinxapi exceptions suck, so raising our own and
-            # ignoring theirs doesn't make a big difference.
-            raise ExcerptSocketError(
-                'Socket error building excerpt: %s!', msg)
-        except socket.timeout:
-            raise ExcerptTimeoutError('Socket timeout error with excerpt!')
-
+    def _split_excerpts(self, excerpts):
+        """Turn a flat list of excerpted fields from Sphinx into one list per result."""
         # TODO: This assumes the data is in utf-8 which it might not
         # be depending on the backing database configuration.
-        excerpt = [[e.decode('utf-8')] for e in excerpt]
+        excerpts = [[e.decode('utf-8')] for e in excerpts]
+
+        # Split the flat list back up into one list per result:
+        n = len(self._highlight_fields)
+        return [excerpts[i:i + n] for i in xrange(0, len(excerpts), n)]
+
+    def with_excerpts(self):
+        """Iterate over my results, yielding (result, excerpt) pairs.
+
+        The excerpts of all the results are built in a single request to
+        Sphinx. Each excerpt is what ``excerpt()`` would return for its result.
+
+        """
+        results = list(self)
+        return iter(zip(results, self.excerpts(results)))
+
+    def with_weights(self):
+        """Iterate over my results, yielding (result, relevance weight) pairs."""
+        return self._results().with_weights()
+
+    @property
+    def total_found(self):
+        """Return the total number of matching documents, regardless of slicing."""
+        return self._response().get('total_found', 0)
+
+    @property
+    def query_time(self):
+        """Return the number of seconds searchd spent on my query."""
+        return float(self._response().get('time', 0))
+
+    @property
+    def word_stats(self):
+        """Return how common each of my query's keywords is in the index.
+
+        It's a list of dicts like ``{'word': 'gerbil', 'docs': 12, 'hits':
+        30}``, one per keyword.
+
+        """
+        return self._response().get('words', [])
 
-        return excerpt
+    def _response(self):
+        """Return my raw results, for their metadata.
+
+        If just a count has been fetched, its results will do; otherwise,
+        fetch results, just as iterating over me would.
+
+        """
+        if self._raw_cache is None and self._count_cache is not None:
+            return self._count_cache
+        return self._raw()
 
     def query_fields(self, *args):
         """Ignore any default query fields; Sphinx always searches all.
@@ -396,6 +724,33 @@ class S(object):
     def __iter__(self):
         return iter(self._results())
 
+    def iterator(self, chunk_size=1000):
+        """Iterate over all my results, however many, in bounded memory.
+
+        Rather than fetching all results at once (and stopping at
+        ``SPHINX_MAX_RESULTS``), fetch and hydrate ``chunk_size`` at a time,
+        resuming each chunk after the highest document ID of the last. Thus,
+        results come out in document ID order, whatever the ordering of the
+        ``S``. Slicing is ignored, and nothing is cached.
+
+        This is meant for exports, reindexing, and such. ``chunk_size`` can't
+        exceed searchd's ``max_matches``.
+
+        """
+        # Don't push the result cache's hot queries out with chunks nobody
+        # will ask for again:
+        base = self.order_by('@id').cache(bypass=True)
+        base._slice = slice(None, None)
+        chunk = base[:chunk_size]
+        while True:
+            matches = chunk._raw()['matches']
+            for result in chunk._results():
+                yield result
+            if len(matches) < chunk_size:
+                break
+            chunk = base.filter(
+                **{'@id__gte': matches[-1]['id'] + 1})[:chunk_size]
+
     @staticmethod
     def _extended_sort_fields(fields):
         """Return the field expressions to sort by the given pseudo-fields in SPH_SORT_EXTENDED mode.
@@ -440,34 +795,47 @@ class S(object):
             else:  # There's only 1 comparator in there.
                 yield field, cmp_vals.keys()[0], cmp_vals.values()[0]
 
-    def _set_filters(self, sphinx, keys_and_values, exclude=False):
-        """Set a series of filters on a SphinxClient according to some Django ORM-lookup-style key/value pairs."""
+    def _filter_calls(self, keys_and_values, exclude=False):
+        """Return the SphinxClient calls which apply some Django ORM-lookup-style key/value pairs as filters.
+
+        Yield (method name, args) pairs.
+
+        """
         ranges = self._consolidate_ranges(keys_and_values)
         for field, comparator, value in ranges:
             value = self._filter_value_to_int(field, value)
             if not comparator:
-                sphinx.SetFilter(field, [value], exclude)
+                yield 'SetFilter', (field, [value], exclude)
             elif comparator == 'in':
-                sphinx.SetFilter(field, value, exclude)
+                # Sphinx treats the values as a set, so send each just once,
+                # and in an order that doesn't change the cache fingerprint:
+                yield 'SetFilter', (field, sorted(set(value)), exclude)
             elif comparator == 'gte':
-                sphinx.SetFilterRange(field, value, MAX_LONG, exclude)
+                yield 'SetFilterRange', (field, value, MAX_LONG, exclude)
             elif comparator == 'lte':
-                sphinx.SetFilterRange(field, MIN_LONG, value, exclude)
+                yield 'SetFilterRange', (field, MIN_LONG, value, exclude)
             elif comparator == 'RANGE':
                 # exclude() range with both min and max given:
-                sphinx.SetFilterRange(field, value[0], value[1], exclude)
+                yield 'SetFilterRange', (field, value[0], value[1], exclude)
             else:
                 raise ValueError('"%s", in "%s__%s=%s", is not a supported '
                                  'comparator.' %
                                  (comparator, field, comparator, value))
 
     def _filter_value_to_int(self, name, value):
-        """Apply filter mappings to convert values to int."""
+        """Apply filter mappings to convert values to int.
+
+        An ``array`` of integers is taken to hold values already converted
+        and is turned into a list in one go.
+
+        """
+        if isinstance(value, array) and value.typecode in _INT_TYPECODES:
+            return value.tolist()
         mappings = getattr(self.meta, 'filter_mapping', {})
         converter = mappings.get(name, int)
         if (isinstance(value, Iterable) and
             not isinstance(value, basestring)):
-            return map(converter, value)
+            return _convert_all(converter, value)
         return converter(value)
 
     @staticmethod
@@ -478,21 +846,108 @@ class S(object):
         return query.replace('^', '').replace('$', '')
 
     def _sphinx(self):
-        """Parametrize a SphinxClient to execute the query I represent, run it, and return it.
+        """Parametrize a SphinxClient to execute the query I represent, and return it.
 
-        Doesn't support batched queries yet.
+        To run several queries in one round trip, see ``execute_batch()``.
 
         """
-        # TODO: Refactor so we can do multiple searches without reopening the
-        # connection to Sphinx.
         sphinx = sphinxapi.SphinxClient()
         sphinx.SetServer(self.host, self.port)
+        self._add_query(sphinx)
+        return sphinx
+
+    def _limits(self, count_only=False):
+        """Return the (offset, limit) my slice asks Sphinx for, or None to leave them be."""
+        if count_only:
+            # Sphinx won't take a limit of 0.
+            return 0, 1
+        if isinstance(self._slice, slice):
+            if self._slice == slice(None, None):
+                return None
+            start = self._slice.start or 0
+            stop = self._slice.stop
+            return start, (settings.SPHINX_MAX_RESULTS if stop is None
+                           else (stop - start))
+        return self._slice, 1  # self._slice is a number.
+
+    def _add_query(self, sphinx, count_only=False, shard=False):
+        """Set up a SphinxClient for the query I represent, and add it to the client's batch.
+
+        The client may already hold other queries, but its per-query settings
+        must have been reset (see ``_reset_client()``) since the last of them
+        was added.
+
+        :arg count_only: If True, ask for as little as possible beyond the
+            number of matches: no ranking, no slicing, and a single ID
+        :arg shard: If True, ask for everything up to the end of my slice,
+            since it's one shard's share of the query
+
+        """
+        plan = self._compile()
         sphinx.SetMatchMode(sphinxapi.SPH_MATCH_EXTENDED2)
-        sphinx.SetRankingMode(sphinxapi.SPH_RANK_PROXIMITY_BM25)
+        sphinx.SetRankingMode(sphinxapi.SPH_RANK_NONE if count_only else
+                              sphinxapi.SPH_RANK_PROXIMITY_BM25)
+        for method, args in plan.filters:
+            getattr(sphinx, method)(*args)
+
+        # EXTENDED is a superset of all the modes we care about, so we just use
+        # it all the time:
+        sphinx.SetSortMode(sphinxapi.SPH_SORT_EXTENDED, plan.sort)
+
+        if plan.group_by is not None:
+            sphinx.SetGroupBy(plan.group_by[0], sphinxapi.SPH_GROUPBY_ATTR,
+                              plan.group_by[1])
+
+        if plan.weights:
+            sphinx.SetFieldWeights(plan.weights)
+
+        limits = self._limits(count_only=count_only)
+        if limits is not None:
+            offset, limit = limits
+            if shard:
+                # The global offset can be applied only after merging.
+                offset, limit = 0, offset + limit
+            sphinx.SetLimits(offset, limit)
+        # else don't bother setting limits
+        if count_only:
+            # Older sphinxapis don't support select lists.
+            if hasattr(sphinx, 'SetSelect'):
+                sphinx.SetSelect('@id')
+
+        # Add query. This must be done after filters and such are set up, or
+        # they may not apply. That's true of limits, too. This should
+        # probably be last.
+        sphinx.AddQuery(plan.query, self.meta.index)
 
-        # Loop over `self.steps` to build the query format that will be sent to
-        # ElasticSearch, and returns it as a dict.
+    def _compile(self):
+        """Return my ``QueryPlan``, compiling my steps into one if that hasn't been done.
+
+        As a side effect, copy the result format and highlighting settings
+        out of the plan onto me, where the rest of the code looks for them.
+
+        """
+        plan = self._plan
+        if plan is None:
+            with timed('compile', index=self.meta.index):
+                self._plan = plan = self._build_plan()
+        # Even a plan shared by the S I was cloned from needs copying, since
+        # clones don't bring along its query:
+        self._fields = plan.fields
+        self._results_class = plan.results_class
+        self._highlight_fields = plan.highlight_fields
+        self._highlight_options = plan.highlight_options
+        self._query = plan.query
+        return plan
+
+    def _build_plan(self):
+        """Interpret my steps, and return the ``QueryPlan`` they add up to."""
+        # Loop over `self.steps` to work out what will be sent to Sphinx:
         query = sort = ''
+        filters = []
+        fields = self._fields
+        results_class = self._results_class
+        highlight_fields = self._highlight_fields
+        highlight_options = {}
         try:
             group_by = self.meta.group_by
         except AttributeError:
@@ -507,23 +962,28 @@ class S(object):
             elif action == 'group_by':
                 group_by = value
             elif action == 'values':
-                self._fields = value
-                self._results_class = TupleResults
+                fields = value
+                results_class = TupleResults
             elif action == 'values_dict':
-                self._fields = value
-                self._results_class = DictResults
+                fields = value
+                results_class = DictResults
+            elif action == 'attrs':
+                fields = value
+                results_class = AttrTupleResults
+            elif action == 'attrs_dict':
+                fields = value
+                results_class = AttrDictResults
             elif action == 'query':
                 query = self._sanitize_query(value)
             elif action == 'filter':
-                self._set_filters(sphinx, value)
+                filters.extend(self._filter_calls(value))
             elif action == 'weight':
                 weights.update(value)
             elif action == 'highlight':
-                fields, options = value
-                self._highlight_fields = fields
-                self._highlight_options.update(options)
+                highlight_fields, options = value
+                highlight_options.update(options)
             elif action == 'exclude':
-                self._set_filters(sphinx, value, exclude=True)
+                filters.extend(self._filter_calls(value, exclude=True))
             else:
                 raise NotImplementedError(action)
 
@@ -532,63 +992,239 @@ class S(object):
                     (listify(getattr(self.meta, 'ordering', [])) or
                      self._default_sort()))
 
-        # EXTENDED is a superset of all the modes we care about, so we just use
-        # it all the time:
-        sphinx.SetSortMode(sphinxapi.SPH_SORT_EXTENDED, sort)
-
         if group_by is not None:
             sort_field = group_by[1]
             if not isinstance(sort_field, (tuple, list)):
                 sort_field = [sort_field]
-            sphinx.SetGroupBy(group_by[0], sphinxapi.SPH_GROUPBY_ATTR,
-                              self._extended_sort_fields(sort_field))
+            group_by = group_by[0], self._extended_sort_fields(sort_field)
+
+        # weights are name -> field_weight where the field_weights are
+        # essentially ok for Sphinx, so we just pass them through.
+        return QueryPlan(
+            query=query,
+            filters=tuple(filters),
+            sort=sort,
+            group_by=group_by,
+            weights=weights,
+            fields=fields,
+            results_class=results_class,
+            highlight_fields=highlight_fields,
+            highlight_options=highlight_options)
+
+    def search_exchange(self, count_only=False):
+        """Return a ``protocol.Exchange`` which runs my query without blocking.
+
+        This is for use with event loops. Send the exchange's ``request`` to
+        searchd at (``host``, ``port``), and ``feed()`` it the response. Its
+        ``finish()`` then caches the results on me, just as iterating over me
+        would, and returns them raw. To run many queries at once without an
+        event loop of your own, see ``execute_concurrently()``.
+
+        This ignores any shards; see ``shard_exchanges()`` for those.
+
+        :arg count_only: If True, fetch only the number of matches, as
+            ``count()`` does
 
-        # set the final set of weights here
-        if weights:
-            # weights are name -> field_weight where the field_weights
-            # are essentially ok for Sphinx, so we just pass them
-            # through.
-            sphinx.SetFieldWeights(weights)
+        """
+        encoder = QueryEncoder()
+        self._add_query(encoder, count_only=count_only)
+        return encoder.exchange(
+                lambda results: self._store(results[0], count_only))
 
-        # Convert the slice (or int) to limits:
-        if isinstance(self._slice, slice):
-            if self._slice != slice(None, None):
-                start = self._slice.start or 0
-                stop = self._slice.stop
-                max_results = (settings.SPHINX_MAX_RESULTS if stop is None
-                               else (stop - start))
+    def shard_exchanges(self, count_only=False):
+        """Return a ``protocol.Exchange`` per shard of my index, to run my query across them without blocking.
 
-                sphinx.SetLimits(start, max_results)
-            # else don't bother settings limits
-        else:  # self._slice is a number.
-            sphinx.SetLimits(self._slice, 1)
+        Send each exchange's ``request`` to its shard, the corresponding one
+        of ``SphinxMeta.shards``, and ``feed()`` it the response. Pass the
+        ``finish()`` values, in order, to ``gather()``.
 
-        # Add query. This must be done after filters and such are set up, or
-        # they may not apply. That's true of limits, too. This should
-        # probably be last.
-        self._query = query
-        sphinx.AddQuery(query, self.meta.index)
+        """
+        encoder = QueryEncoder()
+        self._add_query(encoder, count_only=count_only, shard=True)
+        return [encoder.exchange() for shard in self._shards()]
 
-        return sphinx
+    def gather(self, shard_results, count_only=False):
+        """Merge what my ``shard_exchanges()`` returned, and cache it as if it came from a single searchd.
+
+        Return the merged results raw.
+
+        """
+        return self._store(self._merged([r[0] for r in shard_results],
+                                        count_only=count_only),
+                           count_only)
+
+    def _merged(self, results, count_only=False):
+        """Merge the results of my query from each shard of my index.
+
+        The shards' best matches are merged by my sort order, and then my
+        slice is applied.
+
+        """
+        plan = self._compile()
+        offset, limit = (self._limits(count_only=count_only) or
+                         (0, DEFAULT_LIMIT))
+        if plan.group_by is None:
+            return merge_results(results, plan.sort, offset, limit)
+        return merge_results(results, plan.group_by[1], offset, limit,
+                             grouped=True)
+
+    def _store(self, result, count_only=False):
+        """Cache a single query's freshly fetched result on me, and in the result cache if there is one.
+
+        Return it, or empty results if it had an error.
+
+        """
+        result = self._received(result)
+        cache = self._result_cache()
+        if cache is not None:
+            self._cache_result(cache, self._fingerprint(count_only), result)
+        result = _checked_result(result)
+        if count_only:
+            self._count_cache = result
+        else:
+            self._raw_cache = [result]
+        return result
+
+    def _execute(self, count_only=False):
+        """Return the results of my query, from the result cache if possible.
+
+        Otherwise, run the query, and cache its results if there's a result
+        cache. If another thread is already running the same query, wait
+        for its results and share them instead, unless
+        ``settings.SPHINX_SINGLE_FLIGHT`` is False.
+
+        """
+        cache = self._result_cache()
+        if cache is not None:
+            key = self._fingerprint(count_only=count_only)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        def fetch():
+            result = self._fetch(count_only=count_only)
+            if cache is not None:
+                self._cache_result(cache, key, result)
+            return result
+
+        if getattr(settings, 'SPHINX_SINGLE_FLIGHT', True):
+            # Results differ in form with compact_results, and waiting on a
+            # query with a longer timeout than mine would be no good:
+            result, shared = _in_flight.do(
+                    (self._fingerprint(count_only=count_only),
+                     getattr(self.meta, 'compact_results', False),
+                     self._deadlines()),
+                    fetch)
+            if shared:
+                count('coalesced', index=self.meta.index)
+        else:
+            result = fetch()
+        return _checked_result(result)
+
+    def _fetch(self, count_only=False):
+        """Run my query, and return its result, in the form I keep results in."""
+        shards = self._shards()
+        deadlines = self._deadlines()
+        if shards:
+            exchanges = self.shard_exchanges(count_only=count_only)
+            outcomes = _run_exchanges(
+                    [(shard, exchange, deadlines)
+                     for shard, exchange in zip(shards, exchanges)],
+                    index=self.meta.index)
+            _raise_errors(outcomes)
+            result = self._received(self._merged(
+                    [o[0] for o in outcomes], count_only=count_only))
+        elif deadlines is not None:
+            encoder = QueryEncoder()
+            self._add_query(encoder, count_only=count_only)
+            outcomes = _run_exchanges(
+                    [(_server(self), encoder.exchange(), deadlines)],
+                    index=self.meta.index)
+            _raise_errors(outcomes)
+            result = self._received(outcomes[0][0])
+        else:
+            with _client_for(_server(self)) as sphinx:
+                self._add_query(sphinx, count_only=count_only)
+                result = self._received(
+                        _run_queries(sphinx, self.meta.index)[0])
+        return result
+
+    def _received(self, result):
+        """Put a single query's freshly fetched result into the form I keep results in.
+
+        That's a ``CompactMatches`` in place of the list of matches, if the
+        ``SphinxMeta`` asks for ``compact_results``.
+
+        """
+        if (getattr(self.meta, 'compact_results', False) and
+            result['status'] != sphinxapi.SEARCHD_ERROR and
+            not isinstance(result['matches'], CompactMatches)):
+            result['matches'] = CompactMatches.from_matches(result['matches'])
+        return result
+
+    def _result_cache(self):
+        """Return the ``ResultCache`` to use, or None if not caching."""
+        if self._cache_bypass:
+            return None
+        return getattr(self.meta, 'result_cache', None)
+
+    def _cache_result(self, cache, key, result):
+        """Store a single query's result in a ``ResultCache``, unless it's an error."""
+        if result['status'] != sphinxapi.SEARCHD_ERROR:
+            cache.set(key, result, self._cache_ttl)
+
+    def _fingerprint(self, count_only=False):
+        """Return a string which identifies everything my query would send to Sphinx.
+
+        As a side effect, sets the same attributes ``_add_query()`` does.
+
+        """
+        if count_only not in self._fingerprints:
+            recorder = QueryRecorder(*(self._shards() or
+                                       (self.host, self.port)))
+            self._add_query(recorder, count_only=count_only)
+            self._fingerprints[count_only] = recorder.fingerprint()
+        return self._fingerprints[count_only]
 
     def _results(self, k=None):
         """Return an iterable of results in whatever format was picked.
 
-        The format is determined by earlier calls to values() or values_dict().
+        The format is determined by earlier calls to values(), values_dict(),
+        attrs(), or attrs_dict().
         The result supports len() as well.
 
         If ``k`` is passed in, then it will restrict the DB query to
         querying only the objects at index k or in the range of slice
         k.
 
+        Objects pulled out of the DB are kept, so later calls fetch only
+        the ones they haven't seen yet.
+
         :arg k: Index or slice to retrieve from the results.  Defaults
             to ``None`` which means you'll get the full results set.
 
         """
-        ids = self.object_ids()
-        if k is not None:
-            ids = ids[k]
-        return self._results_class(self.type, ids, self._fields)
+        matches = self._raw()['matches']
+        # Narrow down the matches first, so indexing each result in turn
+        # doesn't cost a pass over all of them apiece:
+        if isinstance(k, slice):
+            matches = matches[k]
+        elif k is not None:
+            matches = [matches[k]]
+        ids = self._ids(matches)
+        if isinstance(matches, CompactMatches):
+            weights = matches.weights
+        else:
+            weights = [m['weight'] for m in matches]
+
+        if issubclass(self._results_class, AttrResults):
+            return self._results_class(self.type, ids, self._fields, matches,
+                                       weights=weights)
+        return self._results_class(
+                self.type, ids, self._fields, objects=self._hydrated,
+                weights=weights,
+                chunk_size=getattr(self.meta, 'hydration_chunk_size', None),
+                cache=getattr(self.meta, 'hydration_cache', None))
 
     def _default_sort(self):
         """Return the ordering to use if the SphinxMeta doesn't specify one."""
@@ -598,29 +1234,15 @@ class S(object):
         """Return the raw matches from the first (and only) query.
 
         If anything goes wrong, raise SearchError. Cache the results. Calling
-        this after a SearchError will retry.
+        this after a SearchError will retry. If ``execute_parallel()``
+        recorded an error, though, the first call raises that instead.
 
         """
         if self._raw_cache is None:
-            sphinx = self._sphinx()
-            try:
-                self._raw_cache = results = sphinx.RunQueries()
-            except socket.timeout:
-                log.error('Query has timed out!')
-                raise SearchError('Query has timed out!')
-            except socket.error, msg:
-                log.error('Query socket error: %s', msg)
-                raise SearchError('Could not execute your search!')
-            except Exception, e:
-                log.error('Sphinx threw an unknown exception: %s', e)
-                raise SearchError('Sphinx threw an unknown exception!')
-
-            if not results:
-                raise SearchError('Sphinx returned no results.')
-            if results[0]['status'] == sphinxapi.SEARCHD_ERROR:
-                log.error('Sphinx errored while performing a query: %r',
-                          results[0]['error'])
-                return {'matches': []}
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            self._raw_cache = [self._execute()]
 
         # We do only one query at a time; return the first one:
         return self._raw_cache[0]
@@ -687,6 +1309,656 @@ else:
             return self
 
 
+def execute_batch(searches):
+    """Fetch the results of several ``S`` objects in as few round trips as possible.
+
+    The queries of all the ``S`` objects that talk to the same searchd are
+    sent together in a single ``RunQueries()`` call. Afterward, each ``S``
+    has its results cached, so iterating, slicing, or counting it doesn't
+    hit Sphinx again. ``S`` objects whose results are already cached are
+    left alone, and any whose results are in the result cache (see
+    ``ResultCache``) get them from there.
+
+    If a query in the batch has an error, its ``S`` gets empty results, just
+    as if it had been run alone. ``S`` objects with time limits (see
+    ``S.timeout()``) are batched only with others having the same ones, and
+    their batches keep to them and are hedged, as they would be alone.
+
+    :raises SearchError: if anything goes wrong talking to Sphinx. In that
+        case, no ``S`` talking to the failing server gets results cached.
+
+    """
+    # {((host, port) or ReplicaSet, Timeouts or None): [S, ...]}
+    batches = {}
+    keys = []  # Batch order, for determinism
+    for s in _uncached(searches):
+        if s._shards():
+            # It has to go to several servers anyway.
+            s._raw()
+            continue
+        key = _server(s), s._deadlines()
+        if key not in batches:
+            batches[key] = []
+            keys.append(key)
+        batches[key].append(s)
+
+    for server, deadlines in keys:
+        batch = batches[server, deadlines]
+        index = ','.join(sorted(set(s.meta.index for s in batch)))
+        if deadlines is None:
+            with _client_for(server) as sphinx:
+                _add_queries(sphinx, batch)
+                results = _run_queries(sphinx, index)
+        else:
+            encoder = QueryEncoder()
+            _add_queries(encoder, batch)
+            outcomes = _run_exchanges(
+                    [(server, encoder.exchange(), deadlines)], index=index)
+            _raise_errors(outcomes)
+            results = outcomes[0]
+        if len(results) != len(batch):
+            raise SearchError('Sphinx returned %s results for %s queries.' %
+                              (len(results), len(batch)))
+        for s, result in zip(batch, results):
+            result = s._received(result)
+            cache = s._result_cache()
+            if cache is not None:
+                s._cache_result(cache, s._fingerprint(), result)
+            s._raw_cache = [_checked_result(result)]
+
+
+def _add_queries(sphinx, searches):
+    """Add the queries of several ``S`` objects to a SphinxClient or ``QueryEncoder``."""
+    for i, s in enumerate(searches):
+        if i:
+            _reset_client(sphinx)
+        s._add_query(sphinx)
+
+
+def execute_concurrently(searches, timeout=None):
+    """Fetch the results of several ``S`` objects at once, in this thread.
+
+    Each query gets its own connection to searchd, and they all proceed
+    concurrently over non-blocking sockets, without a thread apiece. As with
+    ``execute_batch()``, each ``S`` ends up with its results cached, and those
+    already cached or in the result cache are left alone.
+
+    :arg timeout: Seconds after which to give up on queries that haven't
+        finished
+
+    :raises SearchError: if anything goes wrong with any of the queries. The
+        rest still get their results.
+
+    """
+    pending = _uncached(searches)
+    if not pending:
+        return
+    jobs = []
+    sharded = []  # [(S, index of its first job), ...]
+    for s in pending:
+        shards = s._shards()
+        deadlines = s._deadlines()
+        if shards:
+            sharded.append((s, len(jobs)))
+            jobs.extend((shard, exchange, deadlines) for shard, exchange
+                        in zip(shards, s.shard_exchanges()))
+        else:
+            jobs.append((_server(s), s.search_exchange(), deadlines))
+    outcomes = _run_exchanges(
+            jobs, timeout,
+            index=','.join(sorted(set(s.meta.index for s in pending))))
+    for s, first in sharded:
+        results = outcomes[first:first + len(s._shards())]
+        if not any(isinstance(r, Exception) for r in results):
+            s.gather(results)
+    _raise_errors(outcomes)
+
+
+def _run_exchanges(jobs, timeout=None, event='query', **info):
+    """Carry out many ``Exchange`` objects at once, and return their outcomes.
+
+    :arg jobs: (server, exchange, ``protocol.Timeouts`` or None) tuples,
+        where each server is what ``_server()`` returns. Replicas are picked
+        from ``ReplicaSet`` objects, and told whether their exchanges
+        failed. Slow exchanges with a ``hedge_after`` are hedged onto
+        another replica.
+    :arg event: What to time the exchanges as. For ``query``, the matches
+        and bytes received are added to the ``info``.
+    :arg info: What to time them with, which must include the ``index`` or
+        indices queried
+
+    Return what ``protocol.run()`` does.
+
+    """
+    held = {}  # {(job index, (host, port)): the server it was picked for}
+    hedges = set()  # (job index, (host, port)) of hedges
+    outcomes = [None] * len(jobs)
+    started = []  # (host, port, exchange, Timeouts) for jobs that can be sent
+    indices = []  # The index in jobs of each of those
+    for i, (server, exchange, deadlines) in enumerate(jobs):
+        replica = _acquire(server)
+        if replica is None:
+            outcomes[i] = _unavailable(server)
+            continue
+        held[i, replica] = server
+        indices.append(i)
+        started.append(replica + (exchange, deadlines or NO_TIMEOUTS))
+
+    def hedge(k):
+        i = indices[k]
+        server, exchange, _ = jobs[i]
+        if not isinstance(server, ReplicaSet):
+            return None
+        replica = _acquire(server, exclude=[r for j, r in held if j == i])
+        if replica is None:
+            return None
+        held[i, replica] = server
+        hedges.add((i, replica))
+        count('hedge', index=info['index'])
+        return replica + (exchange.copy(),)
+
+    def report(k, host, port, outcome):
+        i = indices[k]
+        server = held.pop((i, (host, port)), None)
+        if server is not None:
+            _release(server, (host, port), outcome)
+        if ((i, (host, port)) in hedges and outcome is not None and
+            not isinstance(outcome, Exception)):
+            count('hedge_won', index=info['index'])
+
+    try:
+        with timed(event, **info) as timer:
+            for k, outcome in enumerate(
+                    run(started, timeout, hedge=hedge, report=report)):
+                outcomes[indices[k]] = outcome
+            if event == 'query':
+                timer.update(
+                    matches=sum(_match_count(o) for o in outcomes),
+                    bytes=sum(exchange.bytes_received for _, exchange, _
+                              in jobs))
+    finally:
+        # Anything left over was abandoned by an exception in run().
+        for (i, replica), server in held.items():
+            _release(server, replica, None)
+    return outcomes
+
+
+def _match_count(outcome):
+    """Return the number of matches in what an exchange's ``finish()`` returned."""
+    if isinstance(outcome, Exception):
+        return 0
+    if isinstance(outcome, list):  # Raw results of a batch of queries
+        return sum(len(r.get('matches') or []) for r in outcome)
+    return len(outcome['matches'])
+
+
+def _raise_errors(outcomes):
+    """Raise a ``SearchError`` if any of ``protocol.run()``'s outcomes is an exception, logging them all."""
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    if errors:
+        for e in errors[1:]:
+            _search_error(e)
+        raise _search_error(errors[0])
+
+
+def execute_parallel(searches, max_workers=None, timeout=None):
+    """Fetch the results of several ``S`` objects at once, each on a thread of a shared pool.
+
+    This suits searches that can't share a ``RunQueries()`` call, like ones
+    of different indexes on different hosts, while still using sphinxapi
+    and the connection pool. As with ``execute_batch()``, each ``S`` ends up
+    with its results cached, and those already cached or in the result cache
+    are left alone.
+
+    Nothing is raised. Instead, an ``S`` whose search fails, or doesn't
+    finish in time, records its ``SearchError``, which iterating over it (or
+    anything else that needs its results) raises. After that, it retries
+    the search.
+
+    :arg max_workers: The size of the process-wide pool of threads to use.
+        Defaults to ``settings.SPHINX_PARALLEL_WORKERS``, or 8. Calls asking
+        for the same size share a pool.
+    :arg timeout: Seconds after which to stop waiting for all the searches
+        to finish
+
+    """
+    pending = _uncached(searches)
+    if not pending:
+        return
+    pool = thread_pool(max_workers or
+                       getattr(settings, 'SPHINX_PARALLEL_WORKERS', 8))
+    tasks = [pool.submit(s._raw) for s in pending]
+    deadline = None if timeout is None else time() + timeout
+    for s, task in zip(pending, tasks):
+        if not task.wait(None if deadline is None else
+                         max(deadline - time(), 0)):
+            s._error = _search_error(socket.timeout())
+        elif task.exception is not None:
+            s._error = task.exception
+
+
+_thread_pools = {}  # {size: ThreadPool}
+_thread_pools_lock = threading.Lock()
+
+
+def thread_pool(size):
+    """Return the process-wide ``ThreadPool`` with ``size`` threads."""
+    with _thread_pools_lock:
+        if size not in _thread_pools:
+            _thread_pools[size] = ThreadPool(size)
+        return _thread_pools[size]
+
+
+def _uncached(searches):
+    """Return those of some ``S`` objects which have to query Sphinx to get results.
+
+    Along the way, fill in the results of any which are in the result cache.
+
+    """
+    uncached = []
+    for s in searches:
+        if s._raw_cache is None:
+            cache = s._result_cache()
+            if cache is not None:
+                result = cache.get(s._fingerprint())
+                if result is not None:
+                    s._raw_cache = [result]
+                    continue
+            uncached.append(s)
+    return uncached
+
+
+# Typecodes of arrays whose items can go straight into a filter:
+_INT_TYPECODES = frozenset('bBhHiIlLqQ')
+
+# Converted filter values, by converter, so long ``__in`` lists aren't
+# converted afresh for every query: {converter: {(type, value): int}}
+_conversions = {}
+
+
+def _convert_all(converter, values):
+    """Return a list of ``converter(v)`` for each of ``values``.
+
+    Unless the converter is ``int``, which is faster than a lookup, remember
+    the results, up to ``settings.SPHINX_FILTER_CACHE_SIZE`` (default:
+    10000) of them per converter. Converters are assumed to give the same
+    output for the same input every time.
+
+    """
+    size = getattr(settings, 'SPHINX_FILTER_CACHE_SIZE', 10000)
+    if converter is int or not size:
+        return map(converter, values)
+    memo = _conversions.setdefault(converter, {})
+    converted = []
+    for value in values:
+        # Keyed by type as well, so 1, 1.0, and True don't collide:
+        key = type(value), value
+        try:
+            result = memo[key]
+        except KeyError:
+            result = converter(value)
+            if len(memo) >= size:
+                # Cheaper than LRU bookkeeping on every lookup:
+                memo.clear()
+            memo[key] = result
+        except TypeError:  # unhashable
+            result = converter(value)
+        converted.append(result)
+    return converted
+
+
+# Queries being run right now, so identical ones can wait and share results:
+_in_flight = SingleFlight()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connection_pool():
+    """Return the process-wide ``ConnectionPool``, or None if pooling is off.
+
+    Pooling is on if ``settings.SPHINX_POOL_SIZE``, the most idle connections
+    to keep per searchd, is nonzero. ``settings.SPHINX_POOL_MAX_IDLE`` is the
+    number of seconds a connection can sit idle before it's closed.
+
+    """
+    global _pool
+    if _pool is None:
+        size = getattr(settings, 'SPHINX_POOL_SIZE', 0)
+        if not size:
+            return None
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    max_size=size,
+                    max_idle=getattr(settings, 'SPHINX_POOL_MAX_IDLE', 60))
+    return _pool
+
+
+_replica_sets = {}  # {((host, port), ...): ReplicaSet}
+_replica_sets_lock = threading.Lock()
+
+
+def replica_set(servers):
+    """Return the process-wide ``ReplicaSet`` for a list of (host, port) pairs.
+
+    Everything that names the same servers shares one, and so shares its
+    idea of their health. It balances according to
+    ``settings.SPHINX_BALANCING`` (``round_robin``, the default, or
+    ``least_outstanding``), and takes failing servers out of rotation for
+    ``settings.SPHINX_REPLICA_COOLDOWN`` seconds (default: 10).
+
+    """
+    key = tuple(tuple(s) for s in servers)
+    with _replica_sets_lock:
+        if key not in _replica_sets:
+            _replica_sets[key] = ReplicaSet(
+                    key,
+                    strategy=getattr(settings, 'SPHINX_BALANCING',
+                                     'round_robin'),
+                    cooldown=getattr(settings, 'SPHINX_REPLICA_COOLDOWN', 10))
+        return _replica_sets[key]
+
+
+def _server(s):
+    """Return where an ``S`` sends its queries: a ``ReplicaSet`` or a (host, port) pair."""
+    return s._replicas() or (s.host, s.port)
+
+
+def _excerpt_server(s):
+    """Return where an ``S`` sends its excerpt requests.
+
+    That's what ``_server()`` says, unless the index is sharded. Building
+    excerpts needs only the index's settings, which every shard has, so then
+    it's an ``_AnyShard``.
+
+    """
+    shards = s._shards()
+    return _AnyShard(shards) if shards else _server(s)
+
+
+class _AnyShard(object):
+    """Shards of an index, any one of which can take a request"""
+    _turns = counter()  # So requests take turns among shards
+
+    def __init__(self, shards):
+        """
+        :arg shards: A list of (host, port) pairs or ``ReplicaSet`` objects
+
+        """
+        self.shards = list(shards)
+
+    def rotated(self):
+        """Return my shards, starting with the one whose turn it is."""
+        turn = next(self._turns) % len(self.shards)
+        return self.shards[turn:] + self.shards[:turn]
+
+    def owner(self, replica):
+        """Return the shard the (host, port) ``replica`` belongs to."""
+        for shard in self.shards:
+            if (replica in shard.servers if isinstance(shard, ReplicaSet)
+                else tuple(shard) == replica):
+                return shard
+
+    def __repr__(self):
+        return '<_AnyShard %r>' % self.shards
+
+
+@contextmanager
+def _client_for(server, unavailable=SearchError):
+    """Lend out a SphinxClient pointed at what ``_server()`` returns.
+
+    For a ``ReplicaSet``, that's whichever replica it picks. If the block
+    raises a ``SearchSocketError`` or ``ExcerptSocketError``, the searchd is
+    reported as failing; otherwise, even if it answered with an error, as
+    fine.
+
+    :arg unavailable: The exception to raise if no searchd can be tried
+        because of open circuit breakers
+
+    """
+    replica = _acquire(server)
+    if replica is None:
+        raise unavailable(str(_unavailable(server)))
+    outcome = None
+    try:
+        with _client(*replica) as sphinx:
+            yield sphinx
+    except (SearchError, ExcerptError), e:
+        outcome = e
+        raise
+    else:
+        outcome = True
+    finally:
+        _release(server, replica, outcome)
+
+
+def _acquire(server, exclude=()):
+    """Pick a searchd to send a request to, and return its (host, port).
+
+    ``server`` is what ``_server()`` or ``_excerpt_server()`` returns. For
+    an ``_AnyShard``, shards take turns being tried first. Searchds whose
+    circuit
+    breakers are open, or which are in ``exclude``, are skipped; if that
+    leaves none, return None. Pass what's returned to ``_release()`` once
+    the request is done.
+
+    """
+    if isinstance(server, _AnyShard):
+        for shard in server.rotated():
+            replica = _acquire(shard, exclude=exclude)
+            if replica is not None:
+                return replica
+        return None
+
+    if not isinstance(server, ReplicaSet):
+        server = tuple(server)
+        breaker = circuit_breaker(*server)
+        if server in exclude or not (breaker is None or breaker.allow()):
+            return None
+        return server
+
+    exclude = list(exclude)
+    while True:
+        replica = server.acquire(exclude=exclude)
+        if replica is None:
+            return None
+        breaker = circuit_breaker(*replica)
+        if breaker is None or breaker.allow():
+            return replica
+        server.release(replica, failed=None)
+        exclude.append(replica)
+
+
+def _release(server, replica, outcome):
+    """Report how a request to a searchd from ``_acquire()`` went.
+
+    :arg outcome: An exception if it failed, None if it was abandoned, or
+        anything else if it succeeded
+
+    """
+    if isinstance(server, _AnyShard):
+        server = server.owner(replica)
+    # Even an error reply means searchd is there to answer:
+    failed = None if outcome is None else _unreachable(outcome)
+    breaker = circuit_breaker(*replica)
+    if breaker is not None and failed is not None:
+        if failed:
+            breaker.failed()
+        else:
+            breaker.succeeded()
+    if isinstance(server, ReplicaSet):
+        server.release(replica, failed=failed)
+
+
+def _unreachable(outcome):
+    """Return whether an outcome reported to ``_release()`` means its searchd couldn't be talked to.
+
+    Timeouts, socket errors, and responses cut short count. Error replies
+    don't: they come from a searchd that's up.
+
+    """
+    return isinstance(outcome, (socket.error, IncompleteResponse,
+                                SearchSocketError, ExcerptSocketError,
+                                ExcerptTimeoutError))
+
+
+def _unavailable(server):
+    """Return a ``CircuitOpen`` explaining that no searchd could be tried."""
+    if isinstance(server, ReplicaSet):
+        return CircuitOpen('No replica in %r is up, as far as their circuit '
+                           'breakers know.' % server)
+    if isinstance(server, _AnyShard):
+        return CircuitOpen('No shard in %r is up, as far as their circuit '
+                           'breakers know.' % server.shards)
+    return CircuitOpen('searchd at %s:%s seems to be down. Not trying it for '
+                       'now.' % server)
+
+
+_breakers = {}  # {(host, port): CircuitBreaker}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(host, port):
+    """Return the process-wide ``CircuitBreaker`` for a searchd, or None if circuit breaking is off.
+
+    It's on if ``settings.SPHINX_BREAKER_THRESHOLD``, the number of
+    consecutive failures after which to stop trying a searchd, is nonzero.
+    ``settings.SPHINX_BREAKER_COOLDOWN`` (default: 30) is the number of
+    seconds to wait before letting a probe through.
+
+    """
+    threshold = getattr(settings, 'SPHINX_BREAKER_THRESHOLD', 0)
+    if not threshold:
+        return None
+    breaker = _breakers.get((host, port))
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get((host, port))
+            if breaker is None:
+                breaker = _breakers[host, port] = CircuitBreaker(
+                        (host, port),
+                        threshold=threshold,
+                        cooldown=getattr(settings, 'SPHINX_BREAKER_COOLDOWN',
+                                         30))
+    return breaker
+
+
+def circuit_states():
+    """Return a dict of (host, port) -> circuit breaker state for each searchd tried so far.
+
+    The states are ``'closed'``, ``'open'``, and ``'half-open'``.
+
+    """
+    with _breakers_lock:
+        return dict((server, breaker.state)
+                    for server, breaker in _breakers.iteritems())
+
+
+@contextmanager
+def _client(host, port):
+    """Lend out a SphinxClient pointed at the given searchd.
+
+    If pooling is on, the client comes from the pool and goes back to it
+    afterward--unless the block raises an exception, in which case the client
+    is assumed to be in a bad way and is thrown away.
+
+    """
+    pool = connection_pool()
+    if pool is None:
+        sphinx = sphinxapi.SphinxClient()
+        sphinx.SetServer(host, port)
+        yield sphinx
+    else:
+        sphinx = pool.get(host, port)
+        try:
+            yield sphinx
+        except:
+            pool.discard(sphinx)
+            raise
+        _reset_client(sphinx)
+        pool.put(sphinx, host, port)
+
+
+def _reset_client(sphinx):
+    """Undo the per-query settings ``S._add_query()`` makes on a SphinxClient.
+
+    The match, ranking, and sort modes are always set by ``_add_query()``,
+    so we needn't bother with them.
+
+    """
+    sphinx.ResetFilters()
+    sphinx.ResetGroupBy()
+    sphinx.SetFieldWeights({})
+    sphinx.SetLimits(0, DEFAULT_LIMIT)
+    if hasattr(sphinx, 'SetSelect'):
+        sphinx.SetSelect('*')
+
+
+def _run_queries(sphinx, index):
+    """Run the queries batched up in a SphinxClient, and return their results.
+
+    :arg index: The index or indices queried, for instrumentation
+
+    :raises SearchError: if anything goes wrong talking to Sphinx
+
+    """
+    with timed('query', index=index) as timer:
+        try:
+            results = sphinx.RunQueries()
+        except Exception, e:
+            raise _search_error(e)
+        timer.update(matches=sum(len(r.get('matches') or [])
+                                 for r in results or []))
+
+    if not results:
+        error = sphinx.GetLastError()
+        if _is_connection_error(error):
+            log.error('Query socket error: %s', error)
+            raise SearchSocketError('Could not execute your search!')
+        raise SearchError('Sphinx returned no results.')
+    return results
+
+
+# How the errors sphinxapi reports by way of GetLastError() begin when it
+# couldn't talk to searchd, rather than searchd answering with an error:
+_CONNECTION_ERRORS = ('connection', 'failed to read', 'failed to send',
+                      'send() failed', 'received zero-sized', 'incomplete')
+
+
+def _is_connection_error(error):
+    """Return whether a sphinxapi error message is about not getting through to searchd."""
+    return isinstance(error, basestring) and error.startswith(_CONNECTION_ERRORS)
+
+
+def _search_error(e):
+    """Log an exception raised while talking to Sphinx, and return a ``SearchError`` to raise in its stead."""
+    if isinstance(e, CircuitOpen):
+        return SearchError(str(e))  # The breaker logged when it opened.
+    if isinstance(e, socket.timeout):
+        log.error('Query has timed out!')
+        return SearchSocketError('Query has timed out!')
+    if isinstance(e, socket.error):
+        log.error('Query socket error: %s', e)
+        return SearchSocketError('Could not execute your search!')
+    if isinstance(e, (StructError, IncompleteResponse)):
+        # sphinxapi chokes on a response cut short with a StructError.
+        log.error('Query got an incomplete response: %s', e)
+        return SearchSocketError('Could not execute your search!')
+    log.error('Sphinx threw an unknown exception: %s', e)
+    return SearchError('Sphinx threw an unknown exception!')
+
+
+def _checked_result(result):
+    """Return a single query's result, or empty results if it had an error."""
+    if result['status'] == sphinxapi.SEARCHD_ERROR:
+        log.error('Sphinx errored while performing a query: %r',
+                  result['error'])
+        return {'matches': []}
+    return result
+
+
 def _check_weights(weights):
     """Verifies weight values are in the appropriate range.
 
@@ -0,0 +1,113 @@
+"""Spreading queries among replicas of the same searchd"""
+
+import threading
+from time import time
+
+
+STRATEGIES = ('round_robin', 'least_outstanding')
+
+
+class ReplicaSet(object):
+    """Several searchd servers holding the same indexes, with queries spread among them
+
+    Each query should ``acquire()`` a server and, once it's done with it,
+    ``release()`` it, saying whether talking to it failed. That's all the
+    health checking there is: a server which fails ``max_failures`` times in
+    a row is taken out of rotation for ``cooldown`` seconds. After that, it
+    gets queries again, but a single further failure takes it back out. If
+    every server is out, queries go to the one due back soonest rather than
+    failing outright.
+
+    It's thread-safe, so one instance can be shared by a whole process.
+
+    """
+    def __init__(self, servers, strategy='round_robin', max_failures=1,
+                 cooldown=10):
+        """
+        :arg servers: A list of (host, port) pairs
+        :arg strategy: ``round_robin`` to take turns, or ``least_outstanding``
+            to pick the server with the fewest queries in flight, taking turns
+            among those tied
+        :arg max_failures: Consecutive failures after which a server is taken
+            out of rotation
+        :arg cooldown: Seconds a failing server stays out of rotation
+
+        """
+        if not servers:
+            raise ValueError('A ReplicaSet needs at least one server.')
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown balancing strategy %r. Choose from %s.' %
+                             (strategy, ', '.join(STRATEGIES)))
+        self.servers = [tuple(s) for s in servers]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._outstanding = dict((s, 0) for s in self.servers)
+        self._failures = dict((s, 0) for s in self.servers)
+        self._down_until = {}  # {server: time it comes back into rotation}
+
+    def acquire(self, exclude=()):
+        """Pick a server for a query, and return its (host, port).
+
+        :arg exclude: Servers not to pick, like one the query is already
+            running on. If that rules out every server in rotation, return
+            None. Picks made with ``exclude`` don't count as taking a turn,
+            so hedges don't skew which server gets the next query first.
+
+        """
+        now = time()
+        with self._lock:
+            up = [s for s in self.servers
+                  if self._down_until.get(s, 0) <= now and s not in exclude]
+            if not up:
+                if exclude:
+                    return None
+                up = [min(self.servers, key=self._down_until.get)]
+            turn = self._turn % len(up)
+            if not exclude:
+                self._turn += 1
+            candidates = up[turn:] + up[:turn]
+            if self.strategy == 'least_outstanding':
+                # min() keeps the first of any ties, so ties take turns.
+                server = min(candidates, key=self._outstanding.get)
+            else:
+                server = candidates[0]
+            self._outstanding[server] += 1
+        return server
+
+    def release(self, server, failed=False):
+        """Report that a query is done with a server from ``acquire()``.
+
+        :arg failed: Whether the query failed to get an answer out of it, or
+            None if it was abandoned before it could tell, which leaves the
+            server's health as it was
+
+        """
+        with self._lock:
+            self._outstanding[server] -= 1
+            if failed is None:
+                return
+            if failed:
+                self._failures[server] += 1
+                if self._failures[server] >= self.max_failures:
+                    self._down_until[server] = time() + self.cooldown
+            else:
+                self._failures[server] = 0
+                self._down_until.pop(server, None)
+
+    def healthy(self):
+        """Return the servers currently in rotation."""
+        now = time()
+        with self._lock:
+            return [s for s in self.servers
+                    if self._down_until.get(s, 0) <= now]
+
+    def outstanding(self):
+        """Return a dict of (host, port) -> number of queries in flight."""
+        with self._lock:
+            return dict(self._outstanding)
+
+    def __repr__(self):
+        return '<ReplicaSet %s %r>' % (self.strategy, self.servers)
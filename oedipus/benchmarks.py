@@ -0,0 +1,138 @@
+"""Benchmarks of whole S pipelines against a local fake searchd
+
+Run them like this, with sphinxapi importable::
+
+    python -m oedipus.benchmarks --iterations 500
+
+Each scenario runs a typical S chain end to end: encoding, the real wire
+protocol over a local socket to ``oedipus.testing.FakeSearchd``, decoding,
+and hydration from an in-memory stand-in for a Django manager. Throughput
+and p50/p99 latencies are printed per scenario. The fake searchd's own work
+is included in the timings, so compare numbers only between runs on the
+same machine.
+
+"""
+from optparse import OptionParser
+import random
+from time import time
+
+from oedipus import S
+from oedipus.testing import FakeSearchd
+
+
+WORDS = ('crunchy chewy sesame ginger oat chocolate butter shortbread '
+         'almond lemon digestive wafer cream fig raisin honey').split()
+
+
+class QuerySet(list):
+    """Enough of Django's QuerySet for results to hydrate from"""
+    def values(self, *fields):
+        return [dict((k, v) for k, v in o.__dict__.iteritems()
+                     if not fields or k in fields)
+                for o in self]
+
+
+class Manager(object):
+    """An in-memory stand-in for a Django model manager"""
+    def __init__(self):
+        self.rows = {}
+
+    def filter(self, id__in=None):
+        return QuerySet(self.rows[id] for id in id__in if id in self.rows)
+
+
+class Biscuit(object):
+    objects = Manager()
+
+    class SphinxMeta(object):
+        index = 'biscuit'
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.objects.rows[self.id] = self
+
+
+def corpus(size, seed=0):
+    """Make ``size`` biscuits, returning the documents to index them with."""
+    rand = random.Random(seed)
+    Biscuit.objects.rows.clear()
+    docs = []
+    for id in xrange(1, size + 1):
+        name = ' '.join(rand.choice(WORDS) for i in xrange(3))
+        description = ' '.join(rand.choice(WORDS) for i in xrange(30))
+        color = rand.randrange(10)
+        Biscuit(id=id, name=name, description=description, color=color)
+        docs.append({'id': id, 'name': name, 'description': description,
+                     'color': color, 'price': rand.randrange(100, 1000)})
+    return docs
+
+
+def scenarios(port):
+    """Return (name, callable) pairs, each callable running one search."""
+    def s():
+        return S(Biscuit, host='127.0.0.1', port=port)
+
+    def plain():
+        list(s().query('sesame')[:20])
+
+    def filtered():
+        list(s().query('sesame').filter(color__in=[1, 2, 3])
+                .exclude(price__gte=100, price__lte=200)[:20])
+
+    def group_by():
+        list(s().query('chocolate').group_by('color', '-@group')[:10])
+
+    def excerpts():
+        search = (s().query('ginger').values_dict('name', 'description')
+                     .highlight('name', 'description')[:20])
+        list(search.with_excerpts())
+
+    def hydration():
+        list(s()[:1000])
+
+    return [('plain search', plain),
+            ('filtered search', filtered),
+            ('group_by', group_by),
+            ('excerpts', excerpts),
+            ('hydrate 1000 results', hydration)]
+
+
+def percentile(sorted_timings, fraction):
+    return sorted_timings[int(round(fraction * (len(sorted_timings) - 1)))]
+
+
+def measure(search, iterations, warmup=5):
+    """Run ``search`` repeatedly, and return a sorted list of per-run seconds."""
+    for i in xrange(warmup):
+        search()
+    timings = []
+    for i in xrange(iterations):
+        start = time()
+        search()
+        timings.append(time() - start)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=200,
+                      help='runs of each scenario [default: %default]')
+    parser.add_option('-d', '--documents', type='int', default=5000,
+                      help='documents in the index [default: %default]')
+    options, args = parser.parse_args()
+
+    with FakeSearchd({'biscuit': corpus(options.documents)}) as searchd:
+        print '%-22s %10s %10s %10s' % ('scenario', 'ops/sec',
+                                         'p50 ms', 'p99 ms')
+        for name, search in scenarios(searchd.port):
+            timings = measure(search, options.iterations)
+            print '%-22s %10.1f %10.2f %10.2f' % (
+                name,
+                len(timings) / sum(timings),
+                percentile(timings, 0.5) * 1000,
+                percentile(timings, 0.99) * 1000)
+
+
+if __name__ == '__main__':
+    main()
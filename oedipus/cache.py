@@ -0,0 +1,306 @@
+"""Caching and sharing of raw Sphinx results and the DB objects behind them across ``S`` objects"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import os
+import threading
+from time import time
+
+
+class ResultCache(object):
+    """A cache of raw Sphinx results, keyed by compiled-query fingerprint
+
+    To turn it on for a model, put one on its ``SphinxMeta`` as
+    ``result_cache``. The results are stored in a pluggable backend, like
+    ``LRUBackend`` or ``DjangoCacheBackend``. Keeps count of hits and misses.
+
+    Cached results are shared among ``S`` objects, so treat them as
+    read-only.
+
+    """
+    def __init__(self, backend, ttl=60):
+        """
+        :arg backend: Where to keep the results: anything with ``get(key)``
+            and ``set(key, value, ttl)`` methods
+        :arg ttl: Default number of seconds to keep results. ``S.cache()``
+            can override this.
+
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the results cached under ``key``, or None."""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Cache ``value`` under ``key`` for ``ttl`` seconds (default: my ``ttl``)."""
+        self.backend.set(key, value, self.ttl if ttl is None else ttl)
+
+    def stats(self):
+        """Return a dict of hit and miss counts."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class SingleFlight(object):
+    """A way for threads doing the same work at the same time to do it just once
+
+    The first thread to ask for the result for a key computes it; any that
+    ask for the same key meanwhile wait for it and get the same result (or
+    exception). Nothing is kept once the work is done, so it's not a cache.
+    Shared results should be treated as read-only.
+
+    In a forked child process, work in flight in the parent at fork time is
+    forgotten, since the threads doing it don't exist there.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # {key: _Flight}
+        self._pid = os.getpid()
+        self.led = 0
+        self.joined = 0
+
+    def do(self, key, function):
+        """Return ``function()``, or what a concurrent call for the same ``key`` returns.
+
+        Return a pair: the result and whether it was shared from another
+        thread's call.
+
+        """
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._flights = {}
+            self._pid = os.getpid()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.led += 1
+                leader = True
+            else:
+                self.joined += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result, True
+
+        try:
+            flight.result = function()
+        except Exception, e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        """Return a dict of the number of calls that did the work and that shared another's."""
+        with self._lock:
+            return {'led': self.led, 'joined': self.joined}
+
+
+class _Flight(object):
+    """The work for one key of a ``SingleFlight``, and its outcome"""
+    __slots__ = ('done', 'result', 'exception')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class HydrationCache(object):
+    """A cache of the DB objects behind search results, keyed by model and ID
+
+    To turn it on for a model, put one on its ``SphinxMeta`` as
+    ``hydration_cache``. Then results are pulled out of the DB only for IDs
+    that aren't cached. It takes the same backends as ``ResultCache``.
+
+    Model objects are cached for object-style results, and dicts of all of a
+    model's fields for dict- and tuple-style ones, so either kind serves any
+    selection of fields. When an object changes, ``invalidate()`` it, as
+    from a ``post_save`` signal handler.
+
+    Cached objects are shared among searches, so treat them as read-only.
+
+    """
+    #: The forms objects are cached in, which are invalidated together
+    kinds = ('object', 'dict')
+
+    def __init__(self, backend, ttl=300):
+        """
+        :arg backend: Where to keep the objects: anything with
+            ``get_many(keys)``, ``set_many(mapping, ttl)``, and
+            ``delete_many(keys)`` methods
+        :arg ttl: Number of seconds to keep objects
+
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, model, kind, ids):
+        """Return a dict of the cached objects of the given kind and IDs, keyed by ID."""
+        keys = dict((self._key(model, kind, id), id) for id in ids)
+        found = self.backend.get_many(keys.keys())
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return dict((keys[key], value) for key, value in found.iteritems())
+
+    def set_many(self, model, kind, objects):
+        """Cache a dict of objects of the given kind, keyed by ID."""
+        if objects:
+            self.backend.set_many(
+                dict((self._key(model, kind, id), value)
+                     for id, value in objects.iteritems()),
+                self.ttl)
+
+    def invalidate(self, model, *ids):
+        """Forget the cached objects with the given IDs, in every form."""
+        self.backend.delete_many([self._key(model, kind, id)
+                                  for id in ids for kind in self.kinds])
+
+    def stats(self):
+        """Return a dict of hit and miss counts, counting each ID looked up."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    @staticmethod
+    def _key(model, kind, id):
+        return 'oedipus-hydrated:%s.%s:%s:%s' % (model.__module__,
+                                                 model.__name__, kind, id)
+
+
+class LRUBackend(object):
+    """An in-process, thread-safe cache which forgets the least recently used entries"""
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {key: (expiration time, value)}
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time():
+                return None
+            self._entries[key] = expires, value  # Move to the recent end.
+            return value
+
+    def get_many(self, keys):
+        """Return a dict of the unexpired values among those with the given keys."""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time() + ttl, value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_many(self, mapping, ttl):
+        for key, value in mapping.iteritems():
+            self.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend(object):
+    """An adapter which stores results or objects in one of Django's caches"""
+    def __init__(self, cache=None):
+        """
+        :arg cache: A Django cache object. Defaults to the default cache.
+
+        """
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping, ttl):
+        self.cache.set_many(mapping, ttl)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+
+class QueryRecorder(object):
+    """A stand-in for a SphinxClient which just records what's done to it
+
+    Compiling a query onto one of these yields a ``fingerprint()`` which
+    changes whenever anything that would be sent to Sphinx does.
+
+    """
+    def __init__(self, *prefix):
+        """
+        :arg prefix: Anything else the fingerprint should depend on, like the
+            server address
+
+        """
+        self.calls = [prefix]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def record(*args):
+            self.calls.append((name, _normalized(args)))
+        return record
+
+    def fingerprint(self):
+        """Return a string summarizing the calls recorded so far."""
+        return 'oedipus:' + sha1(repr(self.calls)).hexdigest()
+
+
+def _normalized(value):
+    """Return a version of ``value`` whose repr() doesn't depend on dict ordering or string type."""
+    if isinstance(value, dict):
+        return tuple(sorted((_normalized(k), _normalized(v))
+                            for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalized(v) for v in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,97 @@
+"""Failing fast when a searchd is down"""
+
+import logging
+import threading
+from time import time
+
+
+log = logging.getLogger('oedipus')
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """A request wasn't sent, because the circuit breaker of its searchd is open"""
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for one searchd
+
+    It starts out closed, letting every request through. After
+    ``threshold`` consecutive failures, it opens, and requests should fail
+    at once instead of waiting on a searchd that's likely down. After
+    ``cooldown`` seconds, it goes half-open and lets a single probe through.
+    If that succeeds, the breaker closes; if it fails, it opens again for
+    another cooldown. Every change of state is logged.
+
+    Ask ``allow()`` before each request, and then report how it went with
+    ``succeeded()`` or ``failed()``. It's thread-safe.
+
+    """
+    def __init__(self, server, threshold=5, cooldown=30):
+        """
+        :arg server: The (host, port) of the searchd, for logging
+        :arg threshold: Consecutive failures after which to open
+        :arg cooldown: Seconds to stay open before letting a probe through
+
+        """
+        self.server = server
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._failures = 0
+        self._retry_at = None  # When to let the next probe through
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a request may be sent.
+
+        When it's time for a probe, this lets one through and moves to the
+        half-open state. If the probe's outcome is never reported, another is
+        let through after a further cooldown.
+
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time()
+            if now < self._retry_at:
+                return False
+            self._retry_at = now + self.cooldown
+            self._change(HALF_OPEN)
+            return True
+
+    def succeeded(self):
+        """Report that a request got an answer."""
+        with self._lock:
+            self._failures = 0
+            self._change(CLOSED)
+
+    def failed(self):
+        """Report that a request failed to get an answer."""
+        with self._lock:
+            self._failures += 1
+            if (self.state == HALF_OPEN or
+                (self.state == CLOSED and
+                 self._failures >= self.threshold)):
+                self._retry_at = time() + self.cooldown
+                self._change(OPEN)
+
+    def _change(self, state):
+        if state == self.state:
+            return
+        if state == OPEN:
+            log.warning('Circuit to searchd at %s:%s opened after %s '
+                        'failures. Retrying in %s seconds.',
+                        self.server[0], self.server[1], self._failures,
+                        self.cooldown)
+        else:
+            log.info('Circuit to searchd at %s:%s is now %s.',
+                     self.server[0], self.server[1], state)
+        self.state = state
+
+    def __repr__(self):
+        return '<CircuitBreaker %s:%s %s>' % (self.server + (self.state,))
@@ -0,0 +1,136 @@
+"""Column-wise storage of Sphinx matches, for big result sets"""
+
+from array import array
+
+
+# Python 2's array module has no 'q'. 'l' is 64 bits on LP64 platforms, and
+# where it isn't, anything too big for it lands in a list instead.
+try:
+    array('q')
+except ValueError:
+    _INT = 'l'
+else:
+    _INT = 'q'
+
+
+def _column(values):
+    """Pack values into the most compact array that holds them, or a list if none does."""
+    values = list(values)
+    try:
+        return array(_INT, values)
+    except OverflowError:
+        return values
+    except TypeError:
+        try:
+            return array('d', values)
+        except TypeError:  # strings, multi-valued attributes, etc.
+            return values
+
+
+class CompactMatches(object):
+    """Sphinx matches stored as a column per field rather than a dict per match
+
+    This stands in for the list of match dicts in a raw Sphinx result. It
+    supports len(), iteration, and indexing, yielding lightweight ``Match``
+    rows which support ``match['id']``, ``match['weight']``, and
+    ``match['attrs'][name]``. Slicing returns another ``CompactMatches``.
+    Reading a whole column with ``column()`` allocates nothing per match.
+
+    """
+    __slots__ = ('ids', 'weights', 'columns')
+
+    def __init__(self, ids, weights, columns):
+        """
+        :arg ids: Document IDs
+        :arg weights: Match weights, parallel to ``ids``
+        :arg columns: A dict of attribute name -> values parallel to ``ids``
+
+        """
+        self.ids = ids
+        self.weights = weights
+        self.columns = columns
+
+    @classmethod
+    def from_matches(cls, matches):
+        """Make a ``CompactMatches`` out of a list of match dicts."""
+        names = matches[0]['attrs'].keys() if matches else []
+        return cls(_column(m['id'] for m in matches),
+                   _column(m['weight'] for m in matches),
+                   dict((name, _column(m['attrs'][name] for m in matches))
+                        for name in names))
+
+    def column(self, name):
+        """Return all the values of an attribute, or of ``id`` or ``weight``."""
+        if name == 'id':
+            return self.ids
+        if name == 'weight':
+            return self.weights
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (Match(self, i) for i in xrange(len(self.ids)))
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return CompactMatches(
+                self.ids[k], self.weights[k],
+                dict((name, c[k]) for name, c in self.columns.iteritems()))
+        if k < 0:
+            k += len(self.ids)
+        if not 0 <= k < len(self.ids):
+            raise IndexError('match index out of range')
+        return Match(self, k)
+
+    def __reduce__(self):
+        # Without this, __slots__ keep pickle protocols 0 and 1, which some
+        # cache backends use, from working.
+        return CompactMatches, (self.ids, self.weights, self.columns)
+
+
+class Match(object):
+    """One match in a ``CompactMatches``, readable like a Sphinx match dict"""
+    __slots__ = ('_matches', '_index')
+
+    def __init__(self, matches, index):
+        self._matches = matches
+        self._index = index
+
+    def __getitem__(self, key):
+        if key == 'attrs':
+            return MatchAttrs(self._matches, self._index)
+        if key in ('id', 'weight'):
+            return self._matches.column(key)[self._index]
+        raise KeyError(key)
+
+    def __reduce__(self):
+        return Match, (self._matches, self._index)
+
+
+class MatchAttrs(object):
+    """The attributes of one match in a ``CompactMatches``, readable like a dict"""
+    __slots__ = ('_matches', '_index')
+
+    def __init__(self, matches, index):
+        self._matches = matches
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._matches.columns[name][self._index]
+
+    def __contains__(self, name):
+        return name in self._matches.columns
+
+    def keys(self):
+        return self._matches.columns.keys()
+
+    def __iter__(self):
+        return iter(self._matches.columns)
+
+    def __len__(self):
+        return len(self._matches.columns)
+
+    def __reduce__(self):
+        return MatchAttrs, (self._matches, self._index)
@@ -0,0 +1,132 @@
+"""Timing of oedipus's hot paths
+
+These events are timed:
+
+``compile``
+    Turning an ``S``'s steps into a query
+``query``
+    Running queries against searchd
+``hydrate``
+    Pulling results' objects out of the DB (or a ``HydrationCache``)
+``excerpts``
+    Building excerpts with searchd
+
+By default, nothing is recorded, at the cost of little more than a function
+call per event. To record them, pass a sink to ``set_sink()``::
+
+    from statsd import StatsClient
+    set_sink(StatsdSink(StatsClient()))
+
+A sink is anything with a ``record(event, duration, **info)`` method.
+``duration`` is in seconds. ``info`` always has the ``index`` the event
+concerns and, where they're known, the number of ``matches`` (or, for
+``hydrate`` and ``excerpts``, documents) and ``bytes`` of response.
+
+Some events are counted rather than timed:
+
+``hedge``
+    Sending a duplicate of a slow query to another replica
+``hedge_won``
+    The duplicate answering first
+``coalesced``
+    A search sharing the results of an identical one already running
+
+A sink with a ``count(event, **info)`` method is told of those, with the
+``index`` in ``info``.
+
+"""
+from time import time
+
+
+_sink = None
+
+
+def set_sink(sink):
+    """Send events to ``sink`` from now on. Pass None to stop recording them."""
+    global _sink
+    _sink = sink
+
+
+def timed(event, **info):
+    """Return a context manager which times its block as an ``event``.
+
+    What it returns from ``__enter__()`` has an ``update()`` method for adding
+    to the ``info`` things learned within the block, like the number of
+    matches.
+
+    """
+    if _sink is None:
+        return _NOT_TIMED
+    return _Timer(_sink, event, info)
+
+
+def count(event, **info):
+    """Tell the sink, if there is one that counts events, that an ``event`` happened."""
+    if _sink is not None and hasattr(_sink, 'count'):
+        _sink.count(event, **info)
+
+
+class StatsdSink(object):
+    """A sink which sends events to a statsd client
+
+    Each event's duration is sent as a timing stat named
+    ``<prefix>.<event>.<index>``, and its matches and bytes, if known, as
+    counters under that. Counted events are sent as counters of the same
+    name.
+
+    """
+    def __init__(self, client, prefix='oedipus'):
+        """
+        :arg client: Something with ``timing(stat, milliseconds)`` and
+            ``incr(stat, count)`` methods, like a ``statsd.StatsClient``
+
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, event, duration, **info):
+        stat = '%s.%s.%s' % (self.prefix, event, info.get('index'))
+        self.client.timing(stat, int(round(duration * 1000)))
+        for key in ('matches', 'bytes'):
+            if info.get(key) is not None:
+                self.client.incr('%s.%s' % (stat, key), info[key])
+
+    def count(self, event, **info):
+        self.client.incr('%s.%s.%s' % (self.prefix, event, info.get('index')),
+                         1)
+
+
+class _Timer(object):
+    __slots__ = ('sink', 'event', 'info', 'start')
+
+    def __init__(self, sink, event, info):
+        self.sink = sink
+        self.event = event
+        self.info = info
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.sink.record(self.event, time() - self.start, **self.info)
+
+    def update(self, **info):
+        self.info.update(info)
+
+
+class _NotTimed(object):
+    """A stand-in for a ``_Timer`` which does nothing, for when there's no sink"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def update(self, **info):
+        pass
+
+
+_NOT_TIMED = _NotTimed()
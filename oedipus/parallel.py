@@ -0,0 +1,79 @@
+"""A bounded pool of threads for running blocking searches side by side"""
+
+import os
+from Queue import Queue
+import threading
+
+
+class ThreadPool(object):
+    """A fixed number of daemon threads which run the functions handed to them
+
+    Threads are started on first use. Like ``ConnectionPool``, the pool
+    notices when it finds itself in a forked child process, where its
+    threads don't exist, and starts fresh ones there.
+
+    """
+    def __init__(self, size):
+        """
+        :arg size: The number of threads, and so the most functions run at
+            once
+
+        """
+        self.size = size
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def submit(self, function, *args):
+        """Run ``function(*args)`` on one of the threads, and return a ``Task`` to wait on."""
+        task = Task(function, args)
+        self._started().put(task)
+        return task
+
+    def _started(self):
+        """Start the threads if they aren't running in this process, and return their queue."""
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                # The lock might have been held at fork time by a thread which
+                # doesn't exist in the child.
+                self._lock = threading.Lock()
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = Queue()
+                    for i in xrange(self.size):
+                        thread = threading.Thread(target=_work,
+                                                  args=(self._queue,),
+                                                  name='oedipus-%s' % i)
+                        thread.daemon = True
+                        thread.start()
+                    self._pid = pid
+        return self._queue
+
+
+def _work(queue):
+    while True:
+        queue.get().run()
+
+
+class Task(object):
+    """A function call handed to a ``ThreadPool``, and its outcome"""
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args)
+        except Exception, e:
+            self.exception = e
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish, and return whether it has."""
+        self._done.wait(timeout)
+        return self._done.is_set()
@@ -0,0 +1,116 @@
+"""Persistent, reusable connections to searchd"""
+
+import os
+import threading
+from time import time
+
+import sphinxapi
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of persistently connected SphinxClients
+
+    Idle clients are kept per (host, port). Each is opened with searchd's
+    persistent-connection command, so a query run on a reused client skips
+    the TCP connect and protocol handshake.
+
+    A client handed out by ``get()`` belongs to the caller until it is handed
+    back with ``put()``. Callers should hand back only clients whose last
+    request succeeded and whose per-query settings have been reset; anything
+    else should just be dropped (or passed to ``discard()``).
+
+    The pool notices when it finds itself in a forked child process and
+    forgets the parent's connections rather than sharing their sockets.
+
+    """
+    def __init__(self, max_size=10, max_idle=60):
+        """
+        :arg max_size: The most idle clients to keep per (host, port)
+        :arg max_idle: Seconds after which an idle client is closed rather
+            than reused. Keep this below searchd's ``client_timeout``, or
+            searchd will hang up on clients before we do.
+
+        """
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}  # {(host, port): [(time last used, client), ...]}
+        self._pid = os.getpid()
+
+    def get(self, host, port):
+        """Return a SphinxClient pointed at the given searchd.
+
+        Reuse an idle one if there's a fresh enough one around; otherwise,
+        make a new one and open a persistent connection on it.
+
+        """
+        stale = []
+        client = None
+        now = time()
+        self._forget_if_forked()
+        with self._lock:
+            idle = self._idle.get((host, port), [])
+            # The list is oldest-first. Weed out the stale ones, and then take
+            # the most recently used of the rest.
+            while idle and now - idle[0][0] > self.max_idle:
+                stale.append(idle.pop(0)[1])
+            if idle:
+                client = idle.pop()[1]
+        for c in stale:
+            self.discard(c)
+
+        if client is None:
+            client = sphinxapi.SphinxClient()
+            client.SetServer(host, port)
+            # Older sphinxapis don't support persistent connections, and
+            # failure to open one isn't fatal: the client will just connect
+            # per request and report any error then.
+            if hasattr(client, 'Open'):
+                client.Open()
+        return client
+
+    def put(self, client, host, port):
+        """Return a client to the pool so it can be reused.
+
+        If the pool is full, close the least recently used client.
+
+        """
+        overflow = []
+        self._forget_if_forked()
+        with self._lock:
+            idle = self._idle.setdefault((host, port), [])
+            idle.append((time(), client))
+            while len(idle) > self.max_size:
+                overflow.append(idle.pop(0)[1])
+        for c in overflow:
+            self.discard(c)
+
+    def discard(self, client):
+        """Close a client's persistent connection, if it has one."""
+        if hasattr(client, 'Close'):
+            try:
+                client.Close()
+            except Exception:
+                pass
+
+    def clear(self):
+        """Close all idle clients."""
+        with self._lock:
+            clients = [c for idle in self._idle.itervalues() for _, c in idle]
+            self._idle = {}
+        for c in clients:
+            self.discard(c)
+
+    def _forget_if_forked(self):
+        """Drop, without closing, connections inherited from a parent process.
+
+        Closing them would be harmless to the parent, but there's no point.
+        The lock is replaced too, since it might have been held at fork time
+        by a thread which doesn't exist in the child.
+
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._lock = threading.Lock()
+            self._idle = {}
+            self._pid = pid
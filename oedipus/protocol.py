@@ -0,0 +1,523 @@
+"""An implementation of the searchd wire protocol which does no I/O of its own
+
+sphinxapi blocks on its sockets, so each in-flight query ties up a thread.
+The pieces here encode requests and decode responses without touching a
+socket, so queries can be driven by any event loop. ``run()`` is a simple
+one: it multiplexes many conversations with searchd over non-blocking
+sockets in the calling thread.
+
+We speak version 1.22 of the search command (that of Sphinx 0.9.9) and 1.0 of
+the excerpt command, both of which later searchds also understand.
+
+"""
+from collections import namedtuple
+from copy import copy
+import errno
+import select
+import socket
+from struct import pack, unpack_from
+from time import time
+
+
+SEARCHD_COMMAND_SEARCH = 0
+SEARCHD_COMMAND_EXCERPT = 1
+
+VER_COMMAND_SEARCH = 0x116
+VER_COMMAND_EXCERPT = 0x100
+
+SEARCHD_OK = 0
+SEARCHD_ERROR = 1
+SEARCHD_RETRY = 2
+SEARCHD_WARNING = 3
+
+SPH_FILTER_VALUES = 0
+SPH_FILTER_RANGE = 1
+
+SPH_ATTR_FLOAT = 5
+SPH_ATTR_BIGINT = 6
+SPH_ATTR_STRING = 7
+SPH_ATTR_MULTI = 0x40000000
+
+SPH_GROUPBY_DAY = 0
+
+
+class ProtocolError(Exception):
+    """searchd refused a request or sent back something we can't make sense of"""
+
+
+class SearchdError(ProtocolError):
+    """searchd answered a request with an error"""
+
+
+class IncompleteResponse(ProtocolError):
+    """searchd hung up before sending a whole response"""
+
+
+class QueryEncoder(object):
+    """A stand-in for ``sphinxapi.SphinxClient`` which encodes queries without sending them
+
+    It supports the subset of the SphinxClient API that ``S`` uses. Add
+    queries to it as you would to a SphinxClient, and then call
+    ``exchange()`` to get an ``Exchange`` that will run them all.
+
+    """
+    def __init__(self):
+        self._queries = []
+        self._offset = 0
+        self._limit = 20
+        self._maxmatches = 1000
+        self._mode = 0
+        self._ranker = 0
+        self._sort = 0
+        self._sortby = ''
+        self._fieldweights = {}
+        self._select = '*'
+        self.ResetFilters()
+        self.ResetGroupBy()
+
+    def SetLimits(self, offset, limit, maxmatches=0, cutoff=0):
+        self._offset = offset
+        self._limit = limit
+        if maxmatches > 0:
+            self._maxmatches = maxmatches
+
+    def SetMatchMode(self, mode):
+        self._mode = mode
+
+    def SetRankingMode(self, ranker):
+        self._ranker = ranker
+
+    def SetSortMode(self, mode, clause=''):
+        self._sort = mode
+        self._sortby = clause
+
+    def SetFieldWeights(self, weights):
+        self._fieldweights = weights
+
+    def SetSelect(self, select):
+        self._select = select
+
+    def SetFilter(self, attribute, values, exclude=0):
+        self._filters.append((attribute, SPH_FILTER_VALUES, values, exclude))
+
+    def SetFilterRange(self, attribute, min_, max_, exclude=0):
+        self._filters.append((attribute, SPH_FILTER_RANGE, (min_, max_),
+                              exclude))
+
+    def SetGroupBy(self, attribute, func, groupsort='@group desc'):
+        self._groupby = attribute
+        self._groupfunc = func
+        self._groupsort = groupsort
+
+    def ResetFilters(self):
+        self._filters = []
+
+    def ResetGroupBy(self):
+        self._groupby = ''
+        self._groupfunc = SPH_GROUPBY_DAY
+        self._groupsort = '@group desc'
+
+    def AddQuery(self, query, index='*', comment=''):
+        req = [pack('>5L', self._offset, self._limit, self._mode,
+                    self._ranker, self._sort),
+               _string(self._sortby),
+               _string(query),
+               pack('>L', 0),  # Deprecated positional field weights
+               _string(index),
+               pack('>LQQ', 1, 0, 0)]  # 64-bit ID range: unrestricted
+
+        req.append(pack('>L', len(self._filters)))
+        for attribute, type, values, exclude in self._filters:
+            req.append(_string(attribute) + pack('>L', type))
+            if type == SPH_FILTER_VALUES:
+                req.append(pack('>L%sq' % len(values), len(values), *values))
+            else:
+                req.append(pack('>2q', *values))
+            req.append(pack('>L', exclude))
+
+        req.extend([pack('>L', self._groupfunc),
+                    _string(self._groupby),
+                    pack('>L', self._maxmatches),
+                    _string(self._groupsort),
+                    pack('>3L', 0, 0, 0),  # Cutoff, retry count and delay
+                    _string(''),  # Group-distinct attribute
+                    pack('>3L', 0, 0, 0),  # Geo anchor, index weights,
+                                           # max query time
+                    pack('>L', len(self._fieldweights))])
+        for field, weight in self._fieldweights.iteritems():
+            req.append(_string(field) + pack('>L', weight))
+        req.extend([_string(comment),
+                    pack('>L', 0),  # Attribute overrides
+                    _string(self._select)])
+        self._queries.append(''.join(req))
+
+    def exchange(self, callback=None):
+        """Return an ``Exchange`` which runs all the queries added so far.
+
+        Its ``finish()`` returns a list of results, one per query, in the
+        same format as ``SphinxClient.RunQueries()``.
+
+        """
+        count = len(self._queries)
+        return Exchange(SEARCHD_COMMAND_SEARCH,
+                        VER_COMMAND_SEARCH,
+                        pack('>L', count) + ''.join(self._queries),
+                        lambda body: parse_search_response(body, count),
+                        callback)
+
+
+def excerpt_exchange(docs, index, words, options, callback=None):
+    """Return an ``Exchange`` which builds excerpts like ``SphinxClient.BuildExcerpts()``.
+
+    Its ``finish()`` returns a list of excerpts, one per doc.
+
+    """
+    options = dict({'before_match': '<b>',
+                    'after_match': '</b>',
+                    'chunk_separator': ' ... ',
+                    'limit': 256,
+                    'around': 5}, **options)
+    req = [pack('>2L', 0, 1),  # Mode, flags (remove spaces)
+           _string(index),
+           _string(words),
+           _string(options['before_match']),
+           _string(options['after_match']),
+           _string(options['chunk_separator']),
+           pack('>3L', int(options['limit']), int(options['around']),
+                len(docs))]
+    req.extend(_string(doc) for doc in docs)
+    return Exchange(SEARCHD_COMMAND_EXCERPT,
+                    VER_COMMAND_EXCERPT,
+                    ''.join(req),
+                    lambda body: _Reader(body).strings(len(docs)),
+                    callback)
+
+
+class Exchange(object):
+    """A single request to searchd and its response, as bytes
+
+    Send ``request`` to searchd, and ``feed()`` whatever comes back until it
+    returns True. Then call ``finish()`` to get the decoded response.
+
+    """
+    def __init__(self, command, version, body, parse, callback=None):
+        """
+        :arg parse: A callable which decodes the body of a successful response
+        :arg callback: A callable to pass the decoded response to. If given,
+            ``finish()`` returns what it returns.
+
+        """
+        # The handshake (our protocol version) goes first. There's no need to
+        # wait for searchd's half of it.
+        self.request = (pack('>L', 1) +
+                        pack('>2HL', command, version, len(body)) +
+                        body)
+        self._parse = parse
+        self._callback = callback
+        self._received = []
+        self._length = 0
+        self._needed = None  # Response length, once we know it
+
+    # searchd's handshake (its protocol version) plus the response header:
+    _PREAMBLE = 12
+
+    @property
+    def bytes_received(self):
+        """Return how many bytes of response have been fed to me so far."""
+        return self._length
+
+    def copy(self):
+        """Return a fresh ``Exchange`` for the same request, to send it elsewhere too.
+
+        Only one of them should be finished, or the callback will get the
+        response twice.
+
+        """
+        twin = copy(self)
+        twin._received = []
+        twin._length = 0
+        twin._needed = None
+        return twin
+
+    def feed(self, data):
+        """Take some bytes received from searchd. Return whether the whole response is in."""
+        self._received.append(data)
+        self._length += len(data)
+        if self._needed is None:
+            if self._length < self._PREAMBLE:
+                return False
+            self._needed = self._PREAMBLE + unpack_from(
+                '>L', ''.join(self._received), 8)[0]
+        return self._length >= self._needed
+
+    def finish(self):
+        """Decode the response, and pass it to the callback if there is one.
+
+        :raises ProtocolError: if searchd returned an error or the response is
+            short or garbled
+
+        """
+        response = ''.join(self._received)
+        if self._needed is None or len(response) < self._needed:
+            raise IncompleteResponse('Incomplete response from searchd')
+        status = unpack_from('>H', response, 4)[0]
+        reader = _Reader(response[self._PREAMBLE:self._needed])
+        if status == SEARCHD_WARNING:
+            reader.string()  # Skip the warning.
+        elif status != SEARCHD_OK:
+            raise SearchdError('searchd error (status %s): %s' %
+                               (status, reader.string()))
+        try:
+            result = self._parse(reader.rest())
+        except Exception, e:
+            raise ProtocolError('Garbled response from searchd: %s' % e)
+        if self._callback:
+            return self._callback(result)
+        return result
+
+
+def parse_search_response(body, count):
+    """Decode the body of a response to ``count`` search queries.
+
+    Return a list of results in the format of ``SphinxClient.RunQueries()``.
+
+    """
+    reader = _Reader(body)
+    results = []
+    for i in xrange(count):
+        result = {'error': '', 'warning': ''}
+        results.append(result)
+        result['status'] = status = reader.uint()
+        if status != SEARCHD_OK:
+            message = reader.string()
+            if status == SEARCHD_WARNING:
+                result['warning'] = message
+            else:
+                result['error'] = message
+                continue
+
+        result['fields'] = reader.strings(reader.uint())
+        attrs = [(reader.string(), reader.uint())
+                 for a in xrange(reader.uint())]
+        result['attrs'] = [list(a) for a in attrs]
+
+        matches = result['matches'] = []
+        match_count, id64 = reader.uint(), reader.uint()
+        for m in xrange(match_count):
+            id = reader.unpack('>Q' if id64 else '>L')
+            match = {'id': id, 'weight': reader.uint(), 'attrs': {}}
+            for name, type in attrs:
+                if type == SPH_ATTR_FLOAT:
+                    value = reader.unpack('>f')
+                elif type & SPH_ATTR_MULTI:
+                    value = [reader.uint() for v in xrange(reader.uint())]
+                elif type == SPH_ATTR_BIGINT:
+                    value = reader.unpack('>q')
+                elif type == SPH_ATTR_STRING:
+                    value = reader.string()
+                else:
+                    value = reader.uint()
+                match['attrs'][name] = value
+            matches.append(match)
+
+        result['total'], result['total_found'] = reader.uint(), reader.uint()
+        result['time'] = '%.3f' % (reader.uint() / 1000.0)
+        result['words'] = [{'word': reader.string(),
+                            'docs': reader.uint(),
+                            'hits': reader.uint()}
+                           for w in xrange(reader.uint())]
+    return results
+
+
+class Timeouts(namedtuple('Timeouts', ['connect', 'read', 'hedge_after'])):
+    """Per-phase time limits, in seconds, for a job given to ``run()``
+
+    ``connect`` limits how long connecting to searchd may take, and
+    ``read`` how long it may then take to send the request and get the
+    whole response. After ``hedge_after`` seconds without an answer, a
+    duplicate of the request may be sent elsewhere (see ``run()``). Any of
+    them may be None, for no limit.
+
+    """
+    __slots__ = ()
+
+
+NO_TIMEOUTS = Timeouts(None, None, None)
+
+
+def run(jobs, timeout=None, hedge=None, report=None):
+    """Carry out many ``Exchange``s with searchd at once, in this thread.
+
+    :arg jobs: An iterable of (host, port, exchange) tuples, or of (host,
+        port, exchange, ``Timeouts``) tuples
+    :arg timeout: Seconds after which to give up on any exchanges which
+        haven't finished
+    :arg hedge: A callable which is passed the index of a job that has gone
+        unanswered for its ``hedge_after`` seconds. It can return another
+        (host, port, exchange) to race against the first; whichever answers
+        first wins, and the other is hung up on. Or it can return None.
+    :arg report: A callable which is passed (job index, host, port, outcome)
+        whenever an attempt at a job ends. The outcome is what ``finish()``
+        returned, an exception, or None if another attempt won the race.
+
+    Return a list parallel to ``jobs`` of the exchanges' ``finish()`` return
+    values--or of exceptions, for those that failed.
+
+    """
+    jobs = [job if len(job) == 4 else job + (NO_TIMEOUTS,) for job in jobs]
+    outcomes = [None] * len(jobs)
+    finished = [False] * len(jobs)
+    poller = select.poll()
+    attempts = {}  # {file descriptor: _Attempt}
+    # Jobs which may yet be hedged, as {job index: time to hedge}:
+    hedge_times = {}
+
+    def start(i, host, port, exchange):
+        timeouts = jobs[i][3]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((host, port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            end(_Attempt(i, host, port, None, exchange, None),
+                socket.error(err, 'Could not connect to searchd'))
+            return
+        deadline = (None if timeouts.connect is None else
+                    time() + timeouts.connect)
+        attempt = _Attempt(i, host, port, sock, exchange, deadline)
+        attempts[sock.fileno()] = attempt
+        poller.register(sock, select.POLLOUT)
+
+    def end(attempt, outcome):
+        """Finish an attempt, and, if it's the last one going, its job."""
+        if attempt.sock is not None:
+            fd = attempt.sock.fileno()
+            del attempts[fd]
+            poller.unregister(fd)
+            attempt.sock.close()
+        if report:
+            report(attempt.job, attempt.host, attempt.port, outcome)
+        i = attempt.job
+        if finished[i]:
+            return
+        others = [a for a in attempts.itervalues() if a.job == i]
+        if isinstance(outcome, Exception) and others:
+            return  # Let the race play out.
+        finished[i] = True
+        outcomes[i] = outcome
+        hedge_times.pop(i, None)
+        for other in others:
+            end(other, None)
+
+    now = time()
+    for i, (host, port, exchange, timeouts) in enumerate(jobs):
+        if hedge and timeouts.hedge_after is not None:
+            hedge_times[i] = now + timeouts.hedge_after
+        start(i, host, port, exchange)
+
+    deadline = None if timeout is None else now + timeout
+    while attempts:
+        now = time()
+        if deadline is not None and now >= deadline:
+            break
+        for attempt in attempts.values():
+            if attempt.deadline is not None and now >= attempt.deadline:
+                end(attempt, socket.timeout(
+                        'Timed out connecting to searchd' if
+                        attempt.connecting else
+                        'searchd took too long to respond'))
+        for i, when in hedge_times.items():
+            if now >= when:
+                del hedge_times[i]
+                duplicate = hedge(i)
+                if duplicate is not None:
+                    start(i, *duplicate)
+        if not attempts:
+            break
+
+        wakeups = [t for t in ([deadline] + hedge_times.values() +
+                               [a.deadline for a in attempts.itervalues()])
+                   if t is not None]
+        wait = None
+        if wakeups:
+            # poll() takes milliseconds.
+            wait = max(min(wakeups) - now, 0) * 1000
+        for fd, event in poller.poll(wait):
+            attempt = attempts.get(fd)
+            if attempt is None:  # Ended by an earlier event
+                continue
+            try:
+                if attempt.outgoing:
+                    if attempt.connecting:
+                        attempt.connecting = False
+                        read = jobs[attempt.job][3].read
+                        attempt.deadline = (None if read is None else
+                                            time() + read)
+                    sent = attempt.sock.send(attempt.outgoing)
+                    attempt.outgoing = attempt.outgoing[sent:]
+                    if not attempt.outgoing:
+                        poller.modify(fd, select.POLLIN)
+                else:
+                    data = attempt.sock.recv(65536)
+                    if not data:
+                        raise IncompleteResponse('searchd hung up early')
+                    if attempt.exchange.feed(data):
+                        end(attempt, attempt.exchange.finish())
+            except Exception, e:
+                end(attempt, e)
+
+    for attempt in attempts.values():
+        end(attempt, socket.timeout('searchd took too long to respond'))
+    return outcomes
+
+
+class _Attempt(object):
+    """One try at a job given to ``run()``: a connection and its progress"""
+    __slots__ = ('job', 'host', 'port', 'sock', 'exchange', 'deadline',
+                 'connecting', 'outgoing')
+
+    def __init__(self, job, host, port, sock, exchange, deadline):
+        self.job = job
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.exchange = exchange
+        self.deadline = deadline  # When the current phase times out
+        self.connecting = True
+        self.outgoing = exchange.request  # Bytes still to send
+
+
+class _Reader(object):
+    """A cursor for decoding big-endian fields from a string of bytes"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, format):
+        value = unpack_from(format, self.data, self.pos)[0]
+        self.pos += 8 if format[1] in 'qQ' else 4
+        return value
+
+    def uint(self):
+        return self.unpack('>L')
+
+    def string(self):
+        length = self.uint()
+        value = self.data[self.pos:self.pos + length]
+        if len(value) != length:
+            raise ProtocolError('String runs off the end of the response')
+        self.pos += length
+        return value
+
+    def strings(self, count):
+        return [self.string() for i in xrange(count)]
+
+    def rest(self):
+        return self.data[self.pos:]
+
+
+def _string(value):
+    """Encode a string as searchd expects: length, then UTF-8 bytes."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return pack('>L', len(value)) + value
@@ -1,31 +1,103 @@
+from itertools import izip
+
+from oedipus.compact import CompactMatches
+from oedipus.instrumentation import timed
+
+
 class SearchResults(object):
     """Results in the order in which they came out of Sphinx
 
     Since Sphinx stores no non-numerical attributes, we have to reach into the
-    DB to pull them out.
+    DB to pull them out. That's done lazily, a chunk of IDs at a time, as
+    iteration reaches them, so huge ID lists don't blow through DB parameter
+    limits and the first results come back without waiting for the rest.
 
     """
-    def __init__(self, type, ids, fields):
+    #: The most IDs to look up in a single DB query
+    chunk_size = 1000
+
+    #: The form in which a ``HydrationCache`` keeps my DB objects
+    cache_kind = 'object'
+
+    def __init__(self, type, ids, fields, objects=None, chunk_size=None,
+                 cache=None, weights=None):
+        """
+        :arg objects: A dict of objects already pulled out of the DB for
+            other results of the same search, to be shared with these.
+            Only objects not already in it are fetched, and those are added
+            to it.
+        :arg chunk_size: Overrides the class's ``chunk_size``
+        :arg cache: A ``HydrationCache`` to check before going to the DB
+        :arg weights: Sphinx's relevance weights, parallel to ``ids``
+
+        """
         self.type = type
         # Sphinx may return IDs of objects since deleted from the DB.
         self.ids = ids
         self.fields = fields  # tuple
-        self.objects = dict(self._objects())  # {id: obj/tuple/dict, ...}
+        self.objects = {} if objects is None else objects  # {id: obj/tuple/dict, ...}
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.cache = cache
+        self.weights = weights
+
+    def _queryset(self, ids):
+        """Return a QuerySet of the objects with the given IDs."""
+        return self.type.objects.filter(id__in=ids)
+
+    def _load(self, ids):
+        """Pull out of the DB any of the given IDs' objects which haven't been already."""
+        unloaded = [id for id in ids if id not in self.objects]
+        if not unloaded:
+            return
+        with timed('hydrate', index=self.type.SphinxMeta.index,
+                   matches=len(unloaded)):
+            if self.cache is None:
+                self.objects.update(self._objects(unloaded))
+                return
 
-    def _queryset(self):
-        """Return a QuerySet of the objects parallel to the found docs."""
-        return self.type.objects.filter(id__in=self.ids)
+            rows = self.cache.get_many(self.type, self.cache_kind, unloaded)
+            missing = [id for id in unloaded if id not in rows]
+            if missing:
+                fetched = dict(self._cacheable_rows(missing))
+                self.cache.set_many(self.type, self.cache_kind, fetched)
+                rows.update(fetched)
+            self.objects.update((id, self._from_cacheable(row))
+                                for id, row in rows.iteritems())
+
+    def _cacheable_rows(self, ids):
+        """Return an iterable of (document ID, DB row) pairs for the given IDs, in the form a ``HydrationCache`` keeps them."""
+        return self._objects(ids)
+
+    def _from_cacheable(self, row):
+        """Turn a row from ``_cacheable_rows()`` into a result."""
+        return row
+
+    def _found(self):
+        """Yield (index into ``ids``, result) pairs for the results still in the DB, in Sphinx's order."""
+        for start in xrange(0, len(self.ids), self.chunk_size):
+            ids = self.ids[start:start + self.chunk_size]
+            self._load(ids)
+            # Ripped off from elasticutils
+            for i, id in enumerate(ids, start):
+                if id in self.objects:
+                    yield i, self.objects[id]
 
     def __iter__(self):
         """Iterate over results in the same order they came out of Sphinx."""
-        # Ripped off from elasticutils
-        return (self.objects[id] for id in self.ids if id in self.objects)
+        return (result for i, result in self._found())
+
+    def with_weights(self):
+        """Iterate over results as ``__iter__()`` does, yielding (result, relevance weight) pairs."""
+        return ((result, self.weights[i]) for i, result in self._found())
 
 
 class DictResults(SearchResults):
     """Results as an iterable of dictionaries"""
-    def _dicts_with_ids(self):
-        """Return an iterable of dicts with ``id`` attrs, each representing a matched DB object."""
+    cache_kind = 'dict'
+
+    def _dicts_with_ids(self, ids):
+        """Return an iterable of dicts with ``id`` attrs, each representing one of the given IDs' DB objects."""
         fields = self.fields
         # Append ID to the requested fields so we can keep track of object
         # identity to sort by weight (or whatever Sphinx sorted by). We could
@@ -39,15 +111,24 @@ class DictResults(SearchResults):
         # find the ID afterward, and we don't want to have to go rooting around
         # in the Django model to figure out what order the fields were declared
         # in in the case that no fields were passed in.
-        return self._queryset().values(*fields)
+        return self._queryset(ids).values(*fields)
 
-    def _objects(self):
-        """Return an iterable of (document ID, dict) pairs."""
+    def _objects(self, ids):
+        """Return an iterable of (document ID, dict) pairs for the given IDs."""
         should_strip_ids = self.fields and 'id' not in self.fields
-        for d in self._dicts_with_ids():
+        for d in self._dicts_with_ids(ids):
             id = d.pop('id') if should_strip_ids else d['id']
             yield id, d
 
+    def _cacheable_rows(self, ids):
+        """Return (document ID, dict of all fields) pairs, so cached rows serve any choice of fields."""
+        return ((d['id'], d) for d in self._queryset(ids).values())
+
+    def _from_cacheable(self, row):
+        if not self.fields:
+            return dict(row)
+        return dict((k, row[k]) for k in self.fields)
+
     @classmethod
     def content_for_fields(klass, result, fields, highlight_fields):
         """Returns a tuple with content values for highlight_fields.
@@ -69,11 +150,14 @@ class DictResults(SearchResults):
 
 class TupleResults(DictResults):
     """Results as an iterable of tuples, like Django's values_list()"""
-    def _objects(self):
-        """Return an iterable of (document ID, tuple) pairs."""
-        for d in self._dicts_with_ids():
+    def _objects(self, ids):
+        """Return an iterable of (document ID, tuple) pairs for the given IDs."""
+        for d in self._dicts_with_ids(ids):
             yield d['id'], tuple(d[k] for k in self.fields)
 
+    def _from_cacheable(self, row):
+        return tuple(row[k] for k in self.fields)
+
     @classmethod
     def content_for_fields(klass, result, fields, highlight_fields):
         """See ``DictResults.content_for_fields``.
@@ -88,12 +172,12 @@ class TupleResults(DictResults):
 
 class ObjectResults(SearchResults):
     """Results as an iterable of Django model-like objects"""
-    def _objects(self):
-        """Return an iterable of (document ID, model object) pairs."""
+    def _objects(self, ids):
+        """Return an iterable of (document ID, model object) pairs for the given IDs."""
         # Assuming the document ID is called "id" lets us depend on fewer
         # Djangoisms than assuming it's the pk; we'd have to get
         # self.type._meta to get the name of the pk.
-        return ((o.id, o) for o in self._queryset())
+        return ((o.id, o) for o in self._queryset(ids))
 
     @classmethod
     def content_for_fields(klass, result, fields, highlight_fields):
@@ -104,3 +188,70 @@ class ObjectResults(SearchResults):
 
         """
         return tuple(getattr(result, field) for field in highlight_fields)
+
+
+class AttrResults(object):
+    """A mixin for results made straight from the attributes Sphinx returns
+
+    These never touch the DB. Iterating yields one result per match, in
+    Sphinx's order. ``id`` may be asked for as a field even if it isn't an
+    attribute; it's the object ID.
+
+    """
+    def __init__(self, type, ids, fields, matches, weights=None):
+        """
+        :arg matches: Sphinx matches parallel to ``ids``
+        :arg weights: Sphinx's relevance weights, parallel to ``ids``
+
+        """
+        self.type = type
+        self.ids = ids
+        self.fields = fields  # tuple
+        self.matches = matches
+        self.weights = weights
+
+    def __iter__(self):
+        if isinstance(self.matches, CompactMatches):
+            return self._compact_results()
+        return (self._result(id, match['attrs'])
+                for id, match in izip(self.ids, self.matches))
+
+    def with_weights(self):
+        """Iterate over results, yielding (result, relevance weight) pairs."""
+        return izip(self, self.weights)
+
+    def _compact_columns(self, fields):
+        """Return the columns of a ``CompactMatches`` holding the given fields."""
+        return [self.ids if f == 'id' and f not in self.matches.columns
+                else self.matches.columns[f] for f in fields]
+
+    @staticmethod
+    def _attr(id, attrs, field):
+        """Return the value of an attribute, falling back to the object ID for ``id``."""
+        if field == 'id' and 'id' not in attrs:
+            return id
+        return attrs[field]
+
+
+class AttrDictResults(AttrResults, DictResults):
+    """Results as an iterable of dictionaries of Sphinx attributes"""
+    def _result(self, id, attrs):
+        if not self.fields:
+            d = dict(attrs)
+            d.setdefault('id', id)
+            return d
+        return dict((f, self._attr(id, attrs, f)) for f in self.fields)
+
+    def _compact_results(self):
+        fields = self.fields or tuple(self.matches.columns) + ('id',)
+        return (dict(izip(fields, row)) for row in
+                izip(*self._compact_columns(fields)))
+
+
+class AttrTupleResults(AttrResults, TupleResults):
+    """Results as an iterable of tuples of Sphinx attributes"""
+    def _result(self, id, attrs):
+        return tuple(self._attr(id, attrs, f) for f in self.fields)
+
+    def _compact_results(self):
+        return izip(*self._compact_columns(self.fields))
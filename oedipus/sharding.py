@@ -0,0 +1,156 @@
+"""Merging the results of a query run against several shards of an index
+
+Each shard returns its best matches already sorted, so the global ranking
+is a k-way merge of those lists. The merge stops once it has what the
+requested page needs, so no list is ever fully sorted again.
+
+"""
+import heapq
+
+from oedipus.protocol import SEARCHD_ERROR
+
+
+def sort_key(clause):
+    """Return a function which computes a match's sort key under a ``SPH_SORT_EXTENDED`` clause.
+
+    A clause is like ``@weight DESC, @id ASC``. Keys sort ascending, so
+    descending numeric terms are negated, and descending string terms are
+    wrapped so they compare backward.
+
+    """
+    terms = []
+    for term in clause.split(','):
+        words = term.split()
+        if words:
+            terms.append((_getter(words[0]),
+                          len(words) > 1 and words[1].upper() == 'DESC'))
+
+    def key(match):
+        return tuple((_descending(get(match)) if descending else get(match))
+                     for get, descending in terms)
+    return key
+
+
+def _getter(name):
+    """Return a function which pulls a sort term's value out of a match."""
+    if name == '@id':
+        return lambda match: match['id']
+    if name in ('@weight', '@relevance'):
+        return lambda match: match['weight']
+    # Grouped results report the group and its size as attributes:
+    name = {'@group': '@groupby'}.get(name, name)
+    return lambda match: match['attrs'][name]
+
+
+def _descending(value):
+    if isinstance(value, (int, long, float)):
+        return -value
+    return _Backward(value)
+
+
+class _Backward(object):
+    """A wrapper which makes a value sort in reverse"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def merge_matches(lists, key, offset, limit):
+    """Return ``[offset:offset + limit]`` of the k-way merge of several lists of matches.
+
+    Each list must already be sorted by ``key``. Only ``offset + limit``
+    matches are ever looked at, a heap step apiece.
+
+    """
+    heap = [(key(matches[0]), i, 0)
+            for i, matches in enumerate(lists) if matches]
+    heapq.heapify(heap)
+    merged = []
+    for position in xrange(offset + limit):
+        if not heap:
+            break
+        _, i, j = heap[0]
+        if position >= offset:
+            merged.append(lists[i][j])
+        j += 1
+        if j < len(lists[i]):
+            heapq.heapreplace(heap, (key(lists[i][j]), i, j))
+        else:
+            heapq.heappop(heap)
+    return merged
+
+
+def merge_groups(lists, key):
+    """Combine several lists of grouped matches into one, sorted by ``key``.
+
+    A group found on more than one shard becomes a single one, represented
+    by its best match, with the ``@count`` of them all. Since combining
+    can reorder groups, they're sorted afresh, but there are only as many
+    as the shards returned.
+
+    """
+    groups = {}  # {@groupby value: match}
+    for match in merge_matches(lists, key, 0, sum(len(l) for l in lists)):
+        group = match['attrs']['@groupby']
+        if group in groups:
+            groups[group]['attrs']['@count'] += match['attrs']['@count']
+        else:
+            groups[group] = dict(match, attrs=dict(match['attrs']))
+    return sorted(groups.itervalues(), key=key)
+
+
+def merge_results(results, sort, offset, limit, grouped=False):
+    """Combine shards' results for one query into what a single searchd would have returned.
+
+    :arg results: Each shard's result, in ``SphinxClient.RunQueries()``
+        format, made with offset 0 and a limit of at least
+        ``offset + limit``
+    :arg sort: The ``SPH_SORT_EXTENDED`` clause the matches are sorted by
+        (or, if ``grouped``, the group sort clause)
+    :arg grouped: Whether the query grouped its matches
+
+    Totals are summed. For grouped queries, groups found on several shards
+    are counted once, but those beyond the shards' limits can't be told
+    apart, so the total may be high. The query time is the slowest
+    shard's. If any shard had an error, return its result instead.
+
+    """
+    for result in results:
+        if result['status'] == SEARCHD_ERROR:
+            return result
+
+    lists = [result['matches'] for result in results]
+    merged = dict(results[0])
+    if grouped:
+        groups = merge_groups(lists, sort_key(sort))
+        merged['matches'] = groups[offset:offset + limit]
+        for total in ('total', 'total_found'):
+            merged[total] = len(groups) + sum(
+                    result.get(total, 0) - len(result['matches'])
+                    for result in results)
+    else:
+        merged['matches'] = merge_matches(lists, sort_key(sort), offset,
+                                          limit)
+        for total in ('total', 'total_found'):
+            merged[total] = sum(result.get(total, 0) for result in results)
+    merged['time'] = '%.3f' % max(float(result.get('time', 0))
+                                  for result in results)
+
+    words = {}
+    for result in results:
+        for stats in result.get('words', []):
+            if stats['word'] in words:
+                words[stats['word']]['docs'] += stats['docs']
+                words[stats['word']]['hits'] += stats['hits']
+            else:
+                words[stats['word']] = dict(stats)
+    merged['words'] = [words[stats['word']]
+                       for stats in results[0].get('words', [])]
+    return merged
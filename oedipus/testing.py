@@ -0,0 +1,477 @@
+"""A fake searchd which speaks the real wire protocol, for tests and benchmarks
+
+Unlike mocking out ``sphinxapi.SphinxClient``, this exercises everything
+between an ``S`` and the network::
+
+    searchd = FakeSearchd({'biscuit': [
+        {'id': 1, 'name': 'Sesame snap', 'color': 3},
+        {'id': 2, 'name': 'Digestive', 'color': 4}]})
+    searchd.start()
+    ids = S(Biscuit, port=searchd.port).query('sesame').object_ids()
+    searchd.stop()
+
+Each index is a list of documents, each a dict with an ``id``. Its string
+values are full-text fields, and its numbers (and lists of integers) are
+attributes.
+
+Searching is simple-minded: a document matches if every word of the query
+appears in it, and its weight is the number of times they do, scaled by any
+field weights. Filters, extended sort clauses, grouping by attribute, and
+limits work as in searchd. Excerpts highlight query words and are cut at
+the ``limit`` option. Keyword requests report each word's document and hit
+counts.
+
+To see how callers cope with a slow or flaky searchd, give it some
+``latency`` and ``jitter``, or an ``error_rate`` or ``drop_rate``. These
+can be changed while it runs. ``connections`` and ``requests`` count what
+it has served, which is handy for checking connection reuse.
+
+"""
+from collections import defaultdict
+import random
+import re
+import SocketServer
+from struct import pack, unpack, error as StructError
+import threading
+from time import sleep, time
+
+from oedipus.protocol import (_Reader, _string, ProtocolError,
+                              SEARCHD_COMMAND_SEARCH, SEARCHD_COMMAND_EXCERPT,
+                              SEARCHD_OK, SEARCHD_ERROR, SPH_FILTER_VALUES,
+                              SPH_FILTER_RANGE, SPH_ATTR_FLOAT,
+                              SPH_ATTR_BIGINT, SPH_ATTR_MULTI)
+
+
+SEARCHD_COMMAND_KEYWORDS = 3
+SEARCHD_COMMAND_PERSIST = 4
+
+SPH_ATTR_INTEGER = 1
+SPH_FILTER_FLOATRANGE = 2
+SPH_RANK_NONE = 2
+SPH_SORT_EXTENDED = 4
+SPH_GROUPBY_ATTR = 4
+
+# Versions of the search command from which filter values are 64-bit
+_WIDE_SEARCH = 0x114
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _words(text):
+    """Return the lowercase words in some text."""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return _WORD.findall(text.lower())
+
+
+class _Document(object):
+    __slots__ = ('id', 'attrs', 'words')
+
+    def __init__(self, id, attrs, words):
+        self.id = id
+        self.attrs = attrs
+        self.words = words  # {field: {word: hits}}
+
+
+class _Index(object):
+    """Some documents, with their words counted and their schema worked out"""
+    def __init__(self, documents):
+        self.docs = []
+        fields = set()
+        types = {}
+        for source in documents:
+            attrs, words = {}, {}
+            for name, value in source.iteritems():
+                if name == 'id':
+                    continue
+                if isinstance(value, basestring):
+                    fields.add(name)
+                    counts = words[name] = defaultdict(int)
+                    for word in _words(value):
+                        counts[word] += 1
+                else:
+                    attrs[name] = value
+                    types[name] = max(types.get(name, SPH_ATTR_INTEGER),
+                                      _attr_type(value))
+            self.docs.append(_Document(source['id'], attrs, words))
+        self.fields = sorted(fields)
+        self.attrs = sorted(types.iteritems())  # [(name, type), ...]
+
+
+def _attr_type(value):
+    if isinstance(value, float):
+        return SPH_ATTR_FLOAT
+    if isinstance(value, (list, tuple)):
+        return SPH_ATTR_MULTI | SPH_ATTR_INTEGER
+    if not 0 <= value <= 0xffffffff:
+        return SPH_ATTR_BIGINT
+    return SPH_ATTR_INTEGER
+
+
+def _attr_bytes(type, value):
+    if type == SPH_ATTR_FLOAT:
+        return pack('>f', value)
+    if type & SPH_ATTR_MULTI:
+        return pack('>L%sL' % len(value), len(value), *value)
+    if type == SPH_ATTR_BIGINT:
+        return pack('>q', value)
+    return pack('>L', value)
+
+
+class FakeSearchd(object):
+    """A searchd stand-in serving some in-memory indices from a thread of its own"""
+    def __init__(self, indexes=None, host='127.0.0.1', port=0, latency=0,
+                 jitter=0, error_rate=0, drop_rate=0, seed=None):
+        """
+        :arg indexes: A dict of index name -> list of document dicts
+        :arg port: The port to listen on. By default, pick a free one; after
+            ``start()``, ``port`` says which.
+        :arg latency: Seconds to wait before answering each request
+        :arg jitter: Up to this many more seconds, at random, to wait
+        :arg error_rate: The fraction of requests to answer with an error
+        :arg drop_rate: The fraction of requests to answer by hanging up
+        :arg seed: A seed for the randomness of jitter and failures, to make
+            them repeatable
+
+        """
+        self.indexes = dict((name, _Index(docs)) for name, docs in
+                            (indexes or {}).iteritems())
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.connections = 0
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """Start answering requests in a background thread. Return myself."""
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.searchd = self
+        self.host, self.port = self._server.server_address
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop listening."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def respond(self, command, version, body):
+        """Return the framed response to a request, or None if none is due.
+
+        :raises Dropped: if the connection should be dropped instead
+
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            roll = self._random.random()
+        if command == SEARCHD_COMMAND_PERSIST:
+            return None
+        if delay:
+            sleep(delay)
+        if roll < self.drop_rate:
+            raise Dropped
+        try:
+            if roll < self.drop_rate + self.error_rate:
+                raise ProtocolError('injected failure')
+            if command == SEARCHD_COMMAND_SEARCH:
+                payload = self._search(_Reader(body), version)
+            elif command == SEARCHD_COMMAND_EXCERPT:
+                payload = self._excerpts(_Reader(body))
+            elif command == SEARCHD_COMMAND_KEYWORDS:
+                payload = self._keywords(_Reader(body))
+            else:
+                raise ProtocolError('unknown command code %s' % command)
+            status = SEARCHD_OK
+        except (ProtocolError, StructError), e:
+            status, payload = SEARCHD_ERROR, _string(str(e))
+        return pack('>2HL', status, version, len(payload)) + payload
+
+    def _search(self, reader, version):
+        queries = [_read_query(reader, version)
+                   for i in xrange(reader.uint())]
+        return ''.join(self._results(q) for q in queries)
+
+    def _results(self, q):
+        """Run a query, and return its part of a search response."""
+        started = time()
+        names = (self.indexes.keys() if q['index'].strip() == '*' else
+                 [n.strip() for n in q['index'].split(',')])
+        for name in names:
+            if name not in self.indexes:
+                return (pack('>L', SEARCHD_ERROR) +
+                        _string("unknown local index '%s' in search request"
+                                % name))
+        indexes = [self.indexes[n] for n in names]
+        fields = sorted(set(f for i in indexes for f in i.fields))
+        attrs = sorted(set(a for i in indexes for a in i.attrs))
+        words = _words(q['query'])
+
+        # Find matches:
+        matches = []
+        stats = dict((w, [0, 0]) for w in words)  # {word: [docs, hits]}
+        for index in indexes:
+            for doc in index.docs:
+                weight = self._weigh(doc, words, q, stats)
+                if weight and _passes(doc, q['filters']):
+                    matches.append({'id': doc.id, 'weight': weight,
+                                    'attrs': doc.attrs})
+
+        # Sort and group them:
+        _sort(matches, q['sortby'] if q['sort'] == SPH_SORT_EXTENDED else
+                       '@weight DESC, @id ASC')
+        if q['groupby']:
+            if q['groupfunc'] != SPH_GROUPBY_ATTR:
+                raise ProtocolError('only grouping by attribute is supported')
+            matches = _group(matches, q['groupby'])
+            _sort(matches, q['groupsort'])
+            group_type = dict(attrs).get(q['groupby'], SPH_ATTR_INTEGER)
+            attrs += [('@groupby', group_type), ('@count', SPH_ATTR_INTEGER)]
+
+        total_found = len(matches)
+        matches = matches[:q['maxmatches']]
+        page = matches[q['offset']:q['offset'] + q['limit']]
+
+        response = [pack('>2L', SEARCHD_OK, len(fields))]
+        response.extend(_string(f) for f in fields)
+        response.append(pack('>L', len(attrs)))
+        response.extend(_string(name) + pack('>L', type)
+                        for name, type in attrs)
+        response.append(pack('>2L', len(page), 1))  # 64-bit IDs
+        for match in page:
+            response.append(pack('>QL', match['id'], match['weight']))
+            response.extend(_attr_bytes(type, match['attrs'].get(name, 0))
+                            for name, type in attrs)
+        response.append(pack('>4L', len(matches), total_found,
+                             int((time() - started) * 1000), len(words)))
+        for word in words:
+            response.append(_string(word) + pack('>2L', *stats[word]))
+        return ''.join(response)
+
+    @staticmethod
+    def _weigh(doc, words, q, stats):
+        """Return the weight of a document for a query, 0 if it doesn't match.
+
+        Along the way, add its hits to the per-word ``stats``.
+
+        """
+        if not words:
+            return 1
+        weight = 0
+        matched = True
+        for word in words:
+            hits = 0
+            for field, counts in doc.words.iteritems():
+                count = counts.get(word, 0)
+                hits += count
+                weight += count * q['fieldweights'].get(field, 1)
+            if hits:
+                stats[word][0] += 1
+                stats[word][1] += hits
+            else:
+                matched = False
+        if not matched:
+            return 0
+        return 1 if q['ranker'] == SPH_RANK_NONE else max(weight, 1)
+
+    def _keywords(self, reader):
+        query, index, hits = reader.string(), reader.string(), reader.uint()
+        if index not in self.indexes:
+            raise ProtocolError("unknown local index '%s' in keywords request"
+                                % index)
+        response = []
+        words = _words(query)
+        for word in words:
+            response.append(_string(word) * 2)  # Tokenized and normalized
+            if hits:
+                counts = [sum(c.get(word, 0) for c in d.words.itervalues())
+                          for d in self.indexes[index].docs]
+                response.append(pack('>2L', sum(1 for c in counts if c),
+                                     sum(counts)))
+        return pack('>L', len(words)) + ''.join(response)
+
+    @staticmethod
+    def _excerpts(reader):
+        reader.uint(), reader.uint()  # Mode and flags
+        reader.string()  # Index
+        words = set(_words(reader.string()))
+        before, after, separator = reader.strings(3)
+        limit, around = reader.uint(), reader.uint()
+        docs = reader.strings(reader.uint())
+
+        def highlight(match):
+            word = match.group()
+            if word.lower() in words:
+                return before.decode('utf-8') + word + after.decode('utf-8')
+            return word
+
+        excerpts = []
+        for doc in docs:
+            text = doc.decode('utf-8')
+            if len(text) > limit:
+                text = text[:limit] + separator.decode('utf-8')
+            excerpts.append(_string(_WORD.sub(highlight, text)))
+        return ''.join(excerpts)
+
+
+class Dropped(Exception):
+    """A request is to be answered by hanging up."""
+
+
+def _read_query(reader, version):
+    """Decode one query of a search request into a dict."""
+    q = {}
+    q['offset'], q['limit'], q['mode'], q['ranker'], q['sort'] = [
+        reader.uint() for i in xrange(5)]
+    q['sortby'] = reader.string()
+    q['query'] = reader.string()
+    [reader.uint() for i in xrange(reader.uint())]  # Positional weights
+    q['index'] = reader.string()
+    if reader.uint():  # ID range
+        reader.unpack('>Q'), reader.unpack('>Q')
+    else:
+        reader.uint(), reader.uint()
+
+    value = '>q' if version >= _WIDE_SEARCH else '>L'
+    q['filters'] = []
+    for i in xrange(reader.uint()):
+        attribute, type = reader.string(), reader.uint()
+        if type == SPH_FILTER_VALUES:
+            values = set(reader.unpack(value) for j in xrange(reader.uint()))
+        elif type == SPH_FILTER_RANGE:
+            values = reader.unpack(value), reader.unpack(value)
+        elif type == SPH_FILTER_FLOATRANGE:
+            values = reader.unpack('>f'), reader.unpack('>f')
+        else:
+            raise ProtocolError('unknown filter type %s' % type)
+        q['filters'].append((attribute, type, values, reader.uint()))
+
+    q['groupfunc'] = reader.uint()
+    q['groupby'] = reader.string()
+    q['maxmatches'] = reader.uint()
+    q['groupsort'] = reader.string()
+    reader.uint(), reader.uint(), reader.uint()  # Cutoff, retries
+    reader.string()  # Group-distinct attribute
+    if reader.uint():  # Geo anchor
+        reader.string(), reader.string()
+        reader.unpack('>f'), reader.unpack('>f')
+    for i in xrange(reader.uint()):  # Index weights
+        reader.string(), reader.uint()
+    reader.uint()  # Max query time
+    q['fieldweights'] = {}
+    for i in xrange(reader.uint()):
+        field = reader.string()
+        q['fieldweights'][field] = reader.uint()
+    reader.string()  # Comment
+    if version >= _WIDE_SEARCH:
+        if reader.uint():
+            raise ProtocolError('attribute overrides are not supported')
+        reader.string()  # Select list
+    return q
+
+
+def _passes(doc, filters):
+    """Return whether a document gets through all of some filters."""
+    for attribute, type, values, exclude in filters:
+        value = doc.id if attribute == '@id' else doc.attrs.get(attribute, 0)
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        if type == SPH_FILTER_VALUES:
+            hit = any(v in values for v in value)
+        else:
+            hit = any(values[0] <= v <= values[1] for v in value)
+        if hit == bool(exclude):
+            return False
+    return True
+
+
+def _sort_value(match, name):
+    if name in ('@weight', '@rank', '@relevance'):
+        return match['weight']
+    if name == '@id':
+        return match['id']
+    if name == '@group':
+        name = '@groupby'
+    return match['attrs'].get(name, 0)
+
+
+def _sort(matches, clause):
+    """Sort matches in place by an extended sort clause like ``@weight DESC, @id ASC``."""
+    for part in reversed([p.split() for p in clause.split(',') if p.strip()]):
+        name = part[0]
+        descending = len(part) > 1 and part[1].upper() == 'DESC'
+        matches.sort(key=lambda m: _sort_value(m, name), reverse=descending)
+
+
+def _group(matches, attribute):
+    """Keep the first match of each value of an attribute, noting group sizes."""
+    groups = {}
+    grouped = []
+    for match in matches:
+        value = match['attrs'].get(attribute, 0)
+        if value in groups:
+            groups[value]['attrs']['@count'] += 1
+        else:
+            attrs = dict(match['attrs'])
+            attrs['@groupby'], attrs['@count'] = value, 1
+            groups[value] = dict(match, attrs=attrs)
+            grouped.append(groups[value])
+    return grouped
+
+
+class _Server(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    """Carry on one connection's conversation with searchd"""
+    def handle(self):
+        searchd = self.server.searchd
+        with searchd._lock:
+            searchd.connections += 1
+        sock = self.request
+        sock.sendall(pack('>L', 1))  # Our protocol version
+        if _receive(sock, 4) is None:  # The client's
+            return
+        while True:
+            header = _receive(sock, 8)
+            if header is None:
+                return
+            command, version, length = unpack('>2HL', header)
+            body = _receive(sock, length)
+            if body is None:
+                return
+            try:
+                response = searchd.respond(command, version, body)
+            except Dropped:
+                return
+            if response is not None:
+                sock.sendall(response)
+
+
+def _receive(sock, length):
+    """Read exactly ``length`` bytes from a socket, or return None if it closes first."""
+    chunks = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
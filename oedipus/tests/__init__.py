@@ -63,6 +63,7 @@ class SphinxMockingTestCase(TestCase):
                       .expects('RunQueries').returns(
                           [{'status': 0,
                             'total': 2,
+                            'total_found': 2,
                             'matches':
                                 [{'attrs': {'color': 3},
                                  'id': 123,
@@ -104,4 +105,5 @@ class BigSphinxMockingTestCase(TestCase):
                       .returns(
                           [{'status': 0,
                             'total': len(matches),
+                            'total_found': len(matches),
                             'matches': matches}]))
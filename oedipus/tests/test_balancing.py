@@ -0,0 +1,233 @@
+"""Tests for spreading queries among replicas"""
+
+from time import time
+from unittest import TestCase
+
+from nose.tools import eq_, assert_raises
+
+from oedipus import (S, SearchError, execute_batch, execute_concurrently,
+                     replica_set)
+import oedipus.balancing
+from oedipus.balancing import ReplicaSet
+from oedipus.instrumentation import set_sink
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, BaseSphinxMeta, SphinxMockingTestCase
+
+
+A, B, C = ('a', 1), ('b', 2), ('c', 3)
+
+
+class Clock(object):
+    """A stand-in for time.time() which only moves when told to"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_round_robin():
+    replicas = ReplicaSet([A, B, C])
+    eq_([replicas.acquire() for i in xrange(4)], [A, B, C, A])
+
+
+def test_least_outstanding():
+    """The least busy server should get the query, taking turns among ties."""
+    replicas = ReplicaSet([A, B, C], strategy='least_outstanding')
+    eq_(replicas.acquire(), A)
+    eq_(replicas.acquire(), B)
+    replicas.release(A)
+    eq_(replicas.acquire(), C)
+    eq_(replicas.acquire(), A)
+    eq_(replicas.outstanding(), {A: 1, B: 1, C: 1})
+
+
+def test_exclude():
+    """Excluding every server in rotation should leave nothing to pick."""
+    replicas = ReplicaSet([A, B])
+    eq_(replicas.acquire(exclude=[A]), B)
+    eq_(replicas.acquire(exclude=[A, B]), None)
+
+
+def test_hedges_keep_turns():
+    """Picks for hedges shouldn't throw off whose turn it is."""
+    replicas = ReplicaSet([A, B])
+    primaries = []
+    for i in xrange(4):
+        primary = replicas.acquire()
+        hedge = replicas.acquire(exclude=[primary])
+        primaries.append(primary)
+        replicas.release(primary, failed=None)
+        replicas.release(hedge)
+    eq_(primaries, [A, B, A, B])
+
+
+def test_bad_strategy():
+    assert_raises(ValueError, ReplicaSet, [A], strategy='random')
+
+
+class CooldownTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self._time = oedipus.balancing.time
+        oedipus.balancing.time = self.clock
+
+    def tearDown(self):
+        oedipus.balancing.time = self._time
+
+    def test_cooldown(self):
+        """A failing server should sit out its cooldown, then get a second chance."""
+        replicas = ReplicaSet([A, B], cooldown=30)
+        replicas.release(replicas.acquire(), failed=True)
+        eq_(replicas.healthy(), [B])
+        eq_([replicas.acquire() for i in xrange(2)], [B, B])
+
+        self.clock.now += 31
+        eq_(replicas.healthy(), [A, B])
+        eq_(sorted(replicas.acquire() for i in xrange(2)), [A, B])
+        replicas.release(A, failed=True)
+        eq_(replicas.healthy(), [B])
+
+    def test_max_failures(self):
+        replicas = ReplicaSet([A, B], max_failures=2)
+        replicas.acquire()
+        replicas.release(A, failed=True)
+        eq_(replicas.healthy(), [A, B])
+        replicas.release(A)  # A success resets the count.
+        replicas.release(A, failed=True)
+        eq_(replicas.healthy(), [A, B])
+        replicas.release(A, failed=True)
+        eq_(replicas.healthy(), [B])
+
+    def test_abandoned(self):
+        """An abandoned query should say nothing about a server's health."""
+        replicas = ReplicaSet([A, B], max_failures=2)
+        for failed in [True, None, True]:
+            replicas.release(replicas.acquire(exclude=[B]), failed=failed)
+        eq_(replicas.outstanding(), {A: 0, B: 0})
+        eq_(replicas.healthy(), [B])
+
+    def test_all_down(self):
+        """With every server out, the one due back soonest should get queries."""
+        replicas = ReplicaSet([A, B], cooldown=30)
+        replicas.release(A, failed=True)
+        self.clock.now += 1
+        replicas.release(B, failed=True)
+        eq_(replicas.acquire(), A)
+
+
+def test_replica_set_is_shared():
+    eq_(replica_set([A, B]) is replica_set([list(A), list(B)]), True)
+    assert replica_set([A, B]) is not replica_set([B, A])
+
+
+docs = [{'id': 123, 'name': 'sesame'}]
+
+
+class ReplicatedTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(ReplicatedTestCase, self).setUp()
+        self.searchds = [FakeSearchd({'biscuit': docs}).start()
+                         for i in xrange(2)]
+        self.replicas = ReplicaSet([('127.0.0.1', searchd.port)
+                                    for searchd in self.searchds])
+
+        class ReplicatedBiscuit(Biscuit):
+            class SphinxMeta(BaseSphinxMeta):
+                replicas = self.replicas
+        self.model = ReplicatedBiscuit
+
+    def tearDown(self):
+        for searchd in self.searchds:
+            searchd.stop()
+        super(ReplicatedTestCase, self).tearDown()
+
+    def test_spread(self):
+        """Searches, batches, concurrent searches, and excerpts should take turns."""
+        eq_(S(self.model).query('sesame').object_ids(), [123])
+        execute_batch([S(self.model)])
+        execute_concurrently([S(self.model), S(self.model)])
+        list(S(self.model).values_dict('color').highlight('color')
+                          .with_excerpts())
+        eq_([searchd.requests for searchd in self.searchds], [3, 3])
+
+    def test_failover(self):
+        """A replica which fails should be taken out of rotation."""
+        dead = self.searchds[0]
+        dead.stop()
+        assert_raises(SearchError, list, S(self.model))
+        eq_(self.replicas.healthy(), [('127.0.0.1', self.searchds[1].port)])
+        for i in xrange(3):
+            eq_(S(self.model).object_ids(), [123])
+        eq_(self.searchds[1].requests, 3)
+
+    def test_failover_concurrently(self):
+        self.searchds[0].drop_rate = 1
+        assert_raises(SearchError, execute_concurrently,
+                      [S(self.model), S(self.model)])
+        eq_(self.replicas.healthy(), [('127.0.0.1', self.searchds[1].port)])
+
+    def test_error_replies(self):
+        """A replica answering with errors is up, so it should stay in rotation."""
+        self.searchds[0].error_rate = 1
+        assert_raises(SearchError, list, S(self.model))
+        assert_raises(SearchError, execute_concurrently,
+                      [S(self.model), S(self.model)])
+        eq_(len(self.replicas.healthy()), 2)
+
+    def test_explicit_server(self):
+        """A port passed to S should win over replicas."""
+        port = self.searchds[1].port
+        eq_(S(self.model, port=port).object_ids(), [123])
+        eq_([searchd.requests for searchd in self.searchds], [0, 1])
+
+
+class CountingSink(object):
+    def __init__(self):
+        self.counts = []
+
+    def record(self, event, duration, **info):
+        pass
+
+    def count(self, event, **info):
+        self.counts.append(event)
+
+
+class HedgingTestCase(ReplicatedTestCase):
+    def setUp(self):
+        super(HedgingTestCase, self).setUp()
+        self.searchds[0].latency = 0.5  # It's first in line, but slow.
+        self.sink = CountingSink()
+        set_sink(self.sink)
+
+    def tearDown(self):
+        set_sink(None)
+        super(HedgingTestCase, self).tearDown()
+
+    def test_hedge(self):
+        """A slow search should be raced against another replica."""
+        start = time()
+        eq_(S(self.model).timeout(hedge_after=0.05).object_ids(), [123])
+        assert time() - start < 0.3
+        eq_(self.searchds[1].requests, 1)
+        eq_(self.sink.counts, ['hedge', 'hedge_won'])
+        eq_(self.replicas.outstanding().values(), [0, 0])
+
+    def test_hedge_batch(self):
+        s = S(self.model).timeout(hedge_after=0.05)
+        execute_batch([s, S(self.model).timeout(hedge_after=0.05)])
+        eq_(s.object_ids(), [123])
+        eq_(self.sink.counts, ['hedge', 'hedge_won'])
+
+    def test_hedge_concurrently(self):
+        """The winner alone should store its results."""
+        s = S(self.model).timeout(hedge_after=0.05)
+        execute_concurrently([s], timeout=5)
+        eq_(s.object_ids(), [123])
+        eq_(self.sink.counts, ['hedge', 'hedge_won'])
+
+    def test_no_hedge_when_fast(self):
+        self.searchds[0].latency = 0
+        S(self.model).timeout(hedge_after=0.5).object_ids()
+        eq_(self.sink.counts, [])
+        eq_(self.searchds[1].requests, 0)
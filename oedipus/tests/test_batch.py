@@ -0,0 +1,74 @@
+"""Tests for running several queries in one round trip"""
+
+import fudge
+from nose.tools import eq_, assert_raises
+
+from oedipus import S, SearchError, execute_batch
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+
+
+def _result(*ids):
+    """Return a single query's worth of Sphinx results matching ``ids``."""
+    return {'status': 0,
+            'total': len(ids),
+            'matches': [{'attrs': {}, 'id': id, 'weight': 10000}
+                        for id in ids]}
+
+
+class BatchTestCase(SphinxMockingTestCase):
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_batch(self, sphinx_client):
+        """Each S should get its own slot of a single RunQueries() call."""
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('AddQuery').times_called(2)
+                      .expects('ResetFilters').times_called(1)
+                      .expects('RunQueries').times_called(1).returns(
+                          [_result(123), _result(124, 123)]))
+        red = S(Biscuit).query('red')
+        both = S(Biscuit).query('biscuit')
+        execute_batch([red, both])
+
+        # These don't hit Sphinx again; RunQueries() would complain.
+        eq_([b.color for b in red], ['red'])
+        eq_([b.color for b in both], ['blue', 'red'])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_batch_skips_cached(self, sphinx_client):
+        """An S that already has results shouldn't be run again."""
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('AddQuery').times_called(2)
+                      .expects('RunQueries').times_called(2).returns(
+                          [_result(123)]))
+        red = S(Biscuit).query('red')
+        list(red)
+        blue = S(Biscuit).query('blue')
+        execute_batch([red, blue])
+        eq_(blue.object_ids(), [123])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_batch_query_error(self, sphinx_client):
+        """A failed query should yield empty results for its S alone."""
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('RunQueries').returns(
+                          [{'status': 1,
+                            'warning': '',
+                            'error': 'index biscuit: syntax error'},
+                           _result(124)]))
+        bad = S(Biscuit).query('(')
+        good = S(Biscuit).query('blue')
+        execute_batch([bad, good])
+        eq_(list(bad), [])
+        eq_(good.object_ids(), [124])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_batch_connection_failure(self, sphinx_client):
+        """``SearchError`` should be raised, and nothing cached."""
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('RunQueries').returns(None))
+        s = S(Biscuit)
+        assert_raises(SearchError, execute_batch, [s])
+        eq_(s._raw_cache, None)
@@ -0,0 +1,273 @@
+"""Tests for caching results and DB objects across S objects"""
+
+import threading
+from time import sleep
+
+import fudge
+from nose.tools import eq_, assert_raises
+
+from oedipus import S, execute_batch, settings
+from oedipus.cache import (ResultCache, HydrationCache, LRUBackend,
+                           QueryRecorder, SingleFlight)
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, BaseSphinxMeta, SphinxMockingTestCase
+
+
+class CachedBiscuit(Biscuit):
+    class SphinxMeta(BaseSphinxMeta):
+        result_cache = ResultCache(LRUBackend(), ttl=60)
+
+
+def _mock_sphinx_once(sphinx_client):
+    """Mock Sphinx to return 2 results, insisting on a single query."""
+    (sphinx_client.expects_call().returns_fake()
+                  .is_a_stub()
+                  .expects('RunQueries').times_called(1).returns(
+                      [{'status': 0,
+                        'total': 2,
+                        'total_found': 2,
+                        'matches': [{'attrs': {}, 'id': 123, 'weight': 1},
+                                    {'attrs': {}, 'id': 124, 'weight': 1}]}]))
+
+
+class RecordingBackend(object):
+    """A backend which remembers the TTLs it was given"""
+    def __init__(self):
+        self.ttls = []
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        self.ttls.append(ttl)
+
+
+class ResultCacheTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(ResultCacheTestCase, self).setUp()
+        CachedBiscuit.SphinxMeta.result_cache = ResultCache(LRUBackend())
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_hit(self, sphinx_client):
+        """Equivalent queries should share results across S objects."""
+        _mock_sphinx_once(sphinx_client)
+        eq_(S(CachedBiscuit).filter(a=1).object_ids(), [123, 124])
+        eq_(S(CachedBiscuit).filter(a=1).object_ids(), [123, 124])
+        eq_(CachedBiscuit.SphinxMeta.result_cache.stats(),
+            {'hits': 1, 'misses': 1})
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_miss(self, sphinx_client):
+        """Queries differing in anything sent to Sphinx shouldn't share."""
+        self.mock_sphinx(sphinx_client)
+        S(CachedBiscuit).filter(a=1).object_ids()
+        S(CachedBiscuit).filter(a=2).object_ids()
+        S(CachedBiscuit).filter(a=1)[:1].object_ids()
+        S(CachedBiscuit).filter(a=1).count()
+        eq_(CachedBiscuit.SphinxMeta.result_cache.stats(),
+            {'hits': 0, 'misses': 4})
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_bypass(self, sphinx_client):
+        """``cache(bypass=True)`` should neither read nor fill the cache."""
+        self.mock_sphinx(sphinx_client)
+        S(CachedBiscuit).cache(bypass=True).object_ids()
+        S(CachedBiscuit).object_ids()
+        eq_(CachedBiscuit.SphinxMeta.result_cache.stats(),
+            {'hits': 0, 'misses': 1})
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_ttl_override(self, sphinx_client):
+        """``cache(ttl=...)`` should override the cache's default TTL."""
+        self.mock_sphinx(sphinx_client)
+        backend = RecordingBackend()
+        CachedBiscuit.SphinxMeta.result_cache = ResultCache(backend, ttl=60)
+        S(CachedBiscuit).object_ids()
+        S(CachedBiscuit).cache(ttl=30).query('a').object_ids()
+        eq_(backend.ttls, [60, 30])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_batch(self, sphinx_client):
+        """Batches should read from and fill the cache too."""
+        _mock_sphinx_once(sphinx_client)
+        S(CachedBiscuit).object_ids()
+        s = S(CachedBiscuit)
+        execute_batch([s])
+        eq_(s.object_ids(), [123, 124])
+
+
+class HydratedBiscuit(Biscuit):
+    class SphinxMeta(BaseSphinxMeta):
+        hydration_cache = HydrationCache(LRUBackend())
+
+
+class HydrationCacheTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(HydrationCacheTestCase, self).setUp()
+        self.cache = HydratedBiscuit.SphinxMeta.hydration_cache = (
+            HydrationCache(LRUBackend()))
+        self.fetched = []
+        manager_filter = Biscuit.objects.filter
+
+        def filter(id__in=None):
+            self.fetched.append(sorted(id__in))
+            return manager_filter(id__in=id__in)
+        Biscuit.objects.filter = filter
+
+    def tearDown(self):
+        del Biscuit.objects.filter
+        super(HydrationCacheTestCase, self).tearDown()
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_objects(self, sphinx_client):
+        """Objects should come out of the cache once they're in it."""
+        self.mock_sphinx(sphinx_client)
+        eq_([b.color for b in S(HydratedBiscuit)], ['red', 'blue'])
+        eq_([b.color for b in S(HydratedBiscuit)], ['red', 'blue'])
+        eq_(self.fetched, [[123, 124]])
+        eq_(self.cache.stats(), {'hits': 2, 'misses': 2})
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_dicts_any_fields(self, sphinx_client):
+        """Cached dicts should serve any choice of fields, in any format."""
+        self.mock_sphinx(sphinx_client)
+        eq_(list(S(HydratedBiscuit).values_dict('color')),
+            [{'color': 'red'}, {'color': 'blue'}])
+        eq_(list(S(HydratedBiscuit).values('id', 'color')),
+            [(123, 'red'), (124, 'blue')])
+        eq_(list(S(HydratedBiscuit).values_dict()),
+            [{'id': 123, 'color': 'red'}, {'id': 124, 'color': 'blue'}])
+        eq_(self.fetched, [[123, 124]])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_invalidate(self, sphinx_client):
+        """Invalidated IDs should be fetched again, in every form."""
+        self.mock_sphinx(sphinx_client)
+        list(S(HydratedBiscuit))
+        list(S(HydratedBiscuit).values('color'))
+        self.cache.invalidate(HydratedBiscuit, 124)
+        list(S(HydratedBiscuit))
+        list(S(HydratedBiscuit).values('color'))
+        eq_(self.fetched, [[123, 124], [123, 124], [124], [124]])
+
+
+@fudge.patch('oedipus.cache.time')
+def test_lru(time):
+    """LRUBackend should forget the least recently used and expired keys."""
+    time.is_callable().returns(1000)
+    lru = LRUBackend(max_size=2)
+    lru.set('a', 1, 10)
+    lru.set('b', 2, 10)
+    lru.get('a')
+    lru.set('c', 3, 10)
+    eq_(lru.get('b'), None)
+    eq_(lru.get('a'), 1)
+
+    time.is_callable().returns(1011)
+    eq_(lru.get('c'), None)
+
+
+def test_fingerprint_dict_order():
+    """Fingerprints shouldn't depend on the order of dict items."""
+    def fingerprint(weights):
+        recorder = QueryRecorder('localhost', 3381)
+        recorder.SetFieldWeights(weights)
+        return recorder.fingerprint()
+
+    weights = dict(('field%s' % i, i) for i in range(20))
+    reversed_weights = dict(reversed(weights.items()))
+    eq_(fingerprint(weights), fingerprint(reversed_weights))
+    assert fingerprint(weights) != fingerprint({'field0': 1})
+
+
+def _all_at_once(functions):
+    """Run each function on its own thread, and wait for them all."""
+    threads = [threading.Thread(target=f) for f in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_single_flight():
+    """Concurrent calls for one key should share a single call's result."""
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        sleep(0.1)
+        return 'biscuits'
+
+    def call():
+        results.append(flight.do('key', work))
+
+    _all_at_once([call] * 4)
+    eq_(len(calls), 1)
+    eq_(sorted(results), [('biscuits', False)] + [('biscuits', True)] * 3)
+    eq_(flight.stats(), {'led': 1, 'joined': 3})
+
+    # Once done, the next call should do the work again:
+    eq_(flight.do('key', work), ('biscuits', False))
+
+
+def test_single_flight_exception():
+    """Waiting calls should get the exception of the one doing the work."""
+    flight = SingleFlight()
+    errors = []
+
+    def work():
+        sleep(0.1)
+        raise ValueError('no biscuits')
+
+    def call():
+        try:
+            flight.do('key', work)
+        except ValueError, e:
+            errors.append(e)
+
+    _all_at_once([call] * 3)
+    eq_(len(errors), 3)
+    assert_raises(ValueError, flight.do, 'key', work)
+
+
+class SingleFlightTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(SingleFlightTestCase, self).setUp()
+        self.searchd = FakeSearchd({'biscuit': [{'id': 123}, {'id': 124}]},
+                                   latency=0.2).start()
+
+    def tearDown(self):
+        self.searchd.stop()
+        super(SingleFlightTestCase, self).tearDown()
+
+    def _search_at_once(self, searches):
+        ids = []
+        _all_at_once([lambda s=s: ids.append(s.object_ids())
+                      for s in searches])
+        return ids
+
+    def test_coalesce(self):
+        """Identical queries running at once should make one request."""
+        ids = self._search_at_once(
+                [S(Biscuit, port=self.searchd.port) for i in xrange(4)])
+        eq_(ids, [[123, 124]] * 4)
+        eq_(self.searchd.requests, 1)
+
+    def test_different(self):
+        """Different queries shouldn't wait on each other."""
+        self._search_at_once(
+                [S(Biscuit, port=self.searchd.port).query('crumbly'),
+                 S(Biscuit, port=self.searchd.port).query('chewy')])
+        eq_(self.searchd.requests, 2)
+
+    def test_off(self):
+        """SPHINX_SINGLE_FLIGHT = False should send every query."""
+        settings.SPHINX_SINGLE_FLIGHT = False
+        try:
+            self._search_at_once(
+                    [S(Biscuit, port=self.searchd.port) for i in xrange(3)])
+        finally:
+            del settings.SPHINX_SINGLE_FLIGHT
+        eq_(self.searchd.requests, 3)
@@ -0,0 +1,127 @@
+"""Tests for failing fast when searchd is down"""
+
+from time import sleep
+from unittest import TestCase
+
+from nose.tools import eq_, assert_raises
+
+import oedipus
+from oedipus import (S, SearchError, ExcerptError, ExcerptSocketError,
+                     circuit_states, execute_concurrently, settings)
+import oedipus.circuit
+from oedipus.circuit import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+from oedipus.tests.test_balancing import Clock
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self._time = oedipus.circuit.time
+        oedipus.circuit.time = self.clock
+        self.breaker = CircuitBreaker(('localhost', 3381), threshold=2,
+                                      cooldown=30)
+
+    def tearDown(self):
+        oedipus.circuit.time = self._time
+
+    def test_opens(self):
+        """Enough consecutive failures should open the breaker."""
+        self.breaker.failed()
+        self.breaker.succeeded()
+        self.breaker.failed()
+        eq_(self.breaker.state, CLOSED)
+        self.breaker.failed()
+        eq_(self.breaker.state, OPEN)
+        eq_(self.breaker.allow(), False)
+
+    def test_probe(self):
+        """After the cooldown, a single probe should be let through."""
+        self.breaker.failed()
+        self.breaker.failed()
+        self.clock.now += 31
+        eq_(self.breaker.allow(), True)
+        eq_(self.breaker.state, HALF_OPEN)
+        eq_(self.breaker.allow(), False)
+        self.breaker.succeeded()
+        eq_(self.breaker.state, CLOSED)
+        eq_(self.breaker.allow(), True)
+
+    def test_failed_probe(self):
+        """A failed probe should open the breaker for another cooldown."""
+        self.breaker.failed()
+        self.breaker.failed()
+        self.clock.now += 31
+        self.breaker.allow()
+        self.breaker.failed()
+        eq_(self.breaker.state, OPEN)
+        self.clock.now += 29
+        eq_(self.breaker.allow(), False)
+        self.clock.now += 2
+        eq_(self.breaker.allow(), True)
+
+
+docs = [{'id': 123, 'color': 'red'}]
+
+
+class BrokenSearchdTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(BrokenSearchdTestCase, self).setUp()
+        settings.SPHINX_BREAKER_THRESHOLD = 2
+        settings.SPHINX_BREAKER_COOLDOWN = 0.1
+        self.searchd = FakeSearchd({'biscuit': docs}, drop_rate=1).start()
+
+    def tearDown(self):
+        self.searchd.stop()
+        del settings.SPHINX_BREAKER_THRESHOLD
+        del settings.SPHINX_BREAKER_COOLDOWN
+        oedipus._breakers.clear()
+        super(BrokenSearchdTestCase, self).tearDown()
+
+    def s(self):
+        return S(Biscuit, port=self.searchd.port)
+
+    def test_fail_fast(self):
+        """Once the breaker opens, searches should fail without connecting."""
+        for i in xrange(2):
+            assert_raises(SearchError, list, self.s())
+        eq_(circuit_states(), {('127.0.0.1', self.searchd.port): OPEN})
+        connections = self.searchd.connections
+        assert_raises(SearchError, list, self.s())
+        assert_raises(SearchError, execute_concurrently, [self.s()])
+        assert_raises(SearchError, list, self.s().timeout(read=1))
+        eq_(self.searchd.connections, connections)
+
+    def test_excerpts(self):
+        """Excerpts should fail fast too."""
+        self.searchd.drop_rate = 0
+        s = self.s().values_dict('color').highlight('color')
+        results = list(s)
+        self.searchd.drop_rate = 1
+        for i in xrange(2):
+            assert_raises(SearchError, list, self.s())
+        assert_raises(ExcerptSocketError, s.excerpts, results)
+
+    def test_recovery(self):
+        """A successful probe after the cooldown should close the breaker."""
+        for i in xrange(2):
+            assert_raises(SearchError, execute_concurrently, [self.s()])
+        self.searchd.drop_rate = 0
+        sleep(0.15)
+        eq_(self.s().object_ids(), [123])
+        eq_(circuit_states(), {('127.0.0.1', self.searchd.port): CLOSED})
+
+    def test_error_replies(self):
+        """Errors searchd answers with shouldn't open the breaker."""
+        self.searchd.drop_rate = 0
+        s = self.s().values_dict('color').highlight('color')
+        results = list(s)
+        self.searchd.error_rate = 1
+        for i in xrange(2):
+            assert_raises(ExcerptError, s.timeout(read=1).excerpts, results)
+            assert_raises(SearchError, list, self.s())
+            assert_raises(SearchError, list, self.s().timeout(read=1))
+        eq_(circuit_states(), {('127.0.0.1', self.searchd.port): CLOSED})
+        self.searchd.error_rate = 0
+        eq_(self.s().object_ids(), [123])
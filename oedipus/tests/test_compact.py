@@ -0,0 +1,96 @@
+"""Tests for column-wise storage of Sphinx matches"""
+
+from array import array
+import cPickle
+
+import fudge
+from nose.tools import eq_, assert_raises
+
+from oedipus import S
+from oedipus.compact import CompactMatches
+from oedipus.tests import Biscuit, BaseSphinxMeta, SphinxMockingTestCase
+
+
+matches = [{'id': 1, 'weight': 10,
+            'attrs': {'a': 5, 'f': 0.5, 'tags': [1, 2], 'big': 2 ** 64 - 1}},
+           {'id': 2, 'weight': 20,
+            'attrs': {'a': 6, 'f': 1.5, 'tags': [], 'big': 3}}]
+
+
+def test_columns():
+    """Numeric attributes should get arrays; others, lists."""
+    m = CompactMatches.from_matches(matches)
+    assert isinstance(m.ids, array)
+    assert isinstance(m.column('weight'), array)
+    eq_(m.column('a').typecode in ('q', 'l'), True)
+    eq_(m.column('f').typecode, 'd')
+    eq_(m.column('tags'), [[1, 2], []])
+    eq_(m.column('big'), [2 ** 64 - 1, 3])  # Too big for a signed array
+
+
+def test_rows():
+    """Matches should read like the dicts they came from."""
+    m = CompactMatches.from_matches(matches)
+    eq_(len(m), 2)
+    eq_([r['id'] for r in m], [1, 2])
+    eq_(m[-1]['weight'], 20)
+    eq_(m[0]['attrs']['tags'], [1, 2])
+    assert 'a' in m[0]['attrs']
+    eq_(sorted(m[0]['attrs'].keys()), ['a', 'big', 'f', 'tags'])
+    assert_raises(IndexError, m.__getitem__, 2)
+    assert_raises(KeyError, m[0].__getitem__, 'nope')
+
+
+def test_slice():
+    """Slicing should slice every column."""
+    m = CompactMatches.from_matches(matches)[1:]
+    eq_(list(m.ids), [2])
+    eq_(list(m.column('f')), [1.5])
+
+
+def test_pickle():
+    """Compact matches should survive pickling, even with old protocols."""
+    compact = CompactMatches.from_matches(matches)
+    for protocol in xrange(cPickle.HIGHEST_PROTOCOL + 1):
+        result = cPickle.loads(cPickle.dumps({'matches': compact}, protocol))
+        eq_([m['id'] for m in result['matches']], [1, 2])
+        eq_(result['matches'].column('a'), array('l', [5, 6]))
+        eq_(result['matches'][1]['attrs']['tags'], [])
+        match = cPickle.loads(cPickle.dumps(compact[0], protocol))
+        eq_(match['attrs']['big'], 2 ** 64 - 1)
+
+
+def test_empty():
+    eq_(len(CompactMatches.from_matches([])), 0)
+
+
+class CompactBiscuit(Biscuit):
+    class SphinxMeta(BaseSphinxMeta):
+        compact_results = True
+
+
+class CompactResultsTestCase(SphinxMockingTestCase):
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_object_ids(self, sphinx_client):
+        self.mock_sphinx(sphinx_client)
+        s = S(CompactBiscuit)
+        eq_(s.object_ids(), [123, 124])
+        assert isinstance(s._raw()['matches'], CompactMatches)
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_attrs(self, sphinx_client):
+        """Attribute-based results should read the columns."""
+        self.mock_sphinx(sphinx_client)
+        s = S(CompactBiscuit).attrs('id', 'color')
+        eq_(list(s), [(123, 3), (124, 4)])
+        eq_(list(s[1:]), [(124, 4)])
+        eq_(list(S(CompactBiscuit).attrs_dict()),
+            [{'id': 123, 'color': 3}, {'id': 124, 'color': 4}])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_objects(self, sphinx_client):
+        """DB-backed results and counts should work as ever."""
+        self.mock_sphinx(sphinx_client)
+        s = S(CompactBiscuit)
+        eq_([b.color for b in s], ['red', 'blue'])
+        eq_(len(s), 2)
@@ -273,3 +273,51 @@ class TestExcerpt(BiscuitTestCase):
 
         results = list(s)
         s.excerpt(results[0])
+
+
+class TestExcerpts(BiscuitTestCase):
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_excerpts(self, sphinx_client):
+        """Excerpts of many results should come from one BuildExcerpts call."""
+        (sphinx_client.expects_call()
+                      .returns_fake()
+                      .is_a_stub()
+                      .expects('BuildExcerpts')
+                      .with_args(['sesame', 'has sesame foo',
+                                  'dog', 'biscuit fit for a dog'],
+                                 'biscuit',
+                                 'foo',
+                                 {'before_match': '<i>',
+                                  'after_match': '</i>'})
+                      .times_called(1)
+                      .returns(['sesame', 'has sesame <i>foo</i>',
+                                'dog', 'biscuit fit for a dog'])
+                      .expects('RunQueries')
+                      .returns(
+                          [{'status': 0,
+                            'total': 2,
+                            'matches':
+                              [{'attrs': {}, 'id': 123, 'weight': 11111},
+                               {'attrs': {}, 'id': 124, 'weight': 10000}]
+                          }]))
+
+        s = (S(Biscuit).query('foo')
+                       .highlight('name', 'content',
+                                  before_match='<i>',
+                                  after_match='</i>'))
+        pairs = list(s.with_excerpts())
+        eq_([result.id for result, excerpt in pairs], [123, 124])
+        eq_([excerpt for result, excerpt in pairs],
+            [[[u'sesame'], [u'has sesame <i>foo</i>']],
+             [[u'dog'], [u'biscuit fit for a dog']]])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_no_results(self, sphinx_client):
+        """Excerpting no results shouldn't bother Sphinx."""
+        (sphinx_client.expects_call()
+                      .returns_fake()
+                      .is_a_stub()
+                      .expects('RunQueries')
+                      .returns(no_results))
+        s = S(Biscuit).query('foo').highlight('name')
+        eq_(s.excerpts(list(s)), [])
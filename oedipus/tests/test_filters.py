@@ -1,10 +1,13 @@
 """Tests for queries, filters, and excludes"""
 
+from array import array
+
 import fudge
 from nose.tools import eq_
 
+import oedipus
 from oedipus import S, MIN_LONG, MAX_LONG
-from oedipus.tests import no_results, Biscuit, crc32
+from oedipus.tests import no_results, Biscuit, crc32, convert_str
 
 
 @fudge.patch('sphinxapi.SphinxClient')
@@ -152,3 +155,40 @@ def test_chained_filters_and_excludes(sphinx_client):
                   .expects('SetFilter').with_args('c', [3], True)
                   .expects('RunQueries').returns(no_results))
     S(Biscuit).filter(a=1).filter(b=2).exclude(c=3)._raw()
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_filter_in_set(sphinx_client):
+    """__in values should be sent sorted and without duplicates."""
+    (sphinx_client.expects_call().returns_fake()
+                  .is_a_stub()
+                  .expects('SetFilter').with_args('b', [1, 2, 3], False)
+                  .expects('RunQueries').returns(no_results))
+    S(Biscuit).filter(b__in=[3, 1, 2, 3])._raw()
+
+
+def test_filter_in_array():
+    """An array of ints should be taken as already converted."""
+    s = S(Biscuit)
+    values = s._filter_value_to_int('a', array('l', [3, 1, 2]))
+    eq_(values, [3, 1, 2])
+    eq_(type(values), list)
+
+
+def test_conversions_remembered():
+    """Converted __in values should be remembered, up to a point."""
+    oedipus._conversions.clear()
+    calls = []
+
+    def converter(value):
+        calls.append(value)
+        return convert_str(value)
+
+    eq_(oedipus._convert_all(converter, ['x', 'y', 'x']),
+        [crc32('x'), crc32('y'), crc32('x')])
+    oedipus._convert_all(converter, ['y', 'z'])
+    eq_(calls, ['x', 'y', 'z'])
+    eq_(len(oedipus._conversions[converter]), 3)
+
+    # 1 and 1.0 are equal but might convert differently:
+    eq_(map(type, oedipus._convert_all(converter, [1, 1.0])), [int, float])
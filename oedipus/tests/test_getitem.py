@@ -3,9 +3,10 @@
 import fudge
 from nose.tools import eq_, assert_raises
 
-from oedipus import S
-from oedipus.tests import (no_results, Biscuit, SphinxMockingTestCase,
-                           BigSphinxMockingTestCase)
+from oedipus import S, MAX_LONG
+from oedipus.cache import ResultCache, LRUBackend
+from oedipus.tests import (no_results, Biscuit, BaseSphinxMeta,
+                           SphinxMockingTestCase, BigSphinxMockingTestCase)
 from oedipus.utils import mix_slices
 
 
@@ -133,6 +134,10 @@ class IntegratedSlicesTestCase(BigSphinxMockingTestCase):
         # This triggers the one-and-only Sphinx hit.  We should have a
         # set of results now that we use for the rest of the test
         # case.
+        list(test_s)
+
+        # len() should use the cached results rather than running a count
+        # query.
         num_results = len(test_s)
         eq_(num_results, 7)
 
@@ -154,6 +159,29 @@ class IntegratedSlicesTestCase(BigSphinxMockingTestCase):
         num_results = len(test_s)
         eq_(num_results, 7)
 
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_hydration_memoized(self, sphinx_client):
+        """Indexing and reslicing fetched results should hit the DB only for objects it hasn't pulled out yet."""
+        self.mock_sphinx(sphinx_client)
+        fetched = []
+        manager_filter = Biscuit.objects.filter
+
+        def filter(id__in=None):
+            fetched.append(sorted(id__in))
+            return manager_filter(id__in=id__in)
+        Biscuit.objects.filter = filter
+        try:
+            s = S(Biscuit)
+            s._raw()  # Fetch from Sphinx, but not the DB.
+            list(s[1:3])
+            eq_(s[2].id, 102)
+            eq_(s[3].id, 103)
+            eq_([b.id for b in s[2:5]], [102, 103, 104])
+            eq_(len(list(s)), 7)
+        finally:
+            del Biscuit.objects.filter
+        eq_(fetched, [[101, 102], [103], [104], [100, 105, 106]])
+
 
 @fudge.patch('sphinxapi.SphinxClient')
 def test_slice_limit_setting(sphinx_client):
@@ -177,3 +205,53 @@ def test_slice_caching(sphinx_client):
     s = S(Biscuit)[2:20]
     list(s)  # Force it to do the query.
     list(s[:4])  # Reslice and iterate, tempting it to re-query.
+
+
+class IteratorTestCase(BigSphinxMockingTestCase):
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_iterator(self, sphinx_client):
+        """``iterator()`` should page through results by document ID."""
+        def results(*ids):
+            return [{'status': 0,
+                     'total': len(ids),
+                     'matches': [{'attrs': {}, 'id': id, 'weight': 1}
+                                 for id in ids]}]
+
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .remember_order()
+                      .expects('SetSortMode').with_args(4, '@id ASC')
+                      .expects('SetLimits').with_args(0, 3)
+                      .expects('RunQueries').returns(results(100, 101, 102))
+                      .expects('SetFilterRange').with_args(
+                          '@id', 103, MAX_LONG, False)
+                      .expects('SetSortMode').with_args(4, '@id ASC')
+                      .expects('SetLimits').with_args(0, 3)
+                      .expects('RunQueries').returns(results(103, 104, 105))
+                      .expects('SetFilterRange').with_args(
+                          '@id', 106, MAX_LONG, False)
+                      .expects('SetSortMode').with_args(4, '@id ASC')
+                      .expects('SetLimits').with_args(0, 3)
+                      .expects('RunQueries').returns(results(106)))
+        s = S(Biscuit).values('color')[2:5]  # Slice should be ignored.
+        eq_(list(s.iterator(chunk_size=3)),
+            [('red',), ('orange',), ('yellow',), ('green',), ('blue',),
+             ('indigo',), ('violet',)])
+        eq_(s._raw_cache, None)
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_iterator_skips_result_cache(self, sphinx_client):
+        """Chunks shouldn't fill the result cache."""
+        class CachedBiscuit(Biscuit):
+            class SphinxMeta(BaseSphinxMeta):
+                result_cache = ResultCache(LRUBackend(), ttl=60)
+
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('RunQueries').returns(
+                          [{'status': 0,
+                            'total': 1,
+                            'matches': [{'attrs': {}, 'id': 100,
+                                         'weight': 1}]}]))
+        eq_(len(list(S(CachedBiscuit).iterator(chunk_size=3))), 1)
+        eq_(CachedBiscuit.SphinxMeta.result_cache.backend._entries, {})
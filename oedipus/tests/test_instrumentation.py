@@ -0,0 +1,78 @@
+"""Tests for timing of hot paths"""
+
+import fudge
+from nose.tools import eq_
+
+from oedipus import S
+from oedipus.instrumentation import set_sink, timed, StatsdSink
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+
+
+class RecordingSink(object):
+    def __init__(self):
+        self.events = []
+
+    def record(self, event, duration, **info):
+        assert duration >= 0
+        self.events.append((event, info))
+
+
+class InstrumentationTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(InstrumentationTestCase, self).setUp()
+        self.sink = RecordingSink()
+        set_sink(self.sink)
+
+    def tearDown(self):
+        set_sink(None)
+        super(InstrumentationTestCase, self).tearDown()
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_search(self, sphinx_client):
+        """A search should report compiling, querying, and hydrating."""
+        self.mock_sphinx(sphinx_client)
+        list(S(Biscuit).filter(a=1))
+        eq_(self.sink.events,
+            [('compile', {'index': 'biscuit'}),
+             ('query', {'index': 'biscuit', 'matches': 2}),
+             ('hydrate', {'index': 'biscuit', 'matches': 2})])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_excerpts(self, sphinx_client):
+        """Building excerpts should report documents and bytes."""
+        (sphinx_client.expects_call().returns_fake()
+                      .is_a_stub()
+                      .expects('RunQueries').returns(
+                          [{'status': 0, 'total': 2,
+                            'matches': [{'attrs': {}, 'id': 123, 'weight': 1},
+                                        {'attrs': {}, 'id': 124, 'weight': 1}]}])
+                      .expects('BuildExcerpts').returns(['<b>red</b>', 'blue']))
+        s = S(Biscuit).values_dict('color').highlight('color')
+        s.excerpts(list(s))
+        eq_(self.sink.events[-1],
+            ('excerpts', {'index': 'biscuit', 'matches': 2, 'bytes': 7}))
+
+
+def test_disabled():
+    """With no sink, timing should do nothing."""
+    with timed('query', index='biscuit') as timer:
+        timer.update(matches=3)
+
+
+def test_statsd_sink():
+    """StatsdSink should send a timing and counters per event."""
+    client = (fudge.Fake('StatsClient')
+                   .expects('timing').with_args('oedipus.query.biscuit', 250)
+                   .expects('incr').with_args('oedipus.query.biscuit.matches',
+                                              7))
+    StatsdSink(client).record('query', 0.25, index='biscuit', matches=7)
+    fudge.verify()
+
+
+def test_statsd_sink_count():
+    """StatsdSink should send counted events as counters."""
+    fudge.clear_expectations()
+    client = (fudge.Fake('StatsClient')
+                   .expects('incr').with_args('oedipus.hedge.biscuit', 1))
+    StatsdSink(client).count('hedge', index='biscuit')
+    fudge.verify()
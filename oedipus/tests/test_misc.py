@@ -9,6 +9,7 @@ import sphinxapi  # Comes in sphinx source code tarball
 
 from oedipus import S, SearchError
 from oedipus.tests import no_results, Biscuit
+from oedipus.utils import Steps
 
 
 @fudge.patch('sphinxapi.SphinxClient')
@@ -33,6 +34,41 @@ def test_count(sphinx_client):
     eq_(s.count(), 0)
 
 
+@fudge.patch('sphinxapi.SphinxClient')
+def test_count_only_query(sphinx_client):
+    """``count()`` should fetch just the count, using total_found."""
+    (sphinx_client.expects_call().returns_fake()
+                  .is_a_stub()
+                  .expects('SetRankingMode').with_args(sphinxapi.SPH_RANK_NONE)
+                  .expects('SetLimits').with_args(0, 1)
+                  .expects('RunQueries').times_called(1).returns(
+                      [{'status': 0,
+                        'total': 1,
+                        'total_found': 5000,
+                        'matches': [{'attrs': {}, 'id': 3, 'weight': 1}]}]))
+    s = S(Biscuit)
+    eq_(s.count(), 5000)
+    eq_(len(s), 5000)  # cached
+    eq_(len(s[10:30]), 20)
+    eq_(len(s[4990:]), 10)
+    eq_(len(s[6000:]), 0)
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_count_uses_fetched_results(sphinx_client):
+    """``count()`` shouldn't hit Sphinx again if results are cached."""
+    (sphinx_client.expects_call().returns_fake()
+                  .is_a_stub()
+                  .expects('RunQueries').times_called(1).returns(
+                      [{'status': 0,
+                        'total': 1,
+                        'total_found': 1,
+                        'matches': []}]))
+    s = S(Biscuit)
+    s._raw()
+    eq_(s.count(), 1)
+
+
 @fudge.patch('sphinxapi.SphinxClient')
 def test_connection_failure(sphinx_client):
     """``SearchError`` should be raised on connection error."""
@@ -68,10 +104,77 @@ def test_sphinx_max_results_clips(sphinx_client, settings):
     # stop in the slice.
     s = S(Biscuit)[0:]
     # Do this to trigger the results.
-    s.count()
+    s._raw()
 
 
 def test_sanitize_query():
     """Tests _sanitize_query."""
     sq = S._sanitize_query
     eq_(sq('google.com/iq'), 'google.com\\/iq')
+
+
+def test_plan_compiled_once():
+    """An S's steps should be interpreted only once, however often it's run."""
+    s = S(Biscuit).query('yum').filter(a=1).order_by('b')
+    plan = s._compile()
+    eq_(plan.query, 'yum')
+    eq_(plan.filters, (('SetFilter', ('a', [1], False)),))
+    eq_(plan.sort, 'b ASC')
+    assert s._compile() is plan
+
+    # Slices and cache settings don't change the steps, so they share it:
+    assert s[3:5]._compile() is plan
+    assert s.cache(ttl=5)._compile() is plan
+
+    # Adding a step makes a new plan:
+    assert s.filter(c=2)._compile() is not plan
+
+
+def test_plan_highlight_options_not_shared():
+    """Highlight options of one S shouldn't leak into another's plan."""
+    s = S(Biscuit).highlight('a', before_match='<b>')
+    t = s.highlight('a', after_match='</b>')
+    eq_(t._compile().highlight_options,
+        {'before_match': '<b>', 'after_match': '</b>'})
+    eq_(s._compile().highlight_options, {'before_match': '<b>'})
+
+
+def test_steps():
+    """Steps should extend without disturbing the sequences they share."""
+    empty = Steps()
+    one = empty.plus('a')
+    two = one.plus('b')
+    fork = one.plus('c')
+    eq_(list(empty), [])
+    eq_(list(two), ['a', 'b'])
+    eq_(list(fork), ['a', 'c'])
+    eq_(list(one), ['a'])
+    eq_(len(two), 2)
+    eq_(two, ['a', 'b'])
+    assert not empty
+
+
+def test_clones_share_steps():
+    """Chaining shouldn't copy the steps of the S it builds on."""
+    s = S(Biscuit).filter(a=1)
+    t = s.filter(b=2)
+    assert t.steps._previous is s.steps
+    eq_(len(s.steps), 1)
+    eq_(len(t.steps), 2)
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_metadata(sphinx_client):
+    """Response metadata should come from a single query."""
+    (sphinx_client.expects_call().returns_fake()
+                  .is_a_stub()
+                  .expects('RunQueries').times_called(1).returns(
+                      [{'status': 0, 'total': 1, 'total_found': 40,
+                        'time': '0.012',
+                        'words': [{'word': 'yum', 'docs': 40, 'hits': 52}],
+                        'matches': []}]))
+    s = S(Biscuit).query('yum')[:1]
+    eq_(s.total_found, 40)
+    eq_(s.query_time, 0.012)
+    eq_(s.word_stats, [{'word': 'yum', 'docs': 40, 'hits': 52}])
+    eq_(list(s), [])
@@ -0,0 +1,88 @@
+"""Tests for running searches on a pool of threads"""
+
+import threading
+from time import sleep, time
+
+from nose.tools import eq_, assert_raises
+
+from oedipus import S, SearchError, execute_parallel
+from oedipus.parallel import ThreadPool
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, BaseSphinxMeta, SphinxMockingTestCase
+
+
+def test_pool_is_bounded():
+    """No more functions should run at once than there are threads."""
+    lock = threading.Lock()
+    running = [0]
+    most = [0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    pool = ThreadPool(2)
+    tasks = [pool.submit(work) for i in xrange(5)]
+    for task in tasks:
+        assert task.wait(5)
+    eq_(most[0], 2)
+
+
+def test_task_exception():
+    task = ThreadPool(1).submit(lambda: 1 / 0)
+    task.wait(5)
+    assert isinstance(task.exception, ZeroDivisionError)
+
+
+class Cookie(Biscuit):
+    class SphinxMeta(BaseSphinxMeta):
+        index = 'cookie'
+
+
+class ParallelTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(ParallelTestCase, self).setUp()
+        self.biscuits = FakeSearchd({'biscuit': [{'id': 123}]},
+                                    latency=0.2).start()
+        self.cookies = FakeSearchd({'cookie': [{'id': 124}]},
+                                   latency=0.2).start()
+
+    def tearDown(self):
+        self.biscuits.stop()
+        self.cookies.stop()
+        super(ParallelTestCase, self).tearDown()
+
+    def test_parallel(self):
+        """Searches of different hosts should run at the same time."""
+        biscuits = S(Biscuit, port=self.biscuits.port)
+        cookies = S(Cookie, port=self.cookies.port)
+        start = time()
+        execute_parallel([biscuits, cookies], max_workers=2)
+        assert time() - start < 0.35
+        eq_(biscuits.object_ids(), [123])
+        eq_(cookies.object_ids(), [124])
+        eq_(self.biscuits.requests + self.cookies.requests, 2)
+
+    def test_timeout(self):
+        """A search that misses the deadline should raise a SearchError when used."""
+        self.cookies.latency = 0.5
+        biscuits = S(Biscuit, port=self.biscuits.port)
+        cookies = S(Cookie, port=self.cookies.port)
+        start = time()
+        execute_parallel([biscuits, cookies], max_workers=2, timeout=0.3)
+        assert time() - start < 0.45
+        eq_(biscuits.object_ids(), [123])
+        assert_raises(SearchError, cookies.object_ids)
+
+    def test_error(self):
+        """A failed search should keep its error until it's used."""
+        self.cookies.stop()
+        cookies = S(Cookie, port=self.cookies.port)
+        execute_parallel([cookies])
+        assert isinstance(cookies._error, SearchError)
+        assert_raises(SearchError, list, cookies)
+        eq_(cookies._error, None)
@@ -0,0 +1,116 @@
+"""Tests for pooled, persistent connections to searchd"""
+
+import fudge
+from nose.tools import eq_
+
+from oedipus import S
+import oedipus
+from oedipus.pool import ConnectionPool
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+
+
+def _mock_clients(sphinx_client):
+    """Make each SphinxClient() return a new, distinct fake."""
+    sphinx_client.is_callable().calls(
+        lambda: fudge.Fake('SphinxClient').is_a_stub())
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_reuse(sphinx_client):
+    """A client put back into the pool should be handed out again."""
+    _mock_clients(sphinx_client)
+    pool = ConnectionPool()
+    client = pool.get('localhost', 3381)
+    pool.put(client, 'localhost', 3381)
+    assert pool.get('localhost', 3381) is client
+    # It's been taken, so there's none to reuse now:
+    assert pool.get('localhost', 3381) is not client
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_keyed_by_server(sphinx_client):
+    """Clients should be reused only for the server they point at."""
+    _mock_clients(sphinx_client)
+    pool = ConnectionPool()
+    client = pool.get('localhost', 3381)
+    pool.put(client, 'localhost', 3381)
+    assert pool.get('localhost', 3382) is not client
+
+
+@fudge.patch('sphinxapi.SphinxClient')
+def test_max_size(sphinx_client):
+    """Overflowing the pool should close the least recently used client."""
+    _mock_clients(sphinx_client)
+    pool = ConnectionPool(max_size=1)
+    old, new = pool.get('localhost', 3381), pool.get('localhost', 3381)
+    old.expects('Close')
+    pool.put(old, 'localhost', 3381)
+    pool.put(new, 'localhost', 3381)
+    assert pool.get('localhost', 3381) is new
+
+
+@fudge.patch('sphinxapi.SphinxClient', 'oedipus.pool.time')
+def test_idle_eviction(sphinx_client, time):
+    """Clients idle longer than ``max_idle`` should be closed, not reused."""
+    _mock_clients(sphinx_client)
+    time.is_callable().returns(1000)
+    pool = ConnectionPool(max_idle=60)
+    client = pool.get('localhost', 3381)
+    client.expects('Close')
+    pool.put(client, 'localhost', 3381)
+
+    time.is_callable().returns(1061)
+    assert pool.get('localhost', 3381) is not client
+
+
+@fudge.patch('sphinxapi.SphinxClient', 'os.getpid')
+def test_fork(sphinx_client, getpid):
+    """A forked child shouldn't reuse its parent's connections."""
+    _mock_clients(sphinx_client)
+    getpid.is_callable().returns(1)
+    pool = ConnectionPool()
+    client = pool.get('localhost', 3381)
+    pool.put(client, 'localhost', 3381)
+
+    getpid.is_callable().returns(2)
+    assert pool.get('localhost', 3381) is not client
+
+
+class PooledSearchTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(PooledSearchTestCase, self).setUp()
+        self._old_pool = oedipus._pool
+        oedipus._pool = ConnectionPool()
+
+    def tearDown(self):
+        oedipus._pool = self._old_pool
+        super(PooledSearchTestCase, self).tearDown()
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_search_and_excerpt_share(self, sphinx_client):
+        """Searches and excerpts should open one connection between them."""
+        (sphinx_client.expects_call().times_called(1).returns_fake()
+                      .is_a_stub()
+                      .expects('Open').times_called(1)
+                      .expects('BuildExcerpts').returns(['red'])
+                      .expects('RunQueries').returns(
+                          [{'status': 0,
+                            'total': 1,
+                            'matches': [{'attrs': {}, 'id': 123,
+                                         'weight': 10000}]}]))
+        s = S(Biscuit).highlight('color')
+        results = list(s)
+        eq_(s.excerpt(results[0]), [[u'red']])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_failure_discards(self, sphinx_client):
+        """A client whose query failed shouldn't go back into the pool."""
+        (sphinx_client.expects_call().times_called(2).returns_fake()
+                      .is_a_stub()
+                      .expects('Close')
+                      .expects('RunQueries').returns(None))
+        for i in range(2):
+            try:
+                S(Biscuit)._raw()
+            except oedipus.SearchError:
+                pass
@@ -0,0 +1,133 @@
+"""Tests for our own, non-blocking implementation of the searchd protocol"""
+
+import socket
+from struct import pack, unpack_from
+import threading
+
+from nose.tools import eq_, assert_raises
+
+from oedipus import S, SearchError, execute_concurrently
+from oedipus.protocol import (Exchange, IncompleteResponse, QueryEncoder,
+                              SearchdError, parse_search_response,
+                              SEARCHD_OK, SEARCHD_ERROR)
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+
+
+def _string(s):
+    return pack('>L', len(s)) + s
+
+
+def _search_body(ids, total_found=None):
+    """Return the body of a response to one search, matching ``ids``."""
+    return ''.join([pack('>L', SEARCHD_OK),
+                    pack('>L', 1), _string('content'),  # fields
+                    pack('>L', 1), _string('color'), pack('>L', 1),  # attrs
+                    pack('>2L', len(ids), 1)] +  # match count, id64
+                   [pack('>QLL', id, 1000, id + 100) for id in ids] +
+                   [pack('>4L', len(ids), total_found or len(ids), 7, 1),
+                    _string('biscuit'), pack('>2L', 5, 9)])
+
+
+def _response(body, status=SEARCHD_OK):
+    """Frame a response body as searchd would, handshake and all."""
+    return pack('>L2HL', 1, status, 0x116, len(body)) + body
+
+
+def test_parse_search_response():
+    """A search response should decode to what RunQueries() returns."""
+    result, = parse_search_response(_search_body([3, 4], 50), 1)
+    eq_(result['status'], SEARCHD_OK)
+    eq_(result['fields'], ['content'])
+    eq_(result['matches'],
+        [{'id': 3, 'weight': 1000, 'attrs': {'color': 103}},
+         {'id': 4, 'weight': 1000, 'attrs': {'color': 104}}])
+    eq_((result['total'], result['total_found'], result['time']),
+        (2, 50, '0.007'))
+    eq_(result['words'], [{'word': 'biscuit', 'docs': 5, 'hits': 9}])
+
+
+def test_feed_piecemeal():
+    """An exchange should wait for the whole response, however it trickles in."""
+    exchange = Exchange(0, 0x116, '', lambda body: parse_search_response(body, 1))
+    response = _response(_search_body([3]))
+    for i, byte in enumerate(response):
+        eq_(exchange.feed(byte), i == len(response) - 1)
+    eq_(exchange.finish()[0]['matches'][0]['id'], 3)
+
+
+def test_copy():
+    """A copy of an exchange should start out fresh."""
+    exchange = Exchange(0, 0x116, '', lambda body: parse_search_response(body, 1))
+    response = _response(_search_body([3]))
+    exchange.feed(response[:20])
+    twin = exchange.copy()
+    eq_(twin.request, exchange.request)
+    eq_(twin.bytes_received, 0)
+    twin.feed(response)
+    eq_(twin.finish()[0]['matches'][0]['id'], 3)
+
+
+def test_error_status():
+    """An error status from searchd should raise ``SearchdError``."""
+    exchange = Exchange(0, 0x116, '', lambda body: body)
+    exchange.feed(_response(_string('bad request'), status=SEARCHD_ERROR))
+    assert_raises(SearchdError, exchange.finish)
+
+
+def test_incomplete():
+    """A response cut short should raise ``IncompleteResponse``."""
+    exchange = Exchange(0, 0x116, '', lambda body: body)
+    exchange.feed(_response(_string('some matches'))[:-3])
+    assert_raises(IncompleteResponse, exchange.finish)
+
+
+def test_encoding():
+    """Queries should be framed as a single multi-query search command."""
+    encoder = QueryEncoder()
+    S(Biscuit).query('gerbil').filter(a__in=[1, 2])._add_query(encoder)
+    S(Biscuit).query('hamster')._add_query(encoder)
+    request = encoder.exchange().request
+    eq_(unpack_from('>L2HLL', request),
+        (1, 0, 0x116, len(request) - 12, 2))
+    assert 'gerbil' in request and 'hamster' in request
+
+
+class FakeSearchd(threading.Thread):
+    """Answer each of ``connections`` connections with a canned response."""
+    def __init__(self, responses):
+        super(FakeSearchd, self).__init__()
+        self.daemon = True
+        self.responses = responses
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(len(responses))
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        for response in self.responses:
+            conn, address = self.listener.accept()
+            conn.recv(65536)
+            conn.sendall(response)
+            conn.close()
+        self.listener.close()
+
+
+class ConcurrentTestCase(SphinxMockingTestCase):
+    def test_execute_concurrently(self):
+        """Each S should get its results."""
+        searchd = FakeSearchd([_response(_search_body([123]))] * 2)
+        searchd.start()
+        red = S(Biscuit, port=searchd.port).query('red')
+        also_red = S(Biscuit, port=searchd.port).query('rouge')
+        execute_concurrently([red, also_red], timeout=5)
+        eq_([b.color for b in red], ['red'])
+        eq_([b.color for b in also_red], ['red'])
+
+    def test_connection_refused(self):
+        """A dead searchd should cause a ``SearchError``."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        assert_raises(SearchError,
+                      execute_concurrently, [S(Biscuit, port=port)], 5)
@@ -128,6 +128,125 @@ class ResultsTestCase(SphinxMockingTestCase):
         results = S(FunnyIdBiscuit).object_ids()
         eq_(results, [123, 124])
 
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_with_weights(self, sphinx_client):
+        """Every results format should pair results with their weights."""
+        self.mock_sphinx(sphinx_client)
+        s = S(Biscuit)
+        eq_([(b.id, w) for b, w in s.with_weights()],
+            [(123, 11111), (124, 10000)])
+        eq_(list(s.values('color').with_weights()),
+            [(('red',), 11111), (('blue',), 10000)])
+        eq_(list(s[1:].with_weights())[0][1], 10000)
+        eq_(list(s.attrs_dict('color').with_weights()),
+            [({'color': 3}, 11111), ({'color': 4}, 10000)])
+
+    def test_weights_skip_missing(self):
+        """Weights should stay lined up with results when some are missing from the DB."""
+        results = ObjectResults(Biscuit, [999, 124], (), weights=[5, 6])
+        eq_([(b.color, w) for b, w in results.with_weights()], [('blue', 6)])
+
+
+class AttrResultsTestCase(SphinxMockingTestCase):
+    """Tests for results made from Sphinx attributes alone"""
+
+    def setUp(self):
+        super(AttrResultsTestCase, self).setUp()
+
+        def filter(id__in=None):
+            raise AssertionError('The DB should not be queried.')
+        Biscuit.objects.filter = filter
+
+    def tearDown(self):
+        del Biscuit.objects.filter
+        super(AttrResultsTestCase, self).tearDown()
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_tuples(self, sphinx_client):
+        """``attrs()`` should make tuples, with ``id`` as the object ID."""
+        self.mock_sphinx(sphinx_client)
+        eq_(list(S(Biscuit).attrs('color', 'id')), [(3, 123), (4, 124)])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_dicts(self, sphinx_client):
+        """``attrs_dict()`` should make dicts of the requested attributes, or all of them."""
+        self.mock_sphinx(sphinx_client)
+        eq_(list(S(Biscuit).attrs_dict('color')),
+            [{'color': 3}, {'color': 4}])
+        eq_(list(S(Biscuit).attrs_dict()),
+            [{'color': 3, 'id': 123}, {'color': 4, 'id': 124}])
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_slicing_fetched(self, sphinx_client):
+        """Slicing and indexing fetched results should line attributes up with IDs."""
+        self.mock_sphinx(sphinx_client)
+        s = S(Biscuit).attrs('id', 'color')
+        list(s)
+        eq_(list(s[1:]), [(124, 4)])
+        eq_(s[0], (123, 3))
+
+    @fudge.patch('sphinxapi.SphinxClient')
+    def test_indexing_touches_one_match(self, sphinx_client):
+        """Indexing fetched results shouldn't look at every match."""
+        self.mock_sphinx(sphinx_client)
+        s = S(Biscuit).attrs('id', 'color')
+        list(s)
+        touched = []
+
+        class Matches(list):
+            def __iter__(self):
+                touched.append('all')
+                return list.__iter__(self)
+
+            def __getitem__(self, k):
+                touched.append(k)
+                return list.__getitem__(self, k)
+        raw = s._raw()
+        raw['matches'] = Matches(raw['matches'])
+        eq_([s[i] for i in xrange(2)], [(123, 3), (124, 4)])
+        eq_(touched, [0, 1])
+
+    def test_no_fields(self):
+        """An empty attrs() call should raise ``TypeError``."""
+        assert_raises(TypeError, S(Biscuit).attrs)
+
+
+class LazyResultsTestCase(SphinxMockingTestCase):
+    """Tests for chunked, lazy pulling of objects out of the DB"""
+
+    def setUp(self):
+        super(LazyResultsTestCase, self).setUp()
+        Biscuit(id=125, color='green')
+        self.fetched = []
+        manager_filter = Biscuit.objects.filter
+
+        def filter(id__in=None):
+            self.fetched.append(list(id__in))
+            return manager_filter(id__in=id__in)
+        Biscuit.objects.filter = filter
+
+    def tearDown(self):
+        del Biscuit.objects.filter
+        super(LazyResultsTestCase, self).tearDown()
+
+    def test_chunks(self):
+        """Objects should be fetched a chunk at a time as iteration reaches them, skipping missing ones."""
+        results = iter(ObjectResults(Biscuit, [125, 999, 123, 124], (),
+                                     chunk_size=2))
+        eq_(self.fetched, [])
+        eq_(next(results).color, 'green')
+        eq_(self.fetched, [[125, 999]])
+        eq_([r.color for r in results], ['red', 'blue'])
+        eq_(self.fetched, [[125, 999], [123, 124]])
+
+    def test_dict_chunks(self):
+        """Chunking should work for dicts too."""
+        results = DictResults(Biscuit, [124, 125, 123], ('color',),
+                              chunk_size=2)
+        eq_(list(results),
+            [{'color': 'blue'}, {'color': 'green'}, {'color': 'red'}])
+        eq_(self.fetched, [[124, 125], [123]])
+
 
 def test_object_content_for_fields():
     TestResult = collections.namedtuple('TestResult', ['field1', 'field2'])
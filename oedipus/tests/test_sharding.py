@@ -0,0 +1,200 @@
+"""Tests for fanning queries out to shards and merging what comes back"""
+
+from nose.tools import eq_, assert_raises
+
+import oedipus
+from oedipus import (S, SearchError, ExcerptSocketError, execute_batch,
+                     execute_concurrently, settings)
+from oedipus.sharding import (sort_key, merge_matches, merge_groups,
+                              merge_results)
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, BaseSphinxMeta, SphinxMockingTestCase
+
+
+def match(id, weight=1, **attrs):
+    return {'id': id, 'weight': weight, 'attrs': attrs}
+
+
+def test_sort_key():
+    key = sort_key('@weight DESC, @id ASC')
+    eq_(sorted([match(1, 5), match(2, 9), match(3, 9)], key=key),
+        [match(2, 9), match(3, 9), match(1, 5)])
+
+
+def test_sort_key_strings():
+    """Strings should sort descending too."""
+    key = sort_key('name DESC')
+    eq_([m['id'] for m in sorted([match(1, name='a'), match(2, name='c'),
+                                  match(3, name='b')], key=key)],
+        [2, 3, 1])
+
+
+def test_merge_matches():
+    """Merging should interleave the sorted lists, then apply the slice."""
+    key = sort_key('@id ASC')
+    lists = [[match(1), match(4), match(5)], [], [match(2), match(3)]]
+    eq_([m['id'] for m in merge_matches(lists, key, 0, 10)], [1, 2, 3, 4, 5])
+    eq_([m['id'] for m in merge_matches(lists, key, 1, 2)], [2, 3])
+    eq_(merge_matches(lists, key, 9, 2), [])
+
+
+def test_merge_matches_is_lazy():
+    """Only as many matches as the slice needs should be looked at."""
+    seen = []
+
+    def key(m):
+        seen.append(m['id'])
+        return m['id']
+    merge_matches([[match(i) for i in xrange(1, 100, 2)],
+                   [match(i) for i in xrange(2, 100, 2)]], key, 0, 3)
+    # The head of each list, and then the next of each match taken:
+    eq_(sorted(seen), [1, 2, 3, 4, 5])
+
+
+def test_merge_groups():
+    """A group found on several shards should be counted once, in all."""
+    key = sort_key('@count DESC')
+    lists = [[match(1, **{'@groupby': 7, '@count': 3}),
+              match(2, **{'@groupby': 8, '@count': 2})],
+             [match(3, **{'@groupby': 8, '@count': 4})]]
+    eq_([(m['attrs']['@groupby'], m['attrs']['@count'])
+         for m in merge_groups(lists, key)],
+        [(8, 6), (7, 3)])
+    # The shards' matches are left alone:
+    eq_(lists[0][1]['attrs']['@count'], 2)
+
+
+def test_merge_results():
+    results = [{'status': 0, 'matches': [match(1)], 'total': 1,
+                'total_found': 1, 'time': '0.010',
+                'words': [{'word': 'gerbil', 'docs': 1, 'hits': 2}]},
+               {'status': 0, 'matches': [match(2)], 'total': 3,
+                'total_found': 3, 'time': '0.020',
+                'words': [{'word': 'gerbil', 'docs': 3, 'hits': 3}]}]
+    merged = merge_results(results, '@id ASC', 0, 20)
+    eq_([m['id'] for m in merged['matches']], [1, 2])
+    eq_(merged['total_found'], 4)
+    eq_(merged['time'], '0.020')
+    eq_(merged['words'], [{'word': 'gerbil', 'docs': 4, 'hits': 5}])
+
+
+def test_merge_results_error():
+    error = {'status': 1, 'error': 'unknown index'}
+    eq_(merge_results([{'status': 0, 'matches': []}, error], '@id ASC', 0, 20),
+        error)
+
+
+docs = [{'id': id, 'name': name, 'color': color}
+        for id, name, color in [(1, 'sesame', 1), (2, 'sesame sesame', 2),
+                                (3, 'sesame ginger', 1), (4, 'ginger', 2),
+                                (5, 'sesame', 3), (6, 'oat sesame', 1)]]
+
+
+class ShardedTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(ShardedTestCase, self).setUp()
+        for doc in docs:
+            Biscuit(id=doc['id'], name=doc['name'])
+        self.whole = FakeSearchd({'biscuit': docs}).start()
+        # Split by id range, as a real deployment might:
+        self.shards = [FakeSearchd({'biscuit': docs[:3]}).start(),
+                       FakeSearchd({'biscuit': docs[3:]}).start()]
+
+        class ShardedBiscuit(Biscuit):
+            class SphinxMeta(BaseSphinxMeta):
+                shards = [('127.0.0.1', searchd.port)
+                          for searchd in self.shards]
+        self.model = ShardedBiscuit
+
+    def tearDown(self):
+        for searchd in [self.whole] + self.shards:
+            searchd.stop()
+        super(ShardedTestCase, self).tearDown()
+
+    def assert_same(self, chain):
+        """Assert that sharded results are the same as from a single searchd."""
+        sharded = chain(S(self.model))
+        whole = chain(S(self.model, port=self.whole.port))
+        eq_(sharded.object_ids(), whole.object_ids())
+        eq_(sharded.total_found, whole.total_found)
+        eq_(sharded.count(), whole.count())
+
+    def test_relevance(self):
+        self.assert_same(lambda s: s.query('sesame'))
+
+    def test_slices(self):
+        self.assert_same(lambda s: s.query('sesame')[1:4])
+        self.assert_same(lambda s: s.order_by('-color', '@id')[2:])
+        eq_(S(self.model).query('sesame')[2].id,
+            S(self.model, port=self.whole.port).query('sesame')[2].id)
+
+    def test_group_by(self):
+        self.assert_same(lambda s: s.group_by('color', '@group'))
+
+    def test_both_shards_asked(self):
+        S(self.model).query('ginger').object_ids()
+        eq_([searchd.requests for searchd in self.shards], [1, 1])
+
+    def test_count_only(self):
+        eq_(S(self.model).query('sesame').count(), 5)
+
+    def test_word_stats(self):
+        eq_(S(self.model).query('ginger').word_stats,
+            [{'word': 'ginger', 'docs': 2, 'hits': 2}])
+
+    def test_batch_and_concurrently(self):
+        a, b = S(self.model).query('ginger'), S(self.model).filter(color=1)
+        execute_concurrently([a, b], timeout=5)
+        c = S(self.model).query('oat')
+        execute_batch([c])
+        eq_([searchd.requests for searchd in self.shards], [3, 3])
+        eq_(a.object_ids(), [3, 4])
+        eq_(b.object_ids(), [1, 3, 6])
+        eq_(c.object_ids(), [6])
+
+    def page(self, timeout=None):
+        s = S(self.model).query('sesame').values_dict('name').highlight('name')
+        if timeout:
+            s = s.timeout(read=timeout)
+        return s[:2]
+
+    def test_excerpts(self):
+        """Excerpts should be built by one shard, taking turns."""
+        page = self.page()
+        results = list(page)
+        requests = [searchd.requests for searchd in self.shards]
+        for i in xrange(2):
+            excerpts = page.excerpts(results)
+            eq_(len(excerpts), 2)
+            assert all('<b>sesame</b>' in e[0][0] for e in excerpts)
+        eq_([searchd.requests for searchd in self.shards],
+            [r + 1 for r in requests])
+
+        page = self.page(timeout=5)
+        eq_(len(page.excerpts(list(page))), 2)
+
+    def test_excerpts_shard_down(self):
+        """A shard that's down should be passed over for excerpts."""
+        settings.SPHINX_BREAKER_THRESHOLD = 1
+        try:
+            page = self.page()
+            results = list(page)
+            self.shards[1].stop()
+            for i in xrange(2):
+                try:
+                    page.excerpts(results)
+                except ExcerptSocketError:
+                    pass  # Until its breaker opens
+            for i in xrange(2):
+                eq_(len(page.excerpts(results)), 2)
+        finally:
+            del settings.SPHINX_BREAKER_THRESHOLD
+            oedipus._breakers.clear()
+
+    def test_shard_down(self):
+        """A shard that can't be reached should fail the whole query."""
+        self.shards[1].stop()
+        assert_raises(SearchError, S(self.model).object_ids)
+        s = S(self.model)
+        assert_raises(SearchError, execute_concurrently, [s])
+        eq_(s._raw_cache, None)
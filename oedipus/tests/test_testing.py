@@ -0,0 +1,179 @@
+"""Tests for the fake searchd, run through the real sphinxapi and protocol"""
+
+from nose.tools import eq_, assert_raises
+
+from time import time
+
+from oedipus import (S, SearchError, ExcerptTimeoutError, execute_batch,
+                     execute_concurrently)
+from oedipus import benchmarks
+from oedipus.testing import FakeSearchd
+from oedipus.tests import Biscuit, SphinxMockingTestCase
+
+
+docs = [{'id': 123, 'name': 'Sesame snap, sesame', 'color': 3, 'price': 1.5},
+        {'id': 124, 'name': 'Digestive', 'color': 4, 'price': 2.0},
+        {'id': 125, 'name': 'Sesame digestive', 'color': 4, 'price': 3.0}]
+
+
+class FakeSearchdTestCase(SphinxMockingTestCase):
+    def setUp(self):
+        super(FakeSearchdTestCase, self).setUp()
+        Biscuit(id=125, color='sesame green')
+        self.searchd = FakeSearchd({'biscuit': docs}).start()
+
+    def tearDown(self):
+        self.searchd.stop()
+        super(FakeSearchdTestCase, self).tearDown()
+
+    def s(self):
+        return S(Biscuit, port=self.searchd.port)
+
+    def test_query(self):
+        """Matches should be ranked by hits and come with metadata."""
+        s = self.s().query('sesame')
+        eq_(s.object_ids(), [123, 125])
+        eq_(s.total_found, 2)
+        eq_(s.word_stats, [{'word': 'sesame', 'docs': 2, 'hits': 3}])
+        eq_(len(self.s().query('sesame')), 2)
+
+    def test_filter_and_order(self):
+        eq_(self.s().filter(color=4).order_by('-price').object_ids(),
+            [125, 124])
+        eq_(self.s().exclude(color=4).object_ids(), [123])
+
+    def test_group_by(self):
+        raw = self.s().group_by('color', '-@group')._raw()
+        eq_([(m['id'], m['attrs']['@count']) for m in raw['matches']],
+            [(124, 2), (123, 1)])
+
+    def test_slice(self):
+        eq_([b.color for b in self.s().order_by('@id')[1:3]],
+            ['blue', 'sesame green'])
+
+    def test_excerpts(self):
+        s = self.s().query('sesame').values_dict('color').highlight('color')
+        eq_([e for r, e in s.with_excerpts()],
+            [[[u'red']], [[u'<b>sesame</b> green']]])
+
+    def test_excerpts_of_page(self):
+        """A slice taken after counting should still know its query."""
+        s = self.s().query('sesame').values_dict('color').highlight('color')
+        eq_(s.count(), 2)
+        page = s[0:10]
+        eq_(page.excerpts(list(page)),
+            [[[u'red']], [[u'<b>sesame</b> green']]])
+
+    def test_concurrently(self):
+        """Our own protocol implementation should work against it too."""
+        a, b = self.s().query('digestive'), self.s().filter(color=3)
+        execute_concurrently([a, b], timeout=5)
+        eq_(a.object_ids(), [124, 125])
+        eq_(b.object_ids(), [123])
+
+    def test_unknown_index(self):
+        """A query of a missing index should fail."""
+        class Nonesuch(Biscuit):
+            class SphinxMeta(object):
+                index = 'nonesuch'
+        assert_raises(SearchError, list, S(Nonesuch, port=self.searchd.port))
+
+
+def test_benchmarks():
+    """Each benchmark scenario should run."""
+    with FakeSearchd({'biscuit': benchmarks.corpus(50)}) as searchd:
+        for name, search in benchmarks.scenarios(searchd.port):
+            eq_(len(benchmarks.measure(search, 1, warmup=0)), 1)
+
+
+def test_keywords():
+    """Keyword requests should count each word's docs and hits."""
+    import sphinxapi
+    with FakeSearchd({'biscuit': docs}) as searchd:
+        client = sphinxapi.SphinxClient()
+        client.SetServer('127.0.0.1', searchd.port)
+        eq_(client.BuildKeywords('Sesame fig', 'biscuit', 1),
+            [{'tokenized': 'sesame', 'normalized': 'sesame',
+              'docs': 2, 'hits': 3},
+             {'tokenized': 'fig', 'normalized': 'fig', 'docs': 0, 'hits': 0}])
+
+
+class FaultTestCase(SphinxMockingTestCase):
+    def s(self, searchd):
+        return S(Biscuit, port=searchd.port)
+
+    def test_latency(self):
+        """Latency should make queries time out."""
+        with FakeSearchd({'biscuit': docs}, latency=0.5) as searchd:
+            assert_raises(SearchError, execute_concurrently,
+                          [self.s(searchd)], timeout=0.1)
+
+    def test_errors(self):
+        """With an error rate of 1, every query should fail."""
+        with FakeSearchd({'biscuit': docs}, error_rate=1) as searchd:
+            assert_raises(SearchError, list, self.s(searchd))
+            eq_(searchd.requests, 1)
+
+    def test_drops(self):
+        """With a drop rate of 1, every connection should be hung up on."""
+        with FakeSearchd({'biscuit': docs}, drop_rate=1) as searchd:
+            assert_raises(SearchError, execute_concurrently,
+                          [self.s(searchd)], timeout=5)
+            eq_(searchd.connections, 1)
+
+    def test_rates_are_seeded(self):
+        """The same seed should fail the same requests."""
+        def failures(seed):
+            with FakeSearchd({'biscuit': docs}, error_rate=0.5,
+                             seed=seed) as searchd:
+                outcomes = []
+                for i in xrange(10):
+                    try:
+                        self.s(searchd).object_ids()
+                    except SearchError:
+                        outcomes.append(i)
+                return outcomes
+        eq_(failures(7), failures(7))
+
+    def test_read_timeout(self):
+        """A read timeout should give up on a slow searchd early."""
+        with FakeSearchd({'biscuit': docs}, latency=0.5) as searchd:
+            start = time()
+            assert_raises(SearchError, list, self.s(searchd).timeout(read=0.1))
+            assert time() - start < 0.3
+
+    def test_batch_timeout(self):
+        """Batched searches should keep to their time limits too."""
+        with FakeSearchd({'biscuit': docs}, latency=0.5) as searchd:
+            start = time()
+            assert_raises(SearchError, execute_batch,
+                          [self.s(searchd).timeout(read=0.1),
+                           self.s(searchd).query('sesame').timeout(read=0.1)])
+            assert time() - start < 0.3
+            eq_(searchd.requests, 1)
+
+            # S objects with different limits don't share a batch:
+            fast = self.s(searchd).timeout(read=2)
+            execute_batch([fast, self.s(searchd).timeout(read=3)])
+            eq_(searchd.requests, 3)
+            eq_(fast.object_ids(), [123, 124, 125])
+
+    def test_excerpt_timeout(self):
+        with FakeSearchd({'biscuit': docs}) as searchd:
+            s = (self.s(searchd).values_dict('color').highlight('color')
+                                .timeout(read=0.1))
+            results = list(s)
+            searchd.latency = 0.5
+            assert_raises(ExcerptTimeoutError, s.excerpts, results)
+
+    def test_timeouts_from_meta(self):
+        """Timeouts should default to the SphinxMeta's, overridden per S."""
+        class TimelyBiscuit(Biscuit):
+            class SphinxMeta(Biscuit.SphinxMeta):
+                connect_timeout = 1
+                read_timeout = 2
+        eq_(S(TimelyBiscuit).timeout(read=3)._deadlines(), (1, 3, None))
+        eq_(S(TimelyBiscuit).timeout(read=3).timeout(hedge_after=4)
+                            ._deadlines(),
+            (1, 3, 4))
+        eq_(S(Biscuit)._deadlines(), None)
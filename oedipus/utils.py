@@ -52,3 +52,47 @@ def mix_slices(j, k):
 
         return slice(jstart + kstart, stop)
     return jstart + k
+
+
+class Steps(object):
+    """An immutable sequence which shares structure with the ones it's built from
+
+    ``plus()`` returns a new sequence with one more item on the end, in
+    constant time, leaving the original alone. Under the hood, it's a linked
+    list running from the last item back to the first, so any number of
+    sequences can share a common beginning.
+
+    """
+    __slots__ = ('_previous', '_last', '_len')
+
+    def __init__(self):
+        self._previous = self._last = None
+        self._len = 0
+
+    def plus(self, item):
+        """Return a new sequence consisting of my items followed by ``item``."""
+        new = Steps()
+        new._previous, new._last, new._len = self, item, self._len + 1
+        return new
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        items = []
+        node = self
+        while node._len:
+            items.append(node._last)
+            node = node._previous
+        return reversed(items)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Steps, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Steps(%r)' % list(self)